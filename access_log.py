@@ -0,0 +1,133 @@
+"""
+非阻塞日志与结构化访问日志
+- setup_async_logging: 根日志器的输出改为放入有界队列，由后台线程写出，
+  队列满时丢弃并计数，请求处理线程不会因为日志 I/O 阻塞
+- AccessLog: 每条隧道（或普通 HTTP 请求）一条 JSON 访问记录，支持按比例采样，
+  同样经有界队列由后台线程批量写出
+"""
+import atexit
+import json
+import logging
+import queue
+import random
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+class DroppingQueueHandler(QueueHandler):
+    """队列满时丢弃日志而不是阻塞或报错"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def setup_async_logging(max_queue=10000):
+    """将根日志器现有的输出改为经队列异步写出，重复调用无副作用，返回队列处理器"""
+    root = logging.getLogger()
+    for handler in root.handlers:
+        if isinstance(handler, DroppingQueueHandler):
+            return handler
+    handlers = list(root.handlers)
+    queue_handler = DroppingQueueHandler(queue.Queue(max_queue))
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # 退出前写出队列中剩余的日志（如关闭服务器时的日志）
+    atexit.register(listener.stop)
+    return queue_handler
+
+def dropped_log_records():
+    """异步日志因队列满而丢弃的条数"""
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, DroppingQueueHandler):
+            return handler.dropped
+    return 0
+
+STOP = object()  # 访问日志队列的结束标记
+
+class AccessLog:
+    """采样的 JSON 访问日志，path 为 '-' 时写到标准输出"""
+
+    def __init__(self, path='-', sample_rate=1.0, max_queue=10000, batch_size=512, close_timeout=5):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.close_timeout = close_timeout
+        # 在启动时打开文件，路径无效时直接报错而不是在后台线程中失败
+        self.stream = sys.stdout if path == '-' else open(path, 'a', encoding='utf-8')
+        self.queue = queue.Queue(max_queue)
+        self.written = 0
+        self.dropped = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True, name='access-log')
+        self.thread.start()
+        atexit.register(self.close)
+
+    def sample(self):
+        """决定是否记录当前连接，未采样的连接不产生任何日志开销"""
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def write(self, record):
+        """提交一条访问记录，队列满时丢弃"""
+        if self.closed:
+            self.dropped += 1
+            return
+        record.setdefault('ts', time.time())
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        """后台线程: 批量序列化并写出记录，取到结束标记时写出已取出的记录后退出"""
+        stopping = False
+        while not stopping:
+            records = [self.queue.get()]
+            while len(records) < self.batch_size:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if STOP in records:
+                stopping = True
+                records = [r for r in records if r is not STOP]
+            if not records:
+                continue
+            try:
+                self.stream.write(''.join(json.dumps(r, ensure_ascii=False) + '\n' for r in records))
+                self.stream.flush()
+                self.written += len(records)
+            except (OSError, ValueError):
+                self.dropped += len(records)
+
+    def close(self):
+        """写出队列中剩余的记录并停止后台线程，重复调用无副作用
+
+        在排空结束和解释器退出时调用，否则守护线程随进程退出，队列中的记录丢失
+        """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.queue.put(STOP, timeout=self.close_timeout)
+        except queue.Full:
+            pass
+        self.thread.join(self.close_timeout)
+        if self.stream is not sys.stdout and not self.thread.is_alive():
+            self.stream.close()
+
+    def get_stats(self):
+        """获取访问日志统计信息"""
+        return {
+            'access_log_written': self.written,
+            'access_log_dropped': self.dropped
+        }
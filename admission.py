@@ -0,0 +1,94 @@
+"""
+连接准入控制
+accept 之后立即判断是否接收新连接，超出限制时返回 503，避免突发流量或慢速上游
+拖垮整个进程:
+- 全局并发连接上限
+- 单个客户端 IP 的并发连接上限
+- 握手中（读取请求头、连接目标）的连接数上限
+"""
+import threading
+
+REJECT_GLOBAL = 'global'
+REJECT_PER_IP = 'per_ip'
+REJECT_PENDING = 'pending'
+
+class AdmissionTicket:
+    """一个已准入的连接，握手完成和连接结束时分别通知准入控制"""
+
+    __slots__ = ('control', 'ip', 'pending', 'released')
+
+    def __init__(self, control, ip):
+        self.control = control
+        self.ip = ip
+        self.pending = True
+        self.released = False
+
+    def established(self):
+        """握手完成（已连接目标或开始转发请求），不再占用握手队列"""
+        if self.pending:
+            self.pending = False
+            self.control.finish_handshake()
+
+    def release(self):
+        """连接结束，可重复调用"""
+        if not self.released:
+            self.released = True
+            self.control.release(self)
+
+class AdmissionControl:
+    """并发连接计数与准入判断，各项上限为 0 时表示不限制"""
+
+    def __init__(self, max_connections=0, max_per_ip=0, max_pending=0):
+        self.max_connections = max_connections
+        self.max_per_ip = max_per_ip
+        self.max_pending = max_pending
+        self.active = 0
+        self.pending = 0
+        self.per_ip = {}  # ip -> 并发连接数
+        self.rejected = {REJECT_GLOBAL: 0, REJECT_PER_IP: 0, REJECT_PENDING: 0}
+        self.lock = threading.Lock()
+
+    def admit(self, ip):
+        """尝试准入一个新连接，返回 (ticket, None) 或 (None, 拒绝原因)"""
+        with self.lock:
+            if self.max_connections and self.active >= self.max_connections:
+                reason = REJECT_GLOBAL
+            elif self.max_pending and self.pending >= self.max_pending:
+                reason = REJECT_PENDING
+            elif self.max_per_ip and self.per_ip.get(ip, 0) >= self.max_per_ip:
+                reason = REJECT_PER_IP
+            else:
+                self.active += 1
+                self.pending += 1
+                self.per_ip[ip] = self.per_ip.get(ip, 0) + 1
+                return AdmissionTicket(self, ip), None
+            self.rejected[reason] += 1
+            return None, reason
+
+    def finish_handshake(self):
+        with self.lock:
+            self.pending -= 1
+
+    def release(self, ticket):
+        with self.lock:
+            if ticket.pending:
+                ticket.pending = False
+                self.pending -= 1
+            self.active -= 1
+            count = self.per_ip.get(ticket.ip, 0) - 1
+            if count > 0:
+                self.per_ip[ticket.ip] = count
+            else:
+                self.per_ip.pop(ticket.ip, None)
+
+    def get_stats(self):
+        """获取准入控制统计信息"""
+        with self.lock:
+            return {
+                'admission_active': self.active,
+                'admission_pending': self.pending,
+                'admission_clients': len(self.per_ip),
+                'admission_rejected_global': self.rejected[REJECT_GLOBAL],
+                'admission_rejected_per_ip': self.rejected[REJECT_PER_IP],
+                'admission_rejected_pending': self.rejected[REJECT_PENDING]
+            }
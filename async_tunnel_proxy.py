@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+基于 asyncio 事件循环的 HTTP CONNECT 隧道代理服务器
+单个事件循环承载所有隧道，避免每个连接三个线程的开销
+"""
+import asyncio
+import logging
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from tunnel_proxy import TunnelProxy
+from request_head import RequestHead
+from tracing import PHASE_HEAD, PHASE_QUEUE
+
+logger = logging.getLogger(__name__)
+
+try:
+    import resource
+except ImportError:  # 非 Unix 平台
+    resource = None
+
+class AsyncTunnelProxy(TunnelProxy):
+    """asyncio 引擎：与 TunnelProxy 保持相同的 CONNECT 语义、上游回退和统计"""
+
+    def __init__(self, host='0.0.0.0', port=10800, connect_workers=64, http_workers=128, **kwargs):
+        super().__init__(host=host, port=port, **kwargs)
+        # 建立连接阶段复用 connect_to_target（含上游代理回退），在有限线程池中执行
+        # buffer_size 为每次读取的最大字节数；空闲隧道不持有缓冲区
+        self.connect_workers = connect_workers
+        self.connect_executor = None
+        # 普通 HTTP 代理连接（keep-alive、流式消息体）复用阻塞实现，在独立线程池中处理
+        self.http_workers = http_workers
+        self.http_executor = None
+        self.loop = None
+        self.accept_task = None
+        self.drain_task = None
+
+    async def read_request_head(self, client_socket):
+        """读取客户端请求头，连接关闭或超出大小限制时返回已读取的部分"""
+        head = RequestHead()
+        while not head.complete and not head.full:
+            n = await self.loop.sock_recv_into(client_socket, head.free_space())
+            if not n:
+                break
+            head.feed(n)
+        return head
+
+    async def send_error_response_async(self, client_socket, error):
+        """发送HTTP错误响应"""
+        try:
+            response = f"HTTP/1.1 {error}\r\nConnection: close\r\n\r\n"
+            await self.loop.sock_sendall(client_socket, response.encode())
+        except Exception:
+            pass
+
+    def connect_in_executor(self, host, port, record, trace, queued):
+        """在连接线程池中执行 connect_to_target，queued 为提交到线程池的时间"""
+        if trace:
+            trace.record(PHASE_QUEUE, queued)
+        return self.connect_to_target(host, port, record, trace)
+
+    async def handle_connect_request_async(self, client_socket, request_line, ticket=None, early_data=b'',
+                                           trace=None):
+        """处理HTTP CONNECT请求，early_data 为客户端紧跟请求头发送的数据，隧道建立后转发给目标"""
+        record = None
+        try:
+            target = self.parse_connect_target(request_line)
+            if not target:
+                await self.send_error_response_async(client_socket, "400 Bad Request")
+                return False
+            host, port = target
+
+            logger.debug("CONNECT请求: %s:%s", host, port)
+            record = self.new_access_record(client_socket, f"{host}:{port}")
+
+            # 建立到目标服务器的连接（阻塞操作放到线程池中）
+            target_socket = await self.loop.run_in_executor(
+                self.connect_executor, self.connect_in_executor, host, port, record, trace,
+                trace and time.monotonic()
+            )
+            if ticket:
+                ticket.established()
+            if not target_socket:
+                if record:
+                    record['status'] = 502
+                await self.send_error_response_async(client_socket, "502 Bad Gateway")
+                return False
+            target_socket.setblocking(False)
+            if record:
+                record['status'] = 200
+                record['setup_ms'] = round((time.monotonic() - record['started']) * 1000, 1)
+
+            # 发送连接成功响应
+            response = "HTTP/1.1 200 Connection Established\r\n\r\n"
+            await self.loop.sock_sendall(client_socket, response.encode())
+            self.finish_setup_trace(trace, record)
+            if early_data:
+                await self.loop.sock_sendall(target_socket, early_data)
+                self.bytes_in.inc(len(early_data))
+
+            # 开始隧道转发
+            bytes_in, bytes_out = await self.start_tunnel_async(client_socket, target_socket, f"{host}:{port}")
+            if record:
+                record['bytes_in'] = bytes_in + len(early_data)
+                record['bytes_out'] = bytes_out
+            return True
+
+        except Exception as e:
+            logger.error(f"处理CONNECT请求失败: {e}")
+            if record and record['status'] is None:
+                record['status'] = 500
+            await self.send_error_response_async(client_socket, "500 Internal Server Error")
+            return False
+        finally:
+            self.finish_access_record(record)
+
+    async def forward_data_async(self, source, destination, target_info, direction, byte_counter, timer):
+        """单向数据转发，源端 EOF 时半关闭目标端的写方向，返回转发的字节数"""
+        bytes_count = 0
+        try:
+            while True:
+                data = await self.loop.sock_recv(source, self.buffer_size)
+                if not data:
+                    break
+                await self.loop.sock_sendall(destination, data)
+                bytes_count += len(data)
+                byte_counter.inc(len(data))
+                timer.touch()
+            destination.shutdown(socket.SHUT_WR)
+        except Exception as e:
+            logger.debug(f"数据转发结束 {direction}: {e}")
+            # 任一方向出错时中断整个隧道
+            self.abort_tunnel(source, destination)
+        finally:
+            logger.debug("隧道关闭 %s - %s: 传输 %d 字节", target_info, direction, bytes_count)
+        return bytes_count
+
+    async def start_tunnel_async(self, client_socket, target_socket, target_info):
+        """启动双向数据转发隧道，返回 (客户端->目标字节数, 目标->客户端字节数)"""
+        self.active_tunnels.inc()
+        # 空闲超时和最长存活时间由 tunnel_timeouts 统一处理，到期时 shutdown 两端结束转发
+        timer = self.register_tunnel_timer(client_socket, target_socket, target_info)
+        try:
+            bytes_in, bytes_out = await asyncio.gather(
+                self.forward_data_async(client_socket, target_socket, target_info, "客户端->目标",
+                                        self.bytes_in, timer),
+                self.forward_data_async(target_socket, client_socket, target_info, "目标->客户端",
+                                        self.bytes_out, timer),
+            )
+        finally:
+            timer.close()
+            try:
+                target_socket.close()
+            except Exception:
+                pass
+            self.active_tunnels.dec()
+        return bytes_in, bytes_out
+
+    async def handle_client_async(self, client_socket, client_address, ticket=None, accepted=None):
+        """处理客户端连接，ticket 为准入控制分配的凭据，accepted 为 accept 返回的时间（阶段跟踪用）"""
+        try:
+            self.connections_total.inc()
+            logger.debug("新连接来自: %s", client_address)
+            trace = self.new_trace(accepted)
+
+            # 读取客户端请求，30秒超时
+            head_started = trace and time.monotonic()
+            head = await asyncio.wait_for(self.read_request_head(client_socket), 30)
+            if trace:
+                trace.record(PHASE_HEAD, head_started)
+
+            if not head.length:
+                logger.warning(f"客户端 {client_address} 未发送数据")
+                return
+
+            request_line = head.request_line()
+            is_connect = request_line.startswith('CONNECT')
+            # 只复制需要的部分，隧道存续期间不再持有请求头的缓冲区
+            payload = head.leftover() if is_connect else head.data()
+            del head
+
+            # 处理CONNECT请求
+            if is_connect:
+                await self.handle_connect_request_async(client_socket, request_line, ticket, payload, trace)
+            elif self.is_http_request(request_line):
+                if ticket:
+                    ticket.established()
+                client_socket.setblocking(True)
+                await self.loop.run_in_executor(
+                    self.http_executor, self.http_forwarder.handle, client_socket, payload
+                )
+            else:
+                # 不支持的请求类型
+                logger.warning(f"不支持的请求: {request_line}")
+                await self.send_error_response_async(client_socket, "405 Method Not Allowed")
+
+        except asyncio.TimeoutError:
+            logger.warning(f"客户端 {client_address} 超时")
+        except Exception as e:
+            logger.error(f"处理客户端 {client_address} 时发生错误: {e}")
+        finally:
+            try:
+                client_socket.close()
+            except Exception:
+                pass
+            if ticket:
+                ticket.release()
+
+    def raise_fd_limit(self):
+        """将文件描述符软限制提升到硬限制，以容纳大量并发隧道"""
+        if resource is None:
+            return
+        try:
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            if soft < hard:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+                logger.info(f"文件描述符限制: {soft} -> {hard}")
+        except (ValueError, OSError) as e:
+            logger.warning(f"无法提升文件描述符限制: {e}")
+
+    async def serve(self, server_socket):
+        """运行 accept 主循环，收到 SIGTERM 后停止 accept 并等待已有连接结束"""
+        self.loop = asyncio.get_running_loop()
+        tasks = set()
+        self.accept_task = self.loop.create_task(self.accept_loop(server_socket, tasks))
+        self.shutdown.install(self.loop)
+        self.profiling.install(self.loop)
+        self.mark_ready()
+        try:
+            await self.accept_task
+        except asyncio.CancelledError:
+            if self.shutdown.reason is None:
+                raise
+        server_socket.close()
+        await self.drain_async(tasks)
+
+    def stop_accepting(self):
+        """SIGTERM: 取消 accept 主循环；排空期间再次收到时取消排空等待"""
+        if not self.accept_task.done():
+            self.accept_task.cancel()
+        elif self.drain_task is not None:
+            self.drain_task.cancel()
+
+    async def drain_async(self, tasks):
+        """等待已有连接任务结束，最多 drain_timeout 秒"""
+        self.begin_drain()
+        if tasks:
+            self.drain_task = asyncio.ensure_future(asyncio.wait(set(tasks), timeout=self.drain_timeout))
+            try:
+                await self.drain_task
+            except asyncio.CancelledError:
+                pass
+        self.finish_drain()
+
+    async def accept_loop(self, server_socket, tasks):
+        """事件循环中的 accept 主循环"""
+        while True:
+            client_socket, client_address = await self.loop.sock_accept(server_socket)
+            # 超出准入限制时直接返回 503
+            ticket, reason = self.admission.admit(client_address[0])
+            if ticket is None:
+                self.reject_connection(client_socket, client_address, reason)
+                continue
+            client_socket.setblocking(False)
+            accepted = self.tracer and time.monotonic()
+            task = self.loop.create_task(self.handle_client_async(client_socket, client_address, ticket, accepted))
+            # 保留任务引用，防止被垃圾回收
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    def start(self):
+        """启动代理服务器"""
+        self.raise_fd_limit()
+        self.connect_executor = ThreadPoolExecutor(
+            max_workers=self.connect_workers, thread_name_prefix='connect'
+        )
+        self.http_executor = ThreadPoolExecutor(
+            max_workers=self.http_workers, thread_name_prefix='http'
+        )
+
+        server_socket = None
+        try:
+            server_socket = self.server_socket = self.create_server_socket(backlog=1024)
+            server_socket.setblocking(False)
+
+            logger.info(f"🚀 HTTP CONNECT隧道代理服务器启动 (asyncio 引擎)")
+            logger.info(f"📍 监听地址: {self.host}:{self.port}")
+            logger.info(f"🔧 配置代理: http://{self.host}:{self.port}")
+            logger.info(f"✅ 无需安装证书，支持所有HTTPS网站")
+            logger.info("=" * 50)
+
+            # 启动状态日志、上游连接池和指标服务
+            self.start_background_services()
+
+            asyncio.run(self.serve(server_socket))
+
+        except KeyboardInterrupt:
+            logger.info("\n🛑 收到停止信号，正在关闭服务器...")
+        except Exception as e:
+            logger.error(f"❌ 服务器错误: {e}")
+        finally:
+            if server_socket:
+                server_socket.close()
+            self.connect_executor.shutdown(wait=False, cancel_futures=True)
+            self.http_executor.shutdown(wait=False, cancel_futures=True)
+            logger.info("✅ 服务器已关闭")
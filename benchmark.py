@@ -0,0 +1,541 @@
+#!/usr/bin/env python3
+"""
+隧道数据面离线基准测试
+全部在本机运行: 本地目标服务器（echo/sink/source）作为 CONNECT 目标，
+本地假上游 CONNECT 代理代替 ProxyManager 的代理池（可配置慢速/失败），
+负载生成器测量连接建立延迟分位数、单隧道与总吞吐以及最大并发隧道数，
+结果以 JSON 输出，可与之前的结果对比
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # 非 Unix 平台
+    resource = None
+
+CHUNK = b'\x00' * 65536
+
+def free_port(host='127.0.0.1'):
+    """获取一个空闲端口"""
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+def percentile(values, p):
+    """计算分位数（最近秩法）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+def latency_summary(values):
+    """延迟分布摘要（毫秒）"""
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'p50_ms': percentile(values, 50) * 1000,
+        'p90_ms': percentile(values, 90) * 1000,
+        'p99_ms': percentile(values, 99) * 1000,
+        'max_ms': max(values) * 1000,
+        'mean_ms': sum(values) / len(values) * 1000
+    }
+
+def raise_fd_limit():
+    """提升文件描述符限制，便于测试大量并发隧道"""
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+async def pipe(reader, writer):
+    """单向转发直到 EOF"""
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except (ConnectionError, OSError):
+        pass
+    finally:
+        try:
+            writer.write_eof()
+        except (OSError, RuntimeError):
+            pass
+
+class TargetServer:
+    """CONNECT 目标服务器
+
+    连接建立后客户端先发送一行指令:
+    ECHO         回显后续数据
+    SINK         丢弃后续数据
+    SOURCE <n>   发送 n 字节后关闭
+    """
+
+    def __init__(self, host='127.0.0.1'):
+        self.host = host
+        self.port = None
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, 0, backlog=4096)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        try:
+            command = (await reader.readline()).split()
+            if not command:
+                return
+            if command[0] == b'ECHO':
+                await pipe(reader, writer)
+            elif command[0] == b'SINK':
+                while await reader.read(65536):
+                    pass
+            elif command[0] == b'SOURCE':
+                remaining = int(command[1])
+                while remaining > 0:
+                    chunk = CHUNK[:min(remaining, len(CHUNK))]
+                    writer.write(chunk)
+                    await writer.drain()
+                    remaining -= len(chunk)
+        except (ConnectionError, OSError, ValueError, IndexError):
+            pass
+        finally:
+            writer.close()
+
+class FakeUpstreamProxy:
+    """假上游 HTTP CONNECT 代理: 忽略请求中的目标地址，统一连接到本地目标服务器"""
+
+    def __init__(self, target, delay=0.0, fail_rate=0.0, host='127.0.0.1'):
+        self.target = target
+        self.delay = delay  # 回应 CONNECT 前的延迟（秒），模拟慢速代理
+        self.fail_rate = fail_rate  # 以 502 拒绝 CONNECT 的比例，模拟失败代理
+        self.host = host
+        self.port = None
+        self.server = None
+        self.requests = 0
+        self.failures = 0
+
+    @property
+    def address(self):
+        return f"{self.host}:{self.port}"
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, 0, backlog=4096)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        try:
+            await reader.readuntil(b'\r\n\r\n')
+            self.requests += 1
+            if self.delay:
+                await asyncio.sleep(self.delay)
+            if random.random() < self.fail_rate:
+                self.failures += 1
+                writer.write(b'HTTP/1.1 502 Bad Gateway\r\n\r\n')
+                await writer.drain()
+                return
+            target_reader, target_writer = await asyncio.open_connection(*self.target)
+            writer.write(b'HTTP/1.1 200 Connection Established\r\n\r\n')
+            await writer.drain()
+            await asyncio.gather(pipe(reader, target_writer), pipe(target_reader, writer))
+            target_writer.close()
+        except (ConnectionError, OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            writer.close()
+
+class LoadGenerator:
+    """通过被测代理建立隧道并施加负载"""
+
+    def __init__(self, proxy_address, target, timeout=30):
+        self.proxy_address = proxy_address
+        self.target = target  # CONNECT 请求中的 "host:port"
+        self.timeout = timeout
+
+    async def open_tunnel(self, command):
+        """建立隧道并发送目标指令，返回 (reader, writer, 建立耗时)"""
+        start = time.perf_counter()
+        reader, writer = await asyncio.open_connection(*self.proxy_address)
+        try:
+            writer.write(f"CONNECT {self.target} HTTP/1.1\r\nHost: {self.target}\r\n\r\n".encode())
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.timeout)
+            setup = time.perf_counter() - start
+            status = head.split(b'\r\n', 1)[0]
+            if b' 200 ' not in status + b' ':
+                raise ConnectionError(status.decode(errors='replace'))
+            writer.write(command)
+            return reader, writer, setup
+        except BaseException:
+            writer.close()
+            raise
+
+    async def run_latency(self, total, concurrency, payload=64):
+        """大量短隧道: 测量连接建立延迟和首个往返延迟"""
+        setup_times = []
+        rtt_times = []
+        errors = {}
+        semaphore = asyncio.Semaphore(concurrency)
+        data = b'x' * payload
+
+        async def one():
+            async with semaphore:
+                try:
+                    reader, writer, setup = await self.open_tunnel(b'ECHO\n')
+                    try:
+                        start = time.perf_counter()
+                        writer.write(data)
+                        await asyncio.wait_for(reader.readexactly(len(data)), self.timeout)
+                        rtt_times.append(time.perf_counter() - start)
+                        setup_times.append(setup)
+                    finally:
+                        writer.close()
+                except Exception as e:
+                    errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(total)))
+        elapsed = time.perf_counter() - start
+        return {
+            'tunnels': total,
+            'concurrency': concurrency,
+            'elapsed_s': elapsed,
+            'tunnels_per_s': len(setup_times) / elapsed if elapsed else None,
+            'setup_latency': latency_summary(setup_times),
+            'first_rtt': latency_summary(rtt_times),
+            'errors': errors
+        }
+
+    async def run_throughput(self, tunnels, size):
+        """并发下载: 测量单隧道与总吞吐"""
+        rates = []
+        setup_times = []
+        errors = {}
+        total_bytes = 0
+
+        async def one():
+            nonlocal total_bytes
+            try:
+                reader, writer, setup = await self.open_tunnel(f"SOURCE {size}\n".encode())
+                try:
+                    start = time.perf_counter()
+                    received = 0
+                    while received < size:
+                        data = await asyncio.wait_for(reader.read(65536), self.timeout)
+                        if not data:
+                            break
+                        received += len(data)
+                    elapsed = time.perf_counter() - start
+                    total_bytes += received
+                    if received < size:
+                        raise ConnectionError(f"只收到 {received}/{size} 字节")
+                    setup_times.append(setup)
+                    rates.append(received / elapsed / 1e6 if elapsed else 0)
+                finally:
+                    writer.close()
+            except Exception as e:
+                errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(tunnels)))
+        elapsed = time.perf_counter() - start
+        return {
+            'tunnels': tunnels,
+            'bytes_per_tunnel': size,
+            'elapsed_s': elapsed,
+            'aggregate_mb_s': total_bytes / elapsed / 1e6 if elapsed else None,
+            'per_tunnel_mb_s': {
+                'p50': percentile(rates, 50),
+                'min': min(rates) if rates else None,
+                'max': max(rates) if rates else None
+            },
+            'setup_latency': latency_summary(setup_times),
+            'errors': errors
+        }
+
+    async def run_concurrency(self, target_tunnels, concurrency, hold=1.0):
+        """逐步建立并保持空闲隧道，测量可同时维持的最大隧道数"""
+        open_tunnels = []
+        errors = {}
+        semaphore = asyncio.Semaphore(concurrency)
+        stop = False
+
+        async def one():
+            nonlocal stop
+            if stop:
+                return
+            async with semaphore:
+                if stop:
+                    return
+                try:
+                    reader, writer, _ = await self.open_tunnel(b'ECHO\n')
+                    open_tunnels.append((reader, writer))
+                except Exception as e:
+                    errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+                    # 连续出现大量失败时视为已达上限
+                    if sum(errors.values()) >= max(10, concurrency):
+                        stop = True
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(target_tunnels)))
+        ramp = time.perf_counter() - start
+        await asyncio.sleep(hold)
+
+        # 抽样检查保持的隧道是否仍然可用
+        sample = random.sample(open_tunnels, min(100, len(open_tunnels)))
+        alive = 0
+        for reader, writer in sample:
+            try:
+                writer.write(b'ping')
+                await asyncio.wait_for(reader.readexactly(4), 5)
+                alive += 1
+            except Exception:
+                pass
+        for _, writer in open_tunnels:
+            writer.close()
+        return {
+            'target_tunnels': target_tunnels,
+            'max_open_tunnels': len(open_tunnels),
+            'ramp_s': ramp,
+            'sample_alive': f"{alive}/{len(sample)}",
+            'errors': errors
+        }
+
+def run_pool_contention(threads, pool_size, duration, strategy, fail_rate=0.05):
+    """代理池争用微基准: 多个线程同时选择上游代理并回报连接结果，不涉及网络"""
+    from proxy_manager import ProxyManager
+
+    manager = ProxyManager(auto_update=False, selection_strategy=strategy)
+    proxies = [f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}:8080" for i in range(pool_size)]
+    manager.load_state({'all_proxies': proxies, 'available_proxies': proxies, 'proxy_failures': {}})
+    counts = [0] * threads
+    samples = [[] for _ in range(threads)]
+    go = threading.Event()
+    stop = threading.Event()
+
+    def worker(index):
+        rng = random.Random(index)
+        ops = 0
+        picks = samples[index]
+        # 所有线程就绪后同时开始，避免先启动的线程争用导致主线程无法继续创建线程
+        go.wait()
+        while not stop.is_set():
+            start = time.perf_counter()
+            proxy = manager.get_random_proxy()
+            if ops % 16 == 0:
+                picks.append(time.perf_counter() - start)
+            if proxy is not None:
+                if rng.random() < fail_rate:
+                    manager.mark_proxy_failed(proxy)
+                else:
+                    manager.mark_proxy_success(proxy, rng.uniform(0.05, 0.5))
+            ops += 1
+        counts[index] = ops
+
+    workers = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    started = time.perf_counter()
+    go.set()
+    time.sleep(duration)
+    stop.set()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    picks = [value for values in samples for value in values]
+    return {
+        'threads': threads,
+        'pool_size': pool_size,
+        'strategy': strategy,
+        'ops': sum(counts),
+        'ops_per_s': round(sum(counts) / elapsed),
+        'pick_p50_us': round(percentile(picks, 50) * 1e6, 2),
+        'pick_p99_us': round(percentile(picks, 99) * 1e6, 2),
+        'pick_max_us': round(max(picks) * 1e6, 2),
+        'available_after': manager.get_proxy_stats()['available_proxies']
+    }
+
+def start_proxy(args, upstreams):
+    """在后台线程中启动被测 TunnelProxy，代理池只包含假上游代理"""
+    from proxy_manager import ProxyManager
+    from workers import create_proxy
+    from route_cache import ROUTE_UPSTREAM
+
+    proxy_manager = ProxyManager(auto_update=False, selection_strategy=args.proxy_strategy)
+    proxy_manager.load_state({
+        'all_proxies': [u.address for u in upstreams],
+        'available_proxies': [u.address for u in upstreams],
+        'proxy_failures': {}
+    })
+    port = free_port()
+    proxy = create_proxy(
+        args.engine, '127.0.0.1', port,
+        proxy_manager=proxy_manager,
+        forward_backend=args.forward_backend,
+        buffer_size=args.buffer_size,
+        trace_phases=args.trace_phases,
+        metrics_port=0
+    )
+    if args.route == 'upstream':
+        # 预置路由缓存，使目标直接走上游代理
+        proxy.route_cache.put(args.upstream_host, 443, ROUTE_UPSTREAM, upstreams[0].address)
+    threading.Thread(target=proxy.start, daemon=True).start()
+
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    return proxy, port
+
+def environment():
+    """记录测试环境，便于跨次运行对比"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'git_commit': commit or None
+    }
+
+def compare(current, baseline_file):
+    """与之前的结果对比关键指标"""
+    with open(baseline_file, encoding='utf-8') as f:
+        baseline = json.load(f)
+
+    def flatten(prefix, value, out):
+        if isinstance(value, dict):
+            for key, item in value.items():
+                flatten(f"{prefix}.{key}" if prefix else key, item, out)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            out[prefix] = value
+        return out
+
+    old = flatten('', baseline.get('results', {}), {})
+    new = flatten('', current.get('results', {}), {})
+    print(f"\n与 {baseline_file} 对比:")
+    for key in sorted(new):
+        if key in old and old[key]:
+            change = (new[key] - old[key]) / old[key] * 100
+            print(f"  {key:<50} {old[key]:>12.3f} -> {new[key]:>12.3f} ({change:+.1f}%)")
+
+async def run_scenarios(args, proxy_port, target_port):
+    """运行选定的测试场景"""
+    target = f"127.0.0.1:{target_port}" if args.route == 'direct' else f"{args.upstream_host}:443"
+    load = LoadGenerator(('127.0.0.1', proxy_port), target, timeout=args.timeout)
+    results = {}
+    if 'latency' in args.scenarios:
+        results['latency'] = await load.run_latency(args.tunnels, args.concurrency)
+    if 'throughput' in args.scenarios:
+        results['throughput'] = await load.run_throughput(args.throughput_tunnels, args.throughput_bytes)
+    if 'concurrency' in args.scenarios:
+        results['concurrency'] = await load.run_concurrency(args.max_tunnels, args.concurrency)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='隧道数据面离线基准测试')
+    parser.add_argument('--scenarios', default='latency,throughput,concurrency',
+                        help='测试场景, 逗号分隔: latency,throughput,concurrency,pool '
+                             '(默认: latency,throughput,concurrency)')
+    parser.add_argument('--engine', choices=['threading', 'asyncio'], default='threading', help='被测服务引擎')
+    parser.add_argument('--forward-backend', choices=['auto', 'splice', 'buffer'], default='auto')
+    parser.add_argument('--buffer-size', type=int, default=65536)
+    parser.add_argument('--proxy-strategy', default='p2c', help='上游代理选择策略')
+    parser.add_argument('--trace-phases', action='store_true', help='启用连接建立阶段跟踪，用于评估其开销')
+    parser.add_argument('--route', choices=['direct', 'upstream'], default='direct',
+                        help='direct 直连本地目标, upstream 经假上游代理 (默认: direct)')
+    parser.add_argument('--upstream-host', default='bench-target.invalid', help='upstream 模式下 CONNECT 的目标主机名')
+    parser.add_argument('--upstreams', type=int, default=2, help='假上游代理数量 (默认: 2)')
+    parser.add_argument('--upstream-delay', type=float, default=0.0, help='假上游代理回应 CONNECT 前的延迟/秒')
+    parser.add_argument('--upstream-fail-rate', type=float, default=0.0, help='假上游代理拒绝 CONNECT 的比例 (0-1)')
+    parser.add_argument('--tunnels', type=int, default=2000, help='latency 场景的隧道总数 (默认: 2000)')
+    parser.add_argument('--concurrency', type=int, default=50, help='并发建立隧道数 (默认: 50)')
+    parser.add_argument('--throughput-tunnels', type=int, default=8, help='throughput 场景的并发隧道数 (默认: 8)')
+    parser.add_argument('--throughput-bytes', type=int, default=64 * 1024 * 1024,
+                        help='throughput 场景每条隧道下载字节数 (默认: 64MiB)')
+    parser.add_argument('--max-tunnels', type=int, default=2000, help='concurrency 场景的目标隧道数 (默认: 2000)')
+    parser.add_argument('--pool-threads', type=int, default=16, help='pool 场景的并发线程数 (默认: 16)')
+    parser.add_argument('--pool-size', type=int, default=500, help='pool 场景的代理数 (默认: 500)')
+    parser.add_argument('--pool-duration', type=float, default=3, help='pool 场景的运行时间/秒 (默认: 3)')
+    parser.add_argument('--timeout', type=float, default=30, help='单个操作超时/秒')
+    parser.add_argument('--seed', type=int, default=0, help='随机种子，保证跨次运行可复现')
+    parser.add_argument('--output', '-o', help='结果 JSON 输出文件 (默认: 输出到标准输出)')
+    parser.add_argument('--compare', help='与之前的结果 JSON 对比')
+    parser.add_argument('--log-level', default='WARNING', help='被测代理的日志级别 (默认: WARNING)')
+    args = parser.parse_args()
+    args.scenarios = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+
+    random.seed(args.seed)
+    raise_fd_limit()
+    logging.getLogger().setLevel(args.log_level)
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+    def run(coro):
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+    target_server = TargetServer()
+    run(target_server.start())
+    upstreams = [
+        FakeUpstreamProxy(('127.0.0.1', target_server.port), args.upstream_delay, args.upstream_fail_rate)
+        for _ in range(args.upstreams)
+    ]
+    for upstream in upstreams:
+        run(upstream.start())
+
+    results = {}
+    if 'pool' in args.scenarios:
+        results['pool'] = run_pool_contention(args.pool_threads, args.pool_size, args.pool_duration,
+                                              args.proxy_strategy)
+
+    if set(args.scenarios) & {'latency', 'throughput', 'concurrency'}:
+        proxy, proxy_port = start_proxy(args, upstreams)
+        logging.getLogger().setLevel(args.log_level)
+
+        # 负载生成器使用独立事件循环，与目标服务器、假上游互不阻塞
+        results.update(asyncio.run(run_scenarios(args, proxy_port, target_server.port)))
+        results['proxy_stats'] = proxy.get_stats()
+        results['upstream_requests'] = sum(u.requests for u in upstreams)
+        results['upstream_failures'] = sum(u.failures for u in upstreams)
+
+    config = {key: value for key, value in vars(args).items() if key not in ('output', 'compare')}
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': environment(),
+        'config': config,
+        'results': results
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+        print(f"结果已写入 {args.output}")
+    else:
+        print(text)
+    if args.compare:
+        compare(report, args.compare)
+
+if __name__ == "__main__":
+    sys.exit(main())
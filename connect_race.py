@@ -0,0 +1,119 @@
+"""
+竞速（happy eyeballs 风格）连接建立
+先发起第一个尝试，按错峰间隔陆续发起后续尝试，首个完成握手的连接胜出，
+其余进行中的尝试被取消
+"""
+import queue
+import socket
+import threading
+import time
+
+class RaceCancelled(Exception):
+    """竞速已结束，当前尝试被取消"""
+
+class ConnectRace:
+    """一次竞速连接
+
+    每个尝试是一个可调用对象 attempt(race)，成功时返回已完成握手的 socket，
+    失败时抛出异常。尝试创建 socket 后应立即调用 race.register(sock)，
+    以便竞速结束时可以中断仍在进行的连接。
+    """
+
+    def __init__(self, stagger=0.3, deadline=15):
+        self.stagger = stagger  # 相邻两次尝试之间的错峰时间（秒）
+        self.deadline = deadline  # 整体截止时间（秒）
+        self.cancelled = False
+        self.lock = threading.Lock()
+        self.inflight = set()
+        self.results = queue.Queue()
+
+    def register(self, sock):
+        """登记进行中的 socket，竞速已结束时直接取消"""
+        with self.lock:
+            if self.cancelled:
+                sock.close()
+                raise RaceCancelled()
+            self.inflight.add(sock)
+
+    def run_attempt(self, label, attempt):
+        """在线程中执行单个尝试，并把结果放入结果队列"""
+        try:
+            sock = attempt(self)
+        except Exception as e:
+            sock = None
+            error = e
+        else:
+            error = None
+        with self.lock:
+            self.inflight.discard(sock)
+            if sock is not None and self.cancelled:
+                # 已有其他尝试胜出
+                sock.close()
+                return
+            self.results.put((label, sock, error))
+
+    def cancel(self):
+        """结束竞速: 中断所有进行中的尝试，关闭未被采用的连接"""
+        with self.lock:
+            self.cancelled = True
+            inflight, self.inflight = self.inflight, set()
+        for sock in inflight:
+            try:
+                # shutdown 可以唤醒阻塞在 connect/recv 上的线程
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        while True:
+            try:
+                _, sock, _ = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if sock is not None:
+                sock.close()
+
+    def run(self, attempts):
+        """执行竞速，attempts 为 (label, attempt) 的迭代器（按需惰性生成）
+
+        返回 (label, sock, errors)，全部失败或超时时 sock 为 None
+        """
+        attempts = iter(attempts)
+        deadline = time.monotonic() + self.deadline
+        errors = []
+        pending = 0
+        exhausted = False
+        next_launch = time.monotonic()
+        try:
+            while True:
+                now = time.monotonic()
+                # 到达错峰时间，或上一个尝试已失败时发起下一个
+                if not exhausted and (pending == 0 or now >= next_launch):
+                    launch = next(attempts, None)
+                    if launch is None:
+                        exhausted = True
+                    else:
+                        label, attempt = launch
+                        threading.Thread(
+                            target=self.run_attempt, args=(label, attempt), daemon=True
+                        ).start()
+                        pending += 1
+                        next_launch = now + self.stagger
+                        continue
+                if pending == 0 or now >= deadline:
+                    if now >= deadline:
+                        errors.append(('deadline', TimeoutError(f"超过 {self.deadline} 秒连接截止时间")))
+                    return None, None, errors
+                wait = deadline - now
+                if not exhausted:
+                    wait = min(wait, max(next_launch - now, 0))
+                try:
+                    label, sock, error = self.results.get(timeout=wait)
+                except queue.Empty:
+                    continue
+                pending -= 1
+                if sock is not None:
+                    return label, sock, errors
+                errors.append((label, error))
+                # 有尝试失败时立即发起下一个，不必等待错峰时间
+                next_launch = time.monotonic()
+        finally:
+            self.cancel()
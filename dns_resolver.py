@@ -0,0 +1,270 @@
+"""
+进程内 DNS 解析缓存
+- 按记录 TTL 缓存 A/AAAA 结果，支持多地址及失败地址降级
+- 并发解析: 同一域名的并发查询合并为一次，在独立线程池中执行
+- 热门域名在过期前后台预取刷新
+- 可配置 nameserver（如本地 stub 解析器）直接发送 UDP 查询以获取真实 TTL，
+  未配置时使用系统 getaddrinfo 和默认 TTL
+"""
+import ipaddress
+import random
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+QTYPE_A = 1
+QTYPE_AAAA = 28
+RCODE_NXDOMAIN = 3
+
+class DNSError(OSError):
+    """域名解析失败"""
+
+class HostNotFound(DNSError):
+    """域名不存在（NXDOMAIN）"""
+
+def build_query(query_id, hostname, qtype):
+    """构造 DNS 查询报文（递归查询），域名无效（如空标签、超长标签）时抛出 DNSError"""
+    header = struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0)
+    try:
+        labels = hostname.rstrip('.').encode('idna').split(b'.')
+    except UnicodeError as e:
+        raise DNSError(f"无效的域名 {hostname!r}: {e}")
+    if any(not label or len(label) > 63 for label in labels):
+        raise DNSError(f"无效的域名 {hostname!r}")
+    qname = b''.join(bytes([len(label)]) + label for label in labels) + b'\x00'
+    return header + qname + struct.pack('!HH', qtype, 1)
+
+def skip_name(data, offset):
+    """跳过报文中的域名（支持压缩指针），返回其后的偏移"""
+    while True:
+        length = data[offset]
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        offset += length + 1
+
+def parse_response(data):
+    """解析 DNS 响应，返回 (query_id, rcode, [(family, address, ttl)])，报文被截断或格式错误时抛出 DNSError"""
+    try:
+        return parse_message(data)
+    except (struct.error, IndexError, ValueError) as e:
+        raise DNSError(f"无效的 DNS 响应: {e}")
+
+def parse_message(data):
+    query_id, flags, qdcount, ancount, _, _ = struct.unpack('!HHHHHH', data[:12])
+    rcode = flags & 0x000F
+    offset = 12
+    for _ in range(qdcount):
+        offset = skip_name(data, offset) + 4
+    records = []
+    for _ in range(ancount):
+        offset = skip_name(data, offset)
+        rtype, _, ttl, rdlength = struct.unpack('!HHIH', data[offset:offset + 10])
+        offset += 10
+        rdata = data[offset:offset + rdlength]
+        offset += rdlength
+        if rtype == QTYPE_A and rdlength == 4:
+            records.append((socket.AF_INET, socket.inet_ntop(socket.AF_INET, rdata), ttl))
+        elif rtype == QTYPE_AAAA and rdlength == 16:
+            records.append((socket.AF_INET6, socket.inet_ntop(socket.AF_INET6, rdata), ttl))
+    return query_id, rcode, records
+
+def parse_nameserver(nameserver):
+    """解析 "host" 或 "host:port" 形式的 nameserver 地址"""
+    if nameserver.count(':') == 1:
+        host, port = nameserver.split(':')
+        return host, int(port)
+    return nameserver, 53
+
+class DNSResolver:
+    """带 TTL 缓存和后台预取的解析器"""
+
+    def __init__(self, nameservers=None, default_ttl=60, min_ttl=5, max_ttl=3600,
+                 negative_ttl=10, max_size=10000, timeout=2.0, workers=8,
+                 prefetch_ratio=0.2, prefetch_min_hits=3):
+        self.nameservers = [parse_nameserver(ns) for ns in (nameservers or [])]
+        self.default_ttl = default_ttl  # 系统解析器无法提供 TTL 时使用
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl  # 解析失败结果的缓存时间
+        self.max_size = max_size
+        self.timeout = timeout
+        # 剩余 TTL 低于 prefetch_ratio 且期间命中不少于 prefetch_min_hits 次时后台刷新
+        self.prefetch_ratio = prefetch_ratio
+        self.prefetch_min_hits = prefetch_min_hits
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='dns')
+        self.cache = OrderedDict()  # host -> {'addresses', 'error', 'ttl', 'expires_at', 'hits'}
+        self.inflight = {}  # host -> Future，合并同一域名的并发查询
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'prefetches': 0, 'failures': 0}
+
+    def lookup(self, host):
+        """实际执行解析，返回 ([(family, address)], ttl)"""
+        if self.nameservers:
+            return self.query_nameservers(host)
+        infos = socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+        addresses = []
+        for family, _, _, _, sockaddr in infos:
+            address = (family, sockaddr[0])
+            if family in (socket.AF_INET, socket.AF_INET6) and address not in addresses:
+                addresses.append(address)
+        return addresses, self.default_ttl
+
+    def query_nameservers(self, host):
+        """通过 UDP 向配置的 nameserver 查询 A 和 AAAA 记录"""
+        last_error = None
+        for server in self.nameservers:
+            try:
+                return self.query_server(server, host)
+            except DNSError:
+                raise
+            except OSError as e:
+                last_error = e
+        raise DNSError(f"所有 nameserver 查询 {host} 失败: {last_error}")
+
+    def query_server(self, server, host):
+        """向单个 nameserver 同时发送 A/AAAA 查询并收集结果"""
+        family = socket.AF_INET6 if ':' in server[0] else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        try:
+            pending = {}
+            for qtype in (QTYPE_A, QTYPE_AAAA):
+                query_id = random.getrandbits(16)
+                pending[query_id] = qtype
+                sock.sendto(build_query(query_id, host, qtype), server)
+            deadline = time.monotonic() + self.timeout
+            records = []
+            nxdomain = False
+            while pending:
+                # 一种记录已返回而另一种超时（如 AAAA 响应丢失）时使用已收到的结果
+                try:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise socket.timeout()
+                    sock.settimeout(remaining)
+                    data, _ = sock.recvfrom(4096)
+                except socket.timeout:
+                    if records or nxdomain:
+                        break
+                    raise socket.timeout(f"nameserver {server[0]}:{server[1]} 查询超时")
+                query_id, rcode, answer = parse_response(data)
+                if query_id not in pending:
+                    continue
+                del pending[query_id]
+                nxdomain = nxdomain or rcode == RCODE_NXDOMAIN
+                records.extend(answer)
+        finally:
+            sock.close()
+        if not records:
+            raise (HostNotFound if nxdomain else DNSError)(f"域名 {host} 无可用地址")
+        # IPv4 优先，与原有仅 AF_INET 的连接行为保持一致
+        records.sort(key=lambda record: record[0] != socket.AF_INET)
+        addresses = []
+        for family, address, _ in records:
+            if (family, address) not in addresses:
+                addresses.append((family, address))
+        return addresses, min(ttl for _, _, ttl in records)
+
+    def refresh(self, host):
+        """解析并写入缓存，失败时写入负缓存"""
+        entry = None
+        try:
+            try:
+                addresses, ttl = self.lookup(host)
+                if not addresses:
+                    raise DNSError(f"域名 {host} 无可用地址")
+                ttl = min(max(ttl, self.min_ttl), self.max_ttl)
+                entry = {'addresses': addresses, 'error': None, 'ttl': ttl}
+            except Exception as e:
+                # 调用方只处理 OSError，其他异常（如 getaddrinfo 的 UnicodeError）转为 DNSError
+                error = e if isinstance(e, OSError) else DNSError(f"解析 {host} 失败: {e}")
+                entry = {'addresses': None, 'error': error, 'ttl': self.negative_ttl}
+            entry['expires_at'] = time.monotonic() + entry['ttl']
+            entry['hits'] = 0
+        finally:
+            # 无论结果如何都结束本次查询，否则之后的请求会一直拿到同一个已完成的 Future
+            with self.lock:
+                self.inflight.pop(host, None)
+                if entry is not None:
+                    entry = self.store(host, entry)
+        return entry
+
+    def store(self, host, entry):
+        """写入缓存，返回实际使用的条目；调用方需持有锁"""
+        if entry['error'] is not None:
+            self.stats['failures'] += 1
+            # 刷新失败时保留仍未过期的旧结果
+            old = self.cache.get(host)
+            if old and old['error'] is None and old['expires_at'] > time.monotonic():
+                return old
+        self.cache[host] = entry
+        self.cache.move_to_end(host)
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+        return entry
+
+    def submit_refresh(self, host):
+        """提交后台解析，同一域名同时只有一个查询，调用方需持有锁"""
+        future = self.inflight.get(host)
+        if future is None:
+            future = self.executor.submit(self.refresh, host)
+            self.inflight[host] = future
+        return future
+
+    def resolve(self, host):
+        """解析域名，返回 [(family, address)]，失败时抛出 OSError"""
+        try:
+            ip = ipaddress.ip_address(host)
+            return [(socket.AF_INET6 if ip.version == 6 else socket.AF_INET, host)]
+        except ValueError:
+            pass
+
+        now = time.monotonic()
+        with self.lock:
+            entry = self.cache.get(host)
+            if entry and entry['expires_at'] > now:
+                self.cache.move_to_end(host)
+                entry['hits'] += 1
+                self.stats['hits'] += 1
+                # 热门域名即将过期时后台预取，不阻塞当前请求
+                if (entry['error'] is None
+                        and entry['expires_at'] - now < entry['ttl'] * self.prefetch_ratio
+                        and entry['hits'] >= self.prefetch_min_hits
+                        and host not in self.inflight):
+                    self.stats['prefetches'] += 1
+                    self.submit_refresh(host)
+            else:
+                entry = None
+                self.stats['misses'] += 1
+                future = self.submit_refresh(host)
+
+        if entry is None:
+            entry = future.result(timeout=self.timeout * (len(self.nameservers) or 1) + 1)
+        if entry['error'] is not None:
+            raise entry['error']
+        return list(entry['addresses'])
+
+    def report_failure(self, host, family, address):
+        """连接某地址失败时将其移到列表末尾，后续请求优先尝试其他地址"""
+        with self.lock:
+            entry = self.cache.get(host)
+            if not entry or not entry['addresses'] or len(entry['addresses']) < 2:
+                return
+            addresses = entry['addresses']
+            if (family, address) in addresses and addresses[-1] != (family, address):
+                entry['addresses'] = [a for a in addresses if a != (family, address)] + [(family, address)]
+
+    def get_stats(self):
+        """获取解析缓存统计信息"""
+        with self.lock:
+            return {
+                'dns_cache_size': len(self.cache),
+                'dns_cache_hits': self.stats['hits'],
+                'dns_cache_misses': self.stats['misses'],
+                'dns_prefetches': self.stats['prefetches'],
+                'dns_failures': self.stats['failures']
+            }
@@ -0,0 +1,97 @@
+"""
+隧道数据转发后端
+Linux 上通过 os.splice 经内核管道在 socket 之间零拷贝搬运数据，
+不支持时回退到 recv_into + 复用 memoryview 缓冲区
+"""
+import os
+import select
+
+try:
+    import fcntl
+except ImportError:  # 非 Unix 平台
+    fcntl = None
+
+SPLICE_AVAILABLE = hasattr(os, 'splice') and hasattr(os, 'SPLICE_F_MOVE')
+
+def wait_ready(sock, writable=False, timeout=None):
+    """等待 socket 可读（或可写），返回是否就绪
+    优先使用 poll，select 无法处理编号超过 FD_SETSIZE(1024) 的描述符
+    """
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        poller.register(sock, select.POLLOUT if writable else select.POLLIN)
+        return bool(poller.poll(None if timeout is None else timeout * 1000))
+    if writable:
+        return bool(select.select([], [sock], [], timeout)[1])
+    return bool(select.select([sock], [], [], timeout)[0])
+
+class BufferCopier:
+    """使用预分配缓冲区的单向拷贝器，每次转发不再分配新的 bytes 对象"""
+
+    name = 'buffer'
+
+    def __init__(self, buffer_size=65536):
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+
+    def transfer(self, source, destination):
+        """从 source 读取一次并完整写入 destination，返回字节数，0 表示 EOF，None 表示暂无数据"""
+        try:
+            n = source.recv_into(self.buffer)
+        except BlockingIOError:
+            return None
+        if n:
+            destination.sendall(self.view[:n])
+        return n
+
+    def close(self):
+        self.view.release()
+
+class SpliceCopier:
+    """通过内核管道在两个 socket 之间转发数据，负载不经过用户态"""
+
+    name = 'splice'
+
+    def __init__(self, buffer_size=65536):
+        self.chunk_size = buffer_size
+        self.pipe_r, self.pipe_w = os.pipe()
+        # 尽量让管道容量与单次搬运大小一致，避免写入管道时阻塞
+        if fcntl is not None and hasattr(fcntl, 'F_SETPIPE_SZ'):
+            try:
+                fcntl.fcntl(self.pipe_w, fcntl.F_SETPIPE_SZ, buffer_size)
+            except OSError:
+                pass
+
+    def transfer(self, source, destination):
+        """从 source 搬运一次数据到 destination，返回字节数，0 表示 EOF，None 表示暂无数据"""
+        try:
+            n = os.splice(source.fileno(), self.pipe_w, self.chunk_size, flags=os.SPLICE_F_MOVE)
+        except BlockingIOError:
+            return None
+        remaining = n
+        while remaining:
+            try:
+                remaining -= os.splice(self.pipe_r, destination.fileno(), remaining, flags=os.SPLICE_F_MOVE)
+            except BlockingIOError:
+                # 目标 socket 处于非阻塞模式且发送缓冲区已满，等待可写
+                wait_ready(destination, writable=True)
+        return n
+
+    def close(self):
+        for fd in (self.pipe_r, self.pipe_w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+def create_copier(backend='auto', buffer_size=65536):
+    """根据配置创建转发拷贝器: auto 优先 splice, splice 强制使用, buffer 使用 recv_into"""
+    if backend in ('auto', 'splice') and SPLICE_AVAILABLE:
+        try:
+            return SpliceCopier(buffer_size)
+        except OSError:
+            if backend == 'splice':
+                raise
+    elif backend == 'splice':
+        raise RuntimeError("当前平台不支持 os.splice")
+    return BufferCopier(buffer_size)
@@ -0,0 +1,475 @@
+"""
+普通 HTTP 正向代理
+处理绝对 URI 形式的 HTTP/1.1 请求（GET http://example.com/ HTTP/1.1）:
+- 客户端连接保持 keep-alive，可连续发送多个请求
+- 到源站的连接按 host:port 放入空闲池复用，重复请求同一源站时省去 TCP 握手
+- 请求体和响应体（Content-Length / chunked / 读到连接关闭）按块流式转发，不整体缓存
+"""
+import socket
+import threading
+import time
+import logging
+from collections import deque
+from urllib.parse import urlsplit
+from upstream_pool import UpstreamPool
+
+logger = logging.getLogger(__name__)
+
+# 逐跳首部，不转发给下一跳（Transfer-Encoding 保留，消息体按原样转发）
+HOP_BY_HOP_HEADERS = {
+    'connection', 'keep-alive', 'proxy-connection', 'proxy-authenticate',
+    'proxy-authorization', 'te', 'trailer', 'upgrade'
+}
+# 幂等方法，复用的源站连接失效时可以自动重试（RFC 9110 9.2.2）
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'TRACE', 'PUT', 'DELETE'}
+MAX_HEAD_SIZE = 65536
+MAX_LINE_SIZE = 8192
+
+class HTTPError(Exception):
+    """请求无法处理，status 为返回给客户端的状态行"""
+
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+class SocketReader:
+    """带缓冲的 socket 读取器，可先放入已读取的数据"""
+
+    def __init__(self, sock, initial=b'', buffer_size=65536):
+        self.sock = sock
+        self.buffer = bytearray(initial)
+        self.buffer_size = buffer_size
+
+    def fill(self):
+        """读取更多数据，连接关闭时返回 False"""
+        data = self.sock.recv(self.buffer_size)
+        if not data:
+            return False
+        self.buffer += data
+        return True
+
+    def read_until(self, delimiter, max_size):
+        """读取到分隔符为止（含分隔符），连接在读到任何数据前关闭时返回 None"""
+        start = 0
+        while True:
+            index = self.buffer.find(delimiter, start)
+            if index >= 0:
+                end = index + len(delimiter)
+                data = bytes(self.buffer[:end])
+                del self.buffer[:end]
+                return data
+            if len(self.buffer) > max_size:
+                raise HTTPError("431 Request Header Fields Too Large")
+            start = max(0, len(self.buffer) - len(delimiter) + 1)
+            if not self.fill():
+                if self.buffer:
+                    raise ConnectionError("连接在消息头结束前关闭")
+                return None
+
+    def read_some(self, limit):
+        """读取至多 limit 字节，连接关闭时返回 b''"""
+        if not self.buffer and not self.fill():
+            return b''
+        data = bytes(self.buffer[:limit])
+        del self.buffer[:limit]
+        return data
+
+def parse_head(head):
+    """解析消息头，返回 (起始行三段, [(name, value)])"""
+    lines = head.decode('latin-1').split('\r\n')
+    start_line = lines[0].split(' ', 2)
+    headers = []
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise HTTPError("400 Bad Request")
+        headers.append((name.strip(), value.strip()))
+    return start_line, headers
+
+def header_value(headers, name):
+    """获取首部值（不区分大小写），不存在时返回 None"""
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+def connection_tokens(headers):
+    """Connection 与 Proxy-Connection 首部中的选项集合（小写）"""
+    tokens = set()
+    for key, value in headers:
+        if key.lower() in ('connection', 'proxy-connection'):
+            tokens.update(token.strip().lower() for token in value.split(','))
+    return tokens
+
+def header_values(headers, name):
+    """同名首部（不区分大小写）的全部值，按逗号拆分后返回列表"""
+    name = name.lower()
+    values = []
+    for key, value in headers:
+        if key.lower() == name:
+            values.extend(item.strip() for item in value.split(','))
+    return values
+
+def body_framing(headers, request=True):
+    """根据首部判断消息体长度: 'chunked'、字节数或 None（读到连接关闭为止）
+
+    按 RFC 9112 6.3 严格校验，消息长度有歧义时抛出 HTTPError，避免与下一跳对消息边界理解不一致
+    （请求走私）: 请求同时带 Transfer-Encoding 和 Content-Length、chunked 不是最后一个传输编码，
+    或有多个不同的 Content-Length 值；响应中 Transfer-Encoding 优先于 Content-Length
+    """
+    codings = [coding.lower() for coding in header_values(headers, 'Transfer-Encoding')]
+    lengths = set(header_values(headers, 'Content-Length'))
+    if codings:
+        if request and lengths:
+            raise HTTPError("400 Bad Request")
+        if codings[-1] == 'chunked':
+            return 'chunked'
+        if request:
+            raise HTTPError("400 Bad Request")
+        return None
+    if not lengths:
+        return None
+    length = lengths.pop()
+    # int() 还接受 "+4"、"4_0" 等形式，这里只允许十进制数字
+    if lengths or not (length.isascii() and length.isdigit()):
+        raise HTTPError("400 Bad Request")
+    return int(length)
+
+def build_head(start_line, headers):
+    """组装消息头"""
+    lines = [' '.join(start_line)] + [f"{name}: {value}" for name, value in headers]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+def copy_exact(reader, sock, length, counter):
+    """转发恰好 length 字节"""
+    while length > 0:
+        data = reader.read_some(min(length, reader.buffer_size))
+        if not data:
+            raise ConnectionError("消息体未传输完整，连接已关闭")
+        sock.sendall(data)
+        length -= len(data)
+        counter.inc(len(data))
+
+def copy_chunked(reader, sock, counter):
+    """原样转发 chunked 消息体（含 trailer）"""
+    while True:
+        line = reader.read_until(b'\r\n', MAX_LINE_SIZE)
+        if line is None:
+            raise ConnectionError("chunked 消息体未传输完整，连接已关闭")
+        sock.sendall(line)
+        counter.inc(len(line))
+        try:
+            size = int(line.split(b';', 1)[0].strip(), 16)
+        except ValueError:
+            raise ConnectionError(f"无效的 chunk 长度: {line[:32]!r}")
+        if size == 0:
+            break
+        copy_exact(reader, sock, size + 2, counter)
+    while True:
+        line = reader.read_until(b'\r\n', MAX_LINE_SIZE)
+        if line is None:
+            raise ConnectionError("chunked trailer 未传输完整，连接已关闭")
+        sock.sendall(line)
+        counter.inc(len(line))
+        if line == b'\r\n':
+            return
+
+def copy_until_close(reader, sock, counter):
+    """转发数据直到对端关闭连接"""
+    while True:
+        data = reader.read_some(reader.buffer_size)
+        if not data:
+            return
+        sock.sendall(data)
+        counter.inc(len(data))
+
+def copy_body(reader, sock, framing, counter):
+    """按 body_framing 的结果转发消息体"""
+    if framing == 'chunked':
+        copy_chunked(reader, sock, counter)
+    elif framing is not None:
+        copy_exact(reader, sock, framing, counter)
+
+class OriginPool:
+    """按 host:port 保存可复用的源站空闲连接"""
+
+    def __init__(self, max_per_origin=8, idle_timeout=60):
+        self.max_per_origin = max_per_origin
+        self.idle_timeout = idle_timeout
+        self.idle = {}  # "host:port" -> deque[(socket, released_at)]
+        self.lock = threading.Lock()
+        self.last_prune = time.monotonic()
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def acquire(self, origin):
+        """取出一个到 origin 的可用空闲连接，没有时返回 None"""
+        while True:
+            with self.lock:
+                connections = self.idle.get(origin)
+                if not connections:
+                    self.stats['misses'] += 1
+                    return None
+                sock, released_at = connections.pop()
+            if time.monotonic() - released_at < self.idle_timeout and UpstreamPool.is_alive(sock):
+                sock.setblocking(True)
+                with self.lock:
+                    self.stats['hits'] += 1
+                return sock
+            sock.close()
+
+    def release(self, origin, sock):
+        """归还连接，超出单源站上限时关闭"""
+        now = time.monotonic()
+        with self.lock:
+            connections = self.idle.setdefault(origin, deque())
+            if len(connections) < self.max_per_origin:
+                connections.append((sock, now))
+                sock = None
+            expired = self.prune(now) if now - self.last_prune > self.idle_timeout else []
+        for stale in expired + ([sock] if sock else []):
+            stale.close()
+
+    def prune(self, now):
+        """移除所有源站的过期连接并返回它们，调用方需持有锁"""
+        self.last_prune = now
+        expired = []
+        for origin in list(self.idle):
+            connections = self.idle[origin]
+            while connections and now - connections[0][1] >= self.idle_timeout:
+                expired.append(connections.popleft()[0])
+            if not connections:
+                del self.idle[origin]
+        return expired
+
+    def get_stats(self):
+        """获取连接池统计信息"""
+        with self.lock:
+            return {
+                'origin_pool_idle': sum(len(c) for c in self.idle.values()),
+                'origin_pool_hits': self.stats['hits'],
+                'origin_pool_misses': self.stats['misses']
+            }
+
+class HTTPForwarder:
+    """在一个客户端连接上循环处理普通 HTTP 代理请求
+
+    到源站的连接通过 proxy.connect_to_target 建立，复用路由缓存、DNS 缓存和上游代理回退
+    """
+
+    def __init__(self, proxy, max_per_origin=8, idle_timeout=60, keepalive_timeout=60, origin_timeout=60):
+        self.proxy = proxy
+        self.origin_pool = OriginPool(max_per_origin, idle_timeout)
+        self.keepalive_timeout = keepalive_timeout  # 客户端两次请求之间的最长空闲时间（秒）
+        self.origin_timeout = origin_timeout  # 等待源站数据的超时（秒）
+        self.requests = proxy.metrics.counter('http_requests_total', '普通 HTTP 代理请求数')
+
+    def parse_request(self, head):
+        """解析请求头，返回 (method, host, port, 转发给源站的消息头, 请求消息体长度, 请求首部)"""
+        start_line, headers = parse_head(head)
+        if len(start_line) != 3 or not start_line[2].startswith('HTTP/1.'):
+            raise HTTPError("400 Bad Request")
+        method, target, version = start_line
+        url = urlsplit(target)
+        if url.scheme.lower() != 'http' or not url.hostname:
+            raise HTTPError("400 Bad Request")
+        try:
+            port = url.port or 80
+        except ValueError:
+            raise HTTPError("400 Bad Request")
+        path = url.path or '/'
+        if url.query:
+            path += '?' + url.query
+
+        framing = body_framing(headers)
+        # Host 始终取自请求 URI（RFC 9112 3.2.2），不转发客户端自带的 Host
+        dropped = HOP_BY_HOP_HEADERS | connection_tokens(headers) | {'host'}
+        if framing == 'chunked':
+            dropped.add('content-length')
+        forwarded = [('Host', url.netloc.rsplit('@', 1)[-1])]
+        forwarded.extend((name, value) for name, value in headers if name.lower() not in dropped)
+        forwarded.append(('Connection', 'keep-alive'))
+        return (method, url.hostname, port, build_head([method, path, 'HTTP/1.1'], forwarded), framing,
+                (version, headers))
+
+    def client_keep_alive(self, version, headers):
+        """客户端是否希望保持连接"""
+        tokens = connection_tokens(headers)
+        if version == 'HTTP/1.0':
+            return 'keep-alive' in tokens
+        return 'close' not in tokens
+
+    def open_origin(self, host, port):
+        """从空闲池取出或新建到源站的连接，返回 (socket, 是否复用)"""
+        origin = f"{host}:{port}"
+        sock = self.origin_pool.acquire(origin)
+        if sock is not None:
+            return sock, True
+        sock = self.proxy.connect_to_target(host, port)
+        if not sock:
+            raise HTTPError("502 Bad Gateway")
+        return sock, False
+
+    def read_response_head(self, origin_reader):
+        """读取源站响应头，返回 (head, 起始行, 首部)"""
+        head = origin_reader.read_until(b'\r\n\r\n', MAX_HEAD_SIZE)
+        if head is None:
+            raise ConnectionResetError("源站在响应前关闭连接")
+        try:
+            start_line, headers = parse_head(head)
+        except HTTPError:
+            raise ConnectionError(f"无效的源站响应: {head[:64]!r}")
+        if len(start_line) < 2 or not start_line[0].startswith('HTTP/'):
+            raise ConnectionError(f"无效的源站响应: {head[:64]!r}")
+        return head, start_line, headers
+
+    def send_request(self, host, port, method, head, request_framing):
+        """发送请求头并读取响应头（Expect: 100-continue 时先转发临时响应）
+
+        复用的空闲连接在发送或等待响应时失效，且请求没有消息体时，改用新连接重试；
+        非幂等请求只在发送请求头即失败（源站已关闭连接，未收到请求）时重试，
+        否则源站可能已处理过该请求
+        """
+        while True:
+            origin_socket, reused = self.open_origin(host, port)
+            sent = False
+            try:
+                origin_socket.settimeout(self.origin_timeout)
+                origin_socket.sendall(head)
+                sent = True
+                self.proxy.bytes_in.inc(len(head))
+                if request_framing is None or request_framing == 0:
+                    origin_reader = SocketReader(origin_socket, buffer_size=self.proxy.buffer_size)
+                    return origin_socket, origin_reader, self.read_response_head(origin_reader)
+                return origin_socket, SocketReader(origin_socket, buffer_size=self.proxy.buffer_size), None
+            except ConnectionError as e:
+                origin_socket.close()
+                if not reused or (sent and method not in IDEMPOTENT_METHODS):
+                    raise
+                logger.debug(f"复用的源站连接 {host}:{port} 已失效，重新连接: {e}")
+            except BaseException:
+                origin_socket.close()
+                raise
+
+    def handle_request(self, client_socket, client_reader, head):
+        """处理一个请求，返回是否可以继续在该客户端连接上处理下一个请求"""
+        method, host, port, origin_head, request_framing, (version, request_headers) = self.parse_request(head)
+        keep_alive = self.client_keep_alive(version, request_headers)
+        expect_continue = (header_value(request_headers, 'Expect') or '').lower() == '100-continue'
+        self.requests.inc()
+        logger.debug("HTTP请求: %s %s:%s", method, host, port)
+        record = self.proxy.new_access_record(client_socket, f"{host}:{port}")
+        if record:
+            record.update(route='http', method=method, bytes_in=None, bytes_out=None)
+        try:
+            return self.forward_request(client_socket, client_reader, method, host, port, origin_head,
+                                        request_framing, keep_alive, version, expect_continue, record)
+        except HTTPError as e:
+            if record:
+                record['status'] = int(e.status.split()[0])
+            raise
+        finally:
+            self.proxy.finish_access_record(record)
+
+    def forward_request(self, client_socket, client_reader, method, host, port, origin_head,
+                        request_framing, keep_alive, version, expect_continue, record):
+        """将请求转发到源站并把响应写回客户端，record 为访问记录（未采样时为 None）"""
+        try:
+            origin_socket, origin_reader, response = self.send_request(
+                host, port, method, origin_head, request_framing)
+        except socket.timeout:
+            raise HTTPError("504 Gateway Timeout")
+        except OSError as e:
+            logger.warning(f"请求源站 {host}:{port} 失败: {e}")
+            raise HTTPError("502 Bad Gateway")
+        origin_reusable = False
+        try:
+            if response is None:
+                if expect_continue:
+                    # 先等待源站的临时响应，源站直接给出最终响应时不再发送请求体
+                    response = self.read_response_head(origin_reader)
+                    if response[1][1] == '100':
+                        client_socket.sendall(response[0])
+                        response = None
+                    else:
+                        keep_alive = False
+                if response is None:
+                    copy_body(client_reader, origin_socket, request_framing, self.proxy.bytes_in)
+                    response = self.read_response_head(origin_reader)
+
+            response_head, start_line, response_headers = response
+            # 跳过其余 1xx 临时响应
+            while start_line[1].startswith('1') and start_line[1] != '101':
+                client_socket.sendall(response_head)
+                response_head, start_line, response_headers = self.read_response_head(origin_reader)
+
+            status = start_line[1]
+            if record:
+                record['status'] = int(status) if status.isdigit() else None
+                record['setup_ms'] = round((time.monotonic() - record['started']) * 1000, 1)
+            if method == 'HEAD' or status in ('204', '304') or status.startswith('1'):
+                response_framing = 0
+            else:
+                try:
+                    response_framing = body_framing(response_headers, request=False)
+                except HTTPError:
+                    # 源站的响应无效，不是客户端请求的问题
+                    logger.warning(f"源站 {host}:{port} 返回无效的 Content-Length")
+                    raise HTTPError("502 Bad Gateway")
+            origin_reusable = (start_line[0] == 'HTTP/1.1' and response_framing is not None
+                               and 'close' not in connection_tokens(response_headers))
+            if response_framing is None:
+                keep_alive = False  # 消息体以连接关闭为结束，客户端连接也需关闭
+
+            dropped = HOP_BY_HOP_HEADERS | connection_tokens(response_headers)
+            if header_values(response_headers, 'Transfer-Encoding'):
+                dropped.add('content-length')  # 长度以 Transfer-Encoding 为准
+            headers = [(name, value) for name, value in response_headers if name.lower() not in dropped]
+            headers.append(('Connection', 'keep-alive' if keep_alive else 'close'))
+            if version == 'HTTP/1.0' and keep_alive:
+                headers.append(('Proxy-Connection', 'keep-alive'))
+            client_head = build_head(start_line, headers)
+            client_socket.sendall(client_head)
+            self.proxy.bytes_out.inc(len(client_head))
+
+            if response_framing is None:
+                copy_until_close(origin_reader, client_socket, self.proxy.bytes_out)
+            else:
+                copy_body(origin_reader, client_socket, response_framing, self.proxy.bytes_out)
+        except BaseException:
+            origin_reusable = False
+            raise
+        finally:
+            if origin_reusable and not origin_reader.buffer:
+                self.origin_pool.release(f"{host}:{port}", origin_socket)
+            else:
+                origin_socket.close()
+        return keep_alive
+
+    def handle(self, client_socket, initial_data=b''):
+        """处理客户端连接上的全部请求，initial_data 为已读取的数据"""
+        client_reader = SocketReader(client_socket, initial_data, self.proxy.buffer_size)
+        try:
+            while True:
+                client_socket.settimeout(self.keepalive_timeout)
+                head = client_reader.read_until(b'\r\n\r\n', MAX_HEAD_SIZE)
+                if head is None:
+                    return
+                client_socket.settimeout(self.origin_timeout)
+                if not self.handle_request(client_socket, client_reader, head):
+                    return
+        except HTTPError as e:
+            logger.warning(f"HTTP请求无法处理: {e.status}")
+            self.proxy.send_error_response(client_socket, e.status)
+        except socket.timeout:
+            logger.debug("HTTP连接空闲超时")
+        except (ConnectionError, OSError) as e:
+            logger.debug(f"HTTP连接结束: {e}")
+
+    def get_stats(self):
+        """获取普通 HTTP 代理统计信息"""
+        stats = {'http_requests': self.requests.value}
+        stats.update(self.origin_pool.get_stats())
+        return stats
@@ -0,0 +1,132 @@
+"""
+优雅退出与平滑重启
+- SIGTERM: 停止 accept，等待已有连接结束（不超过 drain_timeout 秒）后退出，
+  排空期间再次收到 SIGTERM 时立即退出
+- SIGHUP: 保存代理池状态，以相同命令行启动新进程。单进程模式下新进程通过继承的
+  文件描述符直接使用同一个监听 socket；多进程模式下新进程的 worker 以 SO_REUSEPORT
+  绑定同一端口。新进程开始 accept 后本进程才停止 accept 并按 SIGTERM 流程退出，
+  期间始终有进程在监听。新进程从状态文件恢复代理池，无需重新验证即可服务
+"""
+import logging
+import os
+import select
+import signal
+import subprocess
+import sys
+import threading
+
+logger = logging.getLogger(__name__)
+
+# 新进程从环境变量中获取继承的监听 socket 和就绪通知管道
+LISTEN_FD_ENV = 'TUNNEL_PROXY_LISTEN_FD'
+READY_FD_ENV = 'TUNNEL_PROXY_READY_FD'
+READY_TIMEOUT = 120  # 等待新进程就绪的最长时间（秒），冷启动时需要先验证代理池
+
+STOP_TERMINATE = 'terminate'
+STOP_RESTART = 'restart'
+
+def take_inherited_fd(name):
+    """取出父进程传下来的文件描述符，并从环境变量中删除，避免再传给 worker"""
+    value = os.environ.pop(name, None)
+    return int(value) if value else None
+
+def notify_ready(fd):
+    """通知启动本进程的旧进程: 已开始 accept"""
+    if fd is None:
+        return
+    try:
+        os.write(fd, b'1')
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def spawn_successor(listen_socket=None):
+    """以相同命令行启动新进程，返回 (进程, 就绪通知管道的读端)"""
+    read_fd, write_fd = os.pipe()
+    env = dict(os.environ)
+    env[READY_FD_ENV] = str(write_fd)
+    pass_fds = [write_fd]
+    if listen_socket is not None:
+        env[LISTEN_FD_ENV] = str(listen_socket.fileno())
+        pass_fds.append(listen_socket.fileno())
+    try:
+        process = subprocess.Popen([sys.executable] + sys.argv, env=env, pass_fds=pass_fds)
+    except OSError:
+        os.close(read_fd)
+        raise
+    finally:
+        os.close(write_fd)
+    return process, read_fd
+
+def wait_successor(process, read_fd, timeout=READY_TIMEOUT):
+    """等待新进程就绪；新进程提前退出或超时时终止它并返回 False"""
+    poller = select.poll()
+    poller.register(read_fd, select.POLLIN)
+    try:
+        ready = bool(poller.poll(timeout * 1000)) and os.read(read_fd, 1) == b'1'
+    finally:
+        os.close(read_fd)
+    if not ready and process.poll() is None:
+        process.terminate()
+    return ready
+
+def hand_over(proxy_manager, listen_socket=None, timeout=READY_TIMEOUT):
+    """平滑重启: 保存代理池状态并启动新进程，新进程就绪后返回 True"""
+    proxy_manager.save_state_file()
+    try:
+        process, read_fd = spawn_successor(listen_socket)
+    except OSError as e:
+        logger.error(f"启动新进程失败: {e}")
+        return False
+    logger.info(f"♻️  已启动新进程 (PID: {process.pid})，等待其就绪...")
+    if wait_successor(process, read_fd, timeout):
+        logger.info(f"新进程 (PID: {process.pid}) 已就绪，本进程停止接受新连接")
+        return True
+    logger.error(f"新进程 (PID: {process.pid}) 未能就绪，继续由本进程提供服务")
+    return False
+
+class GracefulShutdown:
+    """SIGTERM/SIGHUP 处理
+
+    on_terminate 在收到 SIGTERM 时调用（信号处理上下文中，只应设置标志或唤醒主循环，不应抛出异常）；restart 为 SIGHUP 时在后台线程中
+    执行的交接函数，返回 True 表示新进程已就绪，随后向本进程发送 SIGTERM 进入退出流程。
+    restart 为 None 时忽略 SIGHUP（多进程模式下的 worker 由 supervisor 统一处理）
+    """
+
+    def __init__(self, on_terminate, restart=None):
+        self.on_terminate = on_terminate
+        self.restart = restart
+        self.reason = None
+        self.restart_thread = None
+
+    def install(self, loop=None):
+        """安装信号处理函数，只能在主线程中调用，否则返回 False；loop 不为 None 时注册到事件循环"""
+        if threading.current_thread() is not threading.main_thread():
+            return False
+        if loop is not None:
+            loop.add_signal_handler(signal.SIGTERM, self.handle_terminate)
+            if self.restart:
+                loop.add_signal_handler(signal.SIGHUP, self.handle_hangup)
+            else:
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            return True
+        signal.signal(signal.SIGTERM, self.handle_terminate)
+        signal.signal(signal.SIGHUP, self.handle_hangup if self.restart else signal.SIG_IGN)
+        return True
+
+    def handle_terminate(self, signum=None, frame=None):
+        if self.reason is None:
+            self.reason = STOP_TERMINATE
+        self.on_terminate()
+
+    def handle_hangup(self, signum=None, frame=None):
+        if self.reason is not None or (self.restart_thread and self.restart_thread.is_alive()):
+            return
+        self.restart_thread = threading.Thread(target=self.run_restart, daemon=True, name='restart')
+        self.restart_thread.start()
+
+    def run_restart(self):
+        if self.restart():
+            self.reason = STOP_RESTART
+            os.kill(os.getpid(), signal.SIGTERM)
@@ -0,0 +1,293 @@
+"""
+运行指标与内嵌 HTTP 指标服务
+提供线程安全的计数器、仪表和直方图，以 Prometheus 文本格式和 JSON 对外暴露
+"""
+import bisect
+import json
+import socket
+import threading
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+from profiling import ProfilerBusy
+
+logger = logging.getLogger(__name__)
+
+# 连接建立耗时直方图的默认分桶（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 30)
+
+class Counter:
+    """单调递增计数器"""
+
+    type = 'counter'
+
+    def __init__(self, name, help_text, labels):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def collect(self):
+        return {'value': self.value}
+
+class Gauge(Counter):
+    """可增可减的仪表"""
+
+    type = 'gauge'
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+class Histogram:
+    """累积分桶直方图"""
+
+    type = 'histogram'
+
+    def __init__(self, name, help_text, labels, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # 最后一个为 +Inf
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def collect(self):
+        with self.lock:
+            return {'buckets': list(self.buckets), 'counts': list(self.counts), 'sum': self.sum}
+
+class MetricsRegistry:
+    """指标注册表，同名同标签的指标只创建一次"""
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, cls, name, help_text, labels, **kwargs):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.metrics:
+                self.metrics[key] = cls(name, help_text, labels, **kwargs)
+            return self.metrics[key]
+
+    def counter(self, name, help_text, **labels):
+        return self.register(Counter, name, help_text, labels)
+
+    def gauge(self, name, help_text, **labels):
+        return self.register(Gauge, name, help_text, labels)
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS, **labels):
+        return self.register(Histogram, name, help_text, labels, buckets=buckets)
+
+    def collect(self):
+        """导出所有指标为可序列化的条目列表"""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        entries = []
+        for metric in metrics:
+            entry = {'name': metric.name, 'type': metric.type, 'help': metric.help, 'labels': metric.labels}
+            entry.update(metric.collect())
+            entries.append(entry)
+        return entries
+
+def stats_entries(stats, counter_keys=(), prefix='tunnel_'):
+    """将统计字典转换为指标条目，counter_keys 中的项视为计数器，其余为仪表"""
+    return [
+        {
+            'name': f"{prefix}{key}",
+            'type': 'counter' if key in counter_keys else 'gauge',
+            'help': key,
+            'labels': {},
+            'value': value
+        }
+        for key, value in stats.items()
+        if isinstance(value, (int, float))
+    ]
+
+def proxy_manager_entries(proxy_manager):
+    """生成代理池汇总及每个代理健康状况的指标条目"""
+    entries = [
+        {'name': f"proxy_pool_{key}", 'type': 'counter' if key.startswith('probe_') else 'gauge',
+         'help': key, 'labels': {}, 'value': value}
+        for key, value in proxy_manager.get_proxy_stats().items()
+    ]
+    fields = (
+        ('available', 'proxy_available', '代理是否在可用列表中'),
+        ('failures', 'proxy_failures', '代理连续失败次数'),
+        ('latency', 'proxy_latency_seconds', '代理连接延迟 EWMA'),
+        ('success_rate', 'proxy_success_rate', '代理成功率 EWMA'),
+        ('quarantined', 'proxy_quarantined', '代理是否处于隔离中'),
+        ('strikes', 'proxy_quarantine_strikes', '代理近期被隔离的次数'),
+        ('retest_in', 'proxy_quarantine_retest_seconds', '距下次复测的秒数'),
+    )
+    for health in proxy_manager.get_proxy_health():
+        labels = {'proxy': health['proxy']}
+        for field, name, help_text in fields:
+            if health[field] is not None:
+                entries.append({'name': name, 'type': 'gauge', 'help': help_text,
+                                'labels': labels, 'value': float(health[field])})
+    return entries
+
+def merge_entries(entry_lists):
+    """合并多个进程的指标条目，同名同标签的值相加"""
+    merged = {}
+    for entries in entry_lists:
+        for entry in entries:
+            key = (entry['name'], tuple(sorted(entry['labels'].items())))
+            current = merged.get(key)
+            if current is None:
+                merged[key] = json.loads(json.dumps(entry))
+            elif entry['type'] == 'histogram':
+                current['counts'] = [a + b for a, b in zip(current['counts'], entry['counts'])]
+                current['sum'] += entry['sum']
+            else:
+                current['value'] += entry['value']
+    return list(merged.values())
+
+def format_labels(labels, extra=None):
+    """格式化 Prometheus 标签"""
+    items = list(labels.items()) + list((extra or {}).items())
+    if not items:
+        return ''
+    escaped = (
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in items
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+def render_prometheus(entries):
+    """将指标条目渲染为 Prometheus 文本格式"""
+    lines = []
+    described = set()
+    for entry in sorted(entries, key=lambda e: e['name']):
+        name = entry['name']
+        if name not in described:
+            lines.append(f"# HELP {name} {entry['help']}")
+            lines.append(f"# TYPE {name} {entry['type']}")
+            described.add(name)
+        labels = entry['labels']
+        if entry['type'] == 'histogram':
+            cumulative = 0
+            for bound, count in zip(entry['buckets'], entry['counts']):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels(labels, {'le': bound})} {cumulative}")
+            cumulative += entry['counts'][-1]
+            lines.append(f"{name}_bucket{format_labels(labels, {'le': '+Inf'})} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {entry['sum']}")
+            lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+        else:
+            lines.append(f"{name}{format_labels(labels)} {entry['value']}")
+    return '\n'.join(lines) + '\n'
+
+def histogram_summary(entries):
+    """从指标条目中提取直方图的 JSON 摘要"""
+    summary = {}
+    for entry in entries:
+        if entry['type'] != 'histogram':
+            continue
+        key = entry['name'] + format_labels(entry['labels'])
+        total = sum(entry['counts'])
+        summary[key] = {
+            'count': total,
+            'sum': entry['sum'],
+            'buckets': dict(zip([str(b) for b in entry['buckets']] + ['+Inf'], entry['counts']))
+        }
+    return summary
+
+class ReusePortHTTPServer(ThreadingHTTPServer):
+    """以 SO_REUSEPORT 绑定，平滑重启期间新旧进程可以同时监听指标端口"""
+
+    def server_bind(self):
+        if hasattr(socket, 'SO_REUSEPORT'):
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+class MetricsServer:
+    """内嵌指标 HTTP 服务
+
+    /metrics 返回 Prometheus 文本格式，/ 和 /metrics.json 返回 JSON。
+    source 需提供 collect_metrics() 返回指标条目列表，以及 metrics_json() 返回 JSON 对象。
+    profiling 不为 None 时提供调试接口: /debug/stacks 返回所有线程栈，
+    /debug/profile?seconds=N 采样分析 N 秒后返回结果
+    """
+
+    def __init__(self, source, host='0.0.0.0', port=8081, profiling=None):
+        self.source = source
+        self.host = host
+        self.port = port
+        self.profiling = profiling
+        self.server = None
+
+    def make_handler(self):
+        source = self.source
+        profiling = self.profiling
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path, _, query = self.path.partition('?')
+                try:
+                    if path == '/metrics':
+                        body = render_prometheus(source.collect_metrics()).encode()
+                        content_type = 'text/plain; version=0.0.4; charset=utf-8'
+                    elif path in ('/', '/metrics.json'):
+                        body = json.dumps(source.metrics_json(), ensure_ascii=False, indent=2).encode()
+                        content_type = 'application/json; charset=utf-8'
+                    elif profiling and path == '/debug/stacks':
+                        body = profiling.dump_stacks().encode()
+                        content_type = 'text/plain; charset=utf-8'
+                    elif profiling and path == '/debug/profile':
+                        seconds = parse_qs(query).get('seconds', [None])[0]
+                        body = profiling.profile(float(seconds) if seconds else None).encode()
+                        content_type = 'text/plain; charset=utf-8'
+                    else:
+                        self.send_error(404)
+                        return
+                except ProfilerBusy:
+                    self.send_error(409, 'Profile already running', explain='已有采样分析在进行中')
+                    return
+                except ValueError:
+                    self.send_error(400)
+                    return
+                except Exception as e:
+                    logger.error(f"生成指标失败: {e}")
+                    self.send_error(500)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(f"指标请求 {self.address_string()} - {format % args}")
+
+        return Handler
+
+    def start(self):
+        """在后台线程中启动指标服务"""
+        self.server = ReusePortHTTPServer((self.host, self.port), self.make_handler())
+        self.server.daemon_threads = True
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        logger.info(f"📊 指标服务: http://{self.host}:{self.port}/metrics")
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
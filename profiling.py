@@ -0,0 +1,146 @@
+"""
+运行中进程的按需诊断
+- 线程栈: 输出所有线程当前的调用栈
+- 采样分析: 在限定时间内由后台线程按固定间隔采集所有线程的调用栈，统计各函数出现的次数。
+  cProfile 只能分析开启它的线程，而代理的工作分散在大量连接线程和事件循环中，因此采用采样方式。
+  结果为挂钟时间（含等待 I/O 的时间），同时输出可供 flamegraph.pl 使用的折叠栈
+- 触发方式: SIGUSR1 将线程栈写入日志，SIGUSR2 采样 duration 秒后写入 output_dir 下的文件；
+  启用调试接口时也可通过指标服务的 /debug/stacks 和 /debug/profile?seconds=N 获取
+- 只有触发时才产生开销，平时不做任何采集
+"""
+import collections
+import logging
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 0.005  # 采样间隔（秒）
+MAX_DURATION = 60  # 单次采样的最长时间（秒）
+TOP_FUNCTIONS = 30
+
+class ProfilerBusy(Exception):
+    """已有采样在进行中"""
+
+def format_thread_stacks():
+    """所有线程当前的调用栈"""
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    frames = sys._current_frames()
+    lines = [f"# PID {os.getpid()}, {len(frames)} 个线程, {time.strftime('%Y-%m-%d %H:%M:%S')}\n"]
+    for ident, frame in frames.items():
+        lines.append(f"\n线程 {names.get(ident, '?')} ({ident}):\n")
+        lines.extend(traceback.format_stack(frame))
+    return ''.join(lines)
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def sample_stacks(duration, interval=DEFAULT_INTERVAL):
+    """采样 duration 秒，返回 (折叠栈 -> 次数, 采样轮数)"""
+    stacks = collections.Counter()
+    rounds = 0
+    me = threading.get_ident()
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(frame_label(frame))
+                frame = frame.f_back
+            labels.reverse()
+            stacks[';'.join(labels)] += 1
+        rounds += 1
+        time.sleep(interval)
+    return stacks, rounds
+
+def format_profile(stacks, rounds, duration):
+    """采样结果: 按自身和累计出现次数排序的函数，以及折叠栈"""
+    total = sum(stacks.values()) or 1
+    own = collections.Counter()
+    cumulative = collections.Counter()
+    for stack, count in stacks.items():
+        labels = stack.split(';')
+        own[labels[-1]] += count
+        for label in set(labels):
+            cumulative[label] += count
+    lines = [f"# PID {os.getpid()}, 采样 {duration} 秒, {rounds} 轮, {total} 个线程栈样本\n"]
+    for title, counter in (("自身", own), ("累计", cumulative)):
+        lines.append(f"\n## 按{title}样本数排序\n")
+        for label, count in counter.most_common(TOP_FUNCTIONS):
+            lines.append(f"{count:>8} {count * 100 / total:6.2f}%  {label}\n")
+    lines.append("\n## 折叠栈\n")
+    for stack, count in stacks.most_common():
+        lines.append(f"{stack} {count}\n")
+    return ''.join(lines)
+
+class ProfilingHooks:
+    """线程栈和采样分析的触发入口，同一时间只进行一次采样"""
+
+    def __init__(self, output_dir=None, duration=10, interval=DEFAULT_INTERVAL):
+        self.output_dir = output_dir or tempfile.gettempdir()
+        self.duration = duration  # SIGUSR2 触发的采样时间（秒）
+        self.interval = interval
+        self.lock = threading.Lock()
+
+    def dump_stacks(self):
+        return format_thread_stacks()
+
+    def profile(self, duration=None):
+        """采样分析并返回报告文本，已有采样进行中时抛出 ProfilerBusy"""
+        duration = min(max(duration or self.duration, 0.1), MAX_DURATION)
+        if not self.lock.acquire(blocking=False):
+            raise ProfilerBusy()
+        try:
+            stacks, rounds = sample_stacks(duration, self.interval)
+        finally:
+            self.lock.release()
+        return format_profile(stacks, rounds, duration)
+
+    def log_stacks(self):
+        logger.info(f"线程栈:\n{self.dump_stacks()}")
+
+    def profile_to_file(self):
+        """采样分析并写入文件"""
+        logger.info(f"开始采样分析 ({self.duration} 秒)...")
+        try:
+            report = self.profile()
+        except ProfilerBusy:
+            logger.warning("已有采样分析在进行中")
+            return
+        path = os.path.join(self.output_dir, f"profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.txt")
+        try:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(report)
+        except OSError as e:
+            logger.error(f"写入采样分析结果失败: {e}")
+            return
+        logger.info(f"📈 采样分析结果已写入 {path}")
+
+    def run_in_background(self, target):
+        threading.Thread(target=target, daemon=True, name='profiling').start()
+
+    def handle_signal(self, signum=None, frame=None):
+        # 信号处理函数中只启动线程，避免在被中断的代码持有锁时写日志
+        if signum == signal.SIGUSR2:
+            self.run_in_background(self.profile_to_file)
+        else:
+            self.run_in_background(self.log_stacks)
+
+    def install(self, loop=None):
+        """安装 SIGUSR1/SIGUSR2 处理函数，只能在主线程中调用；loop 不为 None 时注册到事件循环"""
+        if not hasattr(signal, 'SIGUSR1') or threading.current_thread() is not threading.main_thread():
+            return False
+        for signum in (signal.SIGUSR1, signal.SIGUSR2):
+            if loop is not None:
+                loop.add_signal_handler(signum, self.handle_signal, signum)
+            else:
+                signal.signal(signum, self.handle_signal)
+        return True
@@ -1,188 +1,612 @@
 import requests
+import json
+import os
 import threading
 import time
 from datetime import datetime
+import logging
 import random
 import warnings
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+from proxy_probe import ProxyProber
+from quarantine import Quarantine
+from proxy_pool import IndexedSet, PoolSnapshot, OutcomeBuffer
+
+logger = logging.getLogger(__name__)
 warnings.filterwarnings('ignore')
 
+def select_random(proxies, score):
+    """均匀随机选择"""
+    return random.choice(proxies)
+
+def select_weighted(proxies, score):
+    """按 1/代价 加权随机选择"""
+    weights = [1.0 / score(proxy) for proxy in proxies]
+    return random.choices(proxies, weights=weights, k=1)[0]
+
+def select_least_latency(proxies, score):
+    """选择期望代价最低的代理"""
+    return min(proxies, key=score)
+
+def select_p2c(proxies, score):
+    """Power of two choices: 随机取两个，选择代价较低者"""
+    count = len(proxies)
+    if count < 2:
+        return proxies[0]
+    # 直接取两个不同的下标，比 random.sample 少一次集合/列表构造
+    i = random.randrange(count)
+    j = random.randrange(count - 1)
+    if j >= i:
+        j += 1
+    first, second = proxies[i], proxies[j]
+    return first if score(first) <= score(second) else second
+
+# 可插拔的代理选择策略，新策略只需注册到此字典
+SELECTION_STRATEGIES = {
+    'random': select_random,
+    'weighted': select_weighted,
+    'least-latency': select_least_latency,
+    'p2c': select_p2c,
+}
+
+DEFAULT_PROXY_SOURCE = "https://raw.githubusercontent.com/claude89757/free_https_proxies/main/isz_https_proxies.txt"
+
+def parse_proxy_list(text):
+    """解析代理列表文本，每行一个 host:port，忽略空行和 # 注释"""
+    proxies = []
+    for line in text.strip().split('\n'):
+        line = line.strip()
+        if line and not line.startswith('#'):
+            proxies.append(line)
+    return proxies
+
 class ProxyManager:
-    def __init__(self):
-        self.proxy_list_url = "https://raw.githubusercontent.com/claude89757/free_https_proxies/main/isz_https_proxies.txt"
-        self.available_proxies = []
-        self.all_proxies = []
+    def __init__(self, auto_update=True, validate_concurrency=32, validate_deadline=60,
+                 selection_strategy='p2c', state_file=None, proxy_sources=None, probe_options=None,
+                 quarantine_base_delay=30, quarantine_max_delay=3600, relay_outcomes=False):
+        # 代理列表来源: http(s) URL 或本地文件路径（可用 file:// 前缀），多个来源合并去重
+        self.proxy_sources = list(proxy_sources or [DEFAULT_PROXY_SOURCE])
+        self.source_validators = {}  # 来源 -> ETag/Last-Modified 或文件修改时间，用于条件获取
+        self.source_proxies = {}  # 来源 -> 上次获取到的代理列表
+        # 首次更新验证完整列表（包括从状态文件恢复的代理），之后只验证新增代理
+        self.full_validation_pending = True
+        # 尚未完成验证的代理（如超过每轮验证截止时间），下一轮继续验证
+        self.pending_validation = set()
+        # 可用代理按 revalidate_interval 定期重新验证，每轮至多 revalidate_batch 个（最久未验证的优先）
+        self.last_validated = {}  # 代理 -> 最近一次健康检查的时间
+        self.revalidate_interval = 1800
+        self.revalidate_batch = 200
+        self.available_proxies = IndexedSet()
+        self.all_proxies = IndexedSet()
         self.proxy_failures = {}  # 记录代理失败次数
-        self.max_failures = 3  # 连续失败3次后移除代理
+        self.max_failures = 3  # 失败计数达到3次后移除代理（每次成功抵消一次失败）
+        # 被移除或验证失败的代理进入隔离，按指数退避的时间复测，通过后重新启用
+        self.quarantine = Quarantine(quarantine_base_delay, quarantine_max_delay)
+        self.quarantine_wakeup = threading.Event()
         self.lock = threading.Lock()
         self.update_interval = 300  # 5分钟更新一次
-        self.test_batch_size = 10  # 每批测试10个代理
-        self.start_update_thread()
+        self.validate_concurrency = validate_concurrency  # 并发验证的最大线程数
+        self.validate_deadline = validate_deadline  # 每轮验证的总截止时间（秒）
+        if selection_strategy not in SELECTION_STRATEGIES:
+            raise ValueError(f"未知的代理选择策略: {selection_strategy}")
+        self.selection_strategy = selection_strategy
+        # 分级健康检查: TCP -> CONNECT -> 可选完整请求，probe_options 为 ProxyProber 参数
+        self.prober = ProxyProber(**(probe_options or {}))
+        self.proxy_latency = {}  # 代理连接延迟的 EWMA（秒）
+        self.proxy_success_rate = {}  # 代理成功率的 EWMA
+        self.ewma_alpha = 0.3  # EWMA 平滑系数
+        self.default_latency = 1.0  # 尚无延迟数据时的估计值（秒）
+        # 选择代理时读取的不可变快照，代理池或统计变化后在锁内重新发布，读取不加锁
+        self.snapshot = PoolSnapshot()
+        # 连接成功/失败结果由后台线程按批合并，不在每次连接结束时争用锁
+        self.outcomes = OutcomeBuffer()
+        self.outcome_thread = None  # 首次记录结果时启动
+        # 多进程 worker 中为列表: 已合并但尚未上报给 supervisor 的连接结果
+        self.relayed = [] if relay_outcomes else None
+        # 代理池状态持久化文件，重启时加载后立即可用，再在后台重新验证
+        self.state_file = state_file
+        # auto_update=False 时不自行拉取和验证，由外部通过 load_state 同步代理池（多进程 worker）
+        if auto_update:
+            self.start_update_thread(warm=self.load_state_file())
     
-    def fetch_proxies_from_github(self):
-        """从 GitHub 获取代理列表"""
-        try:
-            response = requests.get(self.proxy_list_url, timeout=10)
-            if response.status_code == 200:
-                proxies = []
-                for line in response.text.strip().split('\n'):
-                    line = line.strip()
-                    if line and not line.startswith('#'):
-                        proxies.append(line)
-                print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 从 GitHub 获取到 {len(proxies)} 个代理")
-                return proxies
-        except Exception as e:
-            print(f"获取代理列表失败: {e}")
-        return []
+    def fetch_source(self, source):
+        """从单个来源获取代理列表，返回 (代理列表, 是否变化)
+
+        URL 来源带 If-None-Match/If-Modified-Since 条件请求，本地文件比较修改时间，
+        内容未变化时直接返回上次的结果
+        """
+        validator = self.source_validators.get(source)
+        if source.startswith(('http://', 'https://')):
+            headers = {}
+            if validator and source in self.source_proxies:
+                if validator.get('etag'):
+                    headers['If-None-Match'] = validator['etag']
+                if validator.get('last_modified'):
+                    headers['If-Modified-Since'] = validator['last_modified']
+            response = requests.get(source, headers=headers, timeout=10)
+            if response.status_code == 304 and source in self.source_proxies:
+                return self.source_proxies[source], False
+            response.raise_for_status()
+            text = response.text
+            validator = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified')
+            }
+        else:
+            path = source[len('file://'):] if source.startswith('file://') else source
+            mtime = os.stat(path).st_mtime_ns
+            if validator == mtime and source in self.source_proxies:
+                return self.source_proxies[source], False
+            with open(path, encoding='utf-8') as f:
+                text = f.read()
+            validator = mtime
+        proxies = parse_proxy_list(text)
+        changed = proxies != self.source_proxies.get(source)
+        self.source_validators[source] = validator
+        self.source_proxies[source] = proxies
+        return proxies, changed
+    
+    def fetch_proxies(self):
+        """从所有来源获取并合并代理列表，返回 (代理列表, 是否变化)，全部来源失败时返回 (None, False)"""
+        merged = []
+        changed = False
+        fetched = False
+        for source in self.proxy_sources:
+            try:
+                proxies, source_changed = self.fetch_source(source)
+            except Exception as e:
+                logger.warning(f"获取代理列表失败 ({source}): {e}")
+                # 获取失败时沿用该来源上次的结果
+                proxies = self.source_proxies.get(source)
+                if proxies is None:
+                    continue
+                source_changed = False
+            fetched = True
+            changed = changed or source_changed
+            merged.extend(proxies)
+        if not fetched:
+            return None, False
+        merged = list(dict.fromkeys(merged))
+        status = "有更新" if changed else "未变化"
+        logger.info(f"从 {len(self.proxy_sources)} 个来源获取到 "
+                    f"{len(merged)} 个代理 ({status})")
+        return merged, changed
     
     def check_proxy(self, proxy_url):
-        """使用 requests 检查代理是否可用"""
-        try:
-            target_url = 'https://ftty.ydmap.cn/srv100241/api/pub/sport/venue/getVenueOrderList?salesItemId=100341&curDate=1748188800000&venueGroupId=&t=1748187760876&type__1295=n4%2BxnDR70%3DK7wqWqY5DsD7fmKD54sO2g8S4rTD'
-            
-            headers = {
-                'Host': 'ftty.ydmap.cn',
-                'server-reflexive-ip': '1.1.1.1',
-                'entry-tag': '',
-                'access-token': '',
-                'visitor-id': 'xxxxxx',
-                'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/107.0.0.0 Safari/537.36 NetType/WIFI MicroMessenger/6.8.0(0x16080000) MacWechat/3.8.10(0x13080a10) XWEB/1227 Flue',
-                'accept': 'application/json, text/plain, */*',
-                'timestamp': '1748187760918',
-                'signature': 'xxxxxx',
-                'tab-id': 'ydmap_fb21e370a0f048acfef6a518e9952c02',
-                'x-requested-with': 'XMLHttpRequest',
-                'cross-token': '',
-                'sec-fetch-site': 'same-origin',
-                'sec-fetch-mode': 'cors',
-                'sec-fetch-dest': 'empty',
-                'referer': 'https://ftty.ydmap.cn/booking/schedule/101332?salesItemId=100341',
-                'accept-language': 'zh-CN,zh;q=0.9'
-            }
-            
-            proxies = {
-                'http': f'http://{proxy_url}',
-                'https': f'http://{proxy_url}'
-            }
-            
-            response = requests.get(
-                target_url,
-                headers=headers,
-                proxies=proxies,
-                timeout=3,
-                verify=False
-            )
-            
-            response_text = response.text
-            
-            # 判断返回内容是否包含"签名"，表示代理IP可用
-            if "签名" in response_text or "验证" in response_text:
-                now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                print(f"[{now}] 发现可用代理: {proxy_url}")
-                return True
-                
-        except Exception as e:
-            pass
-        return False
+        """分级检查代理是否可用，返回 (是否可用, CONNECT 握手耗时秒数)"""
+        ok, _, latency = self.prober.probe(proxy_url)
+        if ok:
+            logger.info(f"发现可用代理: {proxy_url}")
+        return ok, latency
     
     def test_proxies(self, proxy_list):
-        """批量测试代理"""
+        """并发批量测试代理，受并发上限和总截止时间限制"""
         available = []
-        for proxy in proxy_list:
-            # 跳过已经达到最大失败次数的代理
-            if proxy in self.proxy_failures and self.proxy_failures[proxy] >= self.max_failures:
-                continue
-                
-            if self.check_proxy(proxy):
-                available.append(proxy)
-                self.mark_proxy_success(proxy)  # 成功后重置失败计数
-            else:
-                self.mark_proxy_failed(proxy)  # 记录失败
+        # 跳过隔离中的代理，它们按各自的复测时间单独验证
+        with self.lock:
+            candidates = [proxy for proxy in proxy_list if proxy not in self.quarantine]
+        if not candidates:
+            return available
+        
+        executor = ThreadPoolExecutor(
+            max_workers=min(self.validate_concurrency, len(candidates)),
+            thread_name_prefix='validate'
+        )
+        futures = {executor.submit(self.check_proxy, proxy): proxy for proxy in candidates}
+        checked = 0
+        try:
+            for future in as_completed(futures, timeout=self.validate_deadline):
+                proxy = futures[future]
+                checked += 1
+                ok, latency = future.result()
+                if ok:
+                    available.append(proxy)
+                self.record_check_result(proxy, ok, latency)
+        except FuturesTimeoutError:
+            # 超时未完成的代理不计入失败，下一轮再验证
+            logger.warning(f"代理验证超过 {self.validate_deadline} 秒截止时间，{len(candidates) - checked} 个代理未完成验证")
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
         return available
     
+    def revalidation_due(self, now=None):
+        """到了重新验证时间的可用代理，最久未验证的优先；调用方需持有锁"""
+        now = time.time() if now is None else now
+        due = [proxy for proxy in self.available_proxies
+               if now - self.last_validated.get(proxy, 0) >= self.revalidate_interval]
+        due.sort(key=lambda proxy: self.last_validated.get(proxy, 0))
+        return due[:self.revalidate_batch]
+    
     def update_proxies(self):
-        """更新代理池"""
-        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 开始更新代理池...")
+        """增量更新代理池: 验证新增代理、上一轮未完成验证的代理和到期的可用代理，移除已从列表中删除的代理"""
+        logger.info("开始更新代理池...")
         
         # 获取新的代理列表
-        new_proxies = self.fetch_proxies_from_github()
+        new_proxies, changed = self.fetch_proxies()
         if not new_proxies:
-            print("未获取到新代理，保持现有代理池")
+            logger.warning("未获取到新代理，保持现有代理池")
             return
         
-        # 随机选择一批代理进行测试
-        test_sample = random.sample(new_proxies, min(self.test_batch_size, len(new_proxies)))
-        available = self.test_proxies(test_sample)
-        
-        # 同时测试现有的可用代理
-        if self.available_proxies:
-            print(f"重新测试现有 {len(self.available_proxies)} 个可用代理...")
-            still_available = self.test_proxies(self.available_proxies)
-            available.extend(still_available)
+        current = set(new_proxies)
+        with self.lock:
+            previous = set(self.all_proxies)
+            available = list(self.available_proxies)
+            added = [proxy for proxy in new_proxies if proxy not in previous]
+            removed = previous - current
+            self.pending_validation.difference_update(removed)
+            self.pending_validation.update(added)
+            # 隔离中的代理按各自的复测时间验证，不在此处重复验证
+            pending = [proxy for proxy in new_proxies
+                       if proxy in self.pending_validation and proxy not in self.quarantine]
+            revalidate = [proxy for proxy in self.revalidation_due() if proxy in current]
+            if self.full_validation_pending:
+                # 首次更新验证完整列表，同时重新测试现有的可用代理
+                candidates = list(dict.fromkeys(new_proxies + available))
+                self.pending_validation.update(candidates)
+            else:
+                candidates = list(dict.fromkeys(pending + revalidate))
+        if not changed and not candidates:
+            logger.info("代理列表未变化，跳过验证")
+            return
+        logger.info(f"代理列表新增 {len(added)} 个，移除 {len(removed)} 个，"
+                    f"并发验证 {len(candidates)} 个代理 (待验证 {len(pending)} 个，定期复验 {len(revalidate)} 个，"
+                    f"并发数: {self.validate_concurrency})...")
+        validated = set(self.test_proxies(candidates))
         
         # 更新代理池
         with self.lock:
-            self.all_proxies = new_proxies
-            self.available_proxies = list(set(available))
-            # 清理失败计数中不存在的代理
-            self.proxy_failures = {k: v for k, v in self.proxy_failures.items() if k in new_proxies}
-            print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 代理池更新完成，可用代理数: {len(self.available_proxies)}")
+            self.flush_outcomes()
+            self.all_proxies = IndexedSet(new_proxies)
+            if self.full_validation_pending:
+                # 超过截止时间未完成验证的原可用代理暂时保留，下一轮再验证
+                self.available_proxies = IndexedSet(
+                    p for p in candidates
+                    if p in validated or (p in self.pending_validation and p in self.available_proxies)
+                )
+            else:
+                for proxy in removed:
+                    self.available_proxies.discard(proxy)
+                for proxy in candidates:
+                    if proxy in validated:
+                        self.available_proxies.add(proxy)
+            # 清理已移除代理的失败计数、隔离记录和统计
+            for proxy in removed:
+                self.proxy_failures.pop(proxy, None)
+                self.quarantine.discard(proxy)
+                self.last_validated.pop(proxy, None)
+                if proxy not in validated:
+                    self.proxy_latency.pop(proxy, None)
+                    self.proxy_success_rate.pop(proxy, None)
+            self.full_validation_pending = False
+            self.publish()
+            logger.info(f"代理池更新完成，可用代理数: {len(self.available_proxies)}")
     
-    def update_thread(self):
+    def update_thread(self, initial_delay=0):
         """定期更新代理的线程"""
+        time.sleep(initial_delay)
         while True:
             try:
                 self.update_proxies()
+                self.save_state_file()
             except Exception as e:
-                print(f"更新代理池出错: {e}")
+                logger.error(f"更新代理池出错: {e}")
             time.sleep(self.update_interval)
     
-    def start_update_thread(self):
-        """启动更新线程"""
-        thread = threading.Thread(target=self.update_thread, daemon=True)
+    def record_check_result(self, proxy, ok, latency=None):
+        """记录一次健康检查结果: 通过时清零失败计数并解除隔离，失败时（再次）隔离
+
+        从未通过检查的候选代理失败时直接丢弃，不隔离也不保留统计：免费代理列表中大量无效代理
+        不会进入复测队列，也不会各自产生指标序列
+        """
+        with self.lock:
+            self.flush_outcomes()
+            self.pending_validation.discard(proxy)
+            if not ok and proxy not in self.available_proxies and proxy not in self.quarantine.records:
+                return
+            self.record_outcome(proxy, ok, latency)
+            self.last_validated[proxy] = time.time()
+            if ok:
+                self.proxy_failures.pop(proxy, None)
+                self.quarantine.readmit(proxy)
+                self.publish()
+                return
+            self.proxy_failures[proxy] = self.proxy_failures.get(proxy, 0) + 1
+            self.quarantine.add(proxy)
+            self.available_proxies.discard(proxy)
+            self.publish()
+        self.quarantine_wakeup.set()
+    
+    def retest_quarantined(self):
+        """复测已到时间的隔离代理，通过的重新加入可用列表"""
+        with self.lock:
+            due = self.quarantine.pop_due()
+        if not due:
+            return
+        with ThreadPoolExecutor(max_workers=min(self.validate_concurrency, len(due)),
+                                thread_name_prefix='retest') as executor:
+            results = list(executor.map(self.check_proxy, due))
+        readmitted = 0
+        for proxy, (ok, latency) in zip(due, results):
+            self.record_check_result(proxy, ok, latency)
+            if ok:
+                with self.lock:
+                    if proxy in self.all_proxies and self.available_proxies.add(proxy):
+                        self.publish()
+                        readmitted += 1
+        logger.info(f"复测 {len(due)} 个隔离代理，"
+                    f"恢复 {readmitted} 个")
+    
+    def quarantine_thread(self):
+        """等待最早的复测时间并复测隔离代理的线程"""
+        while True:
+            with self.lock:
+                next_due = self.quarantine.next_due()
+            timeout = 60 if next_due is None else min(max(next_due - time.time(), 0), 60)
+            self.quarantine_wakeup.wait(timeout)
+            self.quarantine_wakeup.clear()
+            try:
+                self.retest_quarantined()
+            except Exception as e:
+                logger.error(f"复测隔离代理出错: {e}")
+    
+    def start_update_thread(self, warm=False):
+        """启动更新线程
+
+        已从状态文件恢复出可用代理时，立即在后台重新验证，不阻塞启动；
+        否则先同步执行一次更新
+        """
+        if warm:
+            initial_delay = 0
+        else:
+            self.update_proxies()
+            self.save_state_file()
+            initial_delay = self.update_interval
+        thread = threading.Thread(target=self.update_thread, args=(initial_delay,), daemon=True)
         thread.start()
-        # 立即执行一次更新
-        self.update_proxies()
+        threading.Thread(target=self.quarantine_thread, daemon=True).start()
     
-    def mark_proxy_failed(self, proxy):
-        """标记代理失败"""
+    def record_outcome(self, proxy, success, latency=None):
+        """更新代理的延迟和成功率 EWMA，调用方需持有锁"""
+        alpha = self.ewma_alpha
+        rate = self.proxy_success_rate.get(proxy)
+        outcome = 1.0 if success else 0.0
+        self.proxy_success_rate[proxy] = outcome if rate is None else alpha * outcome + (1 - alpha) * rate
+        if latency is not None:
+            previous = self.proxy_latency.get(proxy)
+            self.proxy_latency[proxy] = latency if previous is None else alpha * latency + (1 - alpha) * previous
+    
+    def proxy_score(self, proxy):
+        """代理的期望代价: 延迟 / 成功率，越小越好"""
+        latency = self.proxy_latency.get(proxy, self.default_latency)
+        success_rate = self.proxy_success_rate.get(proxy, 0.5)
+        return max(latency, 0.001) / max(success_rate, 0.05)
+    
+    def apply_failure(self, proxy):
+        """计入一次失败，失败计数达到阈值时移出可用列表并隔离，返回是否隔离；调用方需持有锁"""
+        self.record_outcome(proxy, False)
+        self.proxy_failures[proxy] = self.proxy_failures.get(proxy, 0) + 1
+        
+        # 如果失败次数超过阈值，从可用列表中移除
+        if self.proxy_failures[proxy] < self.max_failures or not self.available_proxies.discard(proxy):
+            return False
+        delay = self.quarantine.add(proxy)
+        logger.warning(f"代理 {proxy} 失败{self.max_failures}次，"
+                       f"已移除并隔离 {delay:.0f} 秒")
+        return True
+    
+    def apply_success(self, proxy, latency=None):
+        """计入一次成功，抵消一次失败计数并记录连接延迟；调用方需持有锁
+
+        不直接清零失败计数，时好时坏的代理仍会累积失败而被隔离
+        """
+        self.record_outcome(proxy, True, latency)
+        failures = self.proxy_failures.get(proxy, 0)
+        if failures > 1:
+            self.proxy_failures[proxy] = failures - 1
+        elif failures:
+            del self.proxy_failures[proxy]
+    
+    def apply_outcomes(self, events):
+        """按顺序计入一批 (代理, 是否成功, 延迟)，返回是否有代理被隔离；调用方需持有锁"""
+        quarantined = False
+        for proxy, success, latency in events:
+            if success:
+                self.apply_success(proxy, latency)
+            elif self.apply_failure(proxy):
+                quarantined = True
+        return quarantined
+    
+    def flush_outcomes(self):
+        """合并积累的连接结果并发布新快照，返回是否有代理被隔离；调用方需持有锁"""
+        events = self.outcomes.drain()
+        if not events:
+            return False
+        if self.relayed is not None:
+            self.relayed.extend(events)
+        quarantined = self.apply_outcomes(events)
+        self.publish({proxy for proxy, _, _ in events})
+        return quarantined
+    
+    def take_relayed_outcomes(self):
+        """取出尚未上报的连接结果（worker 随统计发送给 supervisor）"""
         with self.lock:
-            if proxy in self.proxy_failures:
-                self.proxy_failures[proxy] += 1
-            else:
-                self.proxy_failures[proxy] = 1
-            
-            # 如果失败次数超过阈值，从可用列表中移除
-            if self.proxy_failures[proxy] >= self.max_failures:
-                if proxy in self.available_proxies:
-                    self.available_proxies.remove(proxy)
-                    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 代理 {proxy} 失败{self.max_failures}次，已移除")
+            self.flush_outcomes()
+            events, self.relayed = self.relayed, []
+        return events
     
-    def mark_proxy_success(self, proxy):
-        """标记代理成功，重置失败计数"""
+    def merge_outcomes(self, events):
+        """计入 worker 上报的连接结果（supervisor），下一次下发的快照即包含这些结果"""
+        if not events:
+            return
         with self.lock:
-            if proxy in self.proxy_failures:
-                del self.proxy_failures[proxy]
+            self.flush_outcomes()
+            quarantined = self.apply_outcomes(events)
+            self.publish({proxy for proxy, _, _ in events})
+        if quarantined:
+            self.quarantine_wakeup.set()
+    
+    def flush_outcomes_thread(self):
+        """每 outcomes.interval 秒合并一次积累的连接结果的线程"""
+        while True:
+            time.sleep(self.outcomes.interval)
+            if not self.outcomes:
+                continue
+            try:
+                with self.lock:
+                    quarantined = self.flush_outcomes()
+                if quarantined:
+                    self.quarantine_wakeup.set()
+            except Exception as e:
+                logger.error(f"合并连接结果出错: {e}")
+    
+    def add_outcome(self, proxy, success, latency=None):
+        """记录一次连接结果: 只追加到缓冲区，由后台线程合并"""
+        self.outcomes.add(proxy, success, latency)
+        if self.outcome_thread is None:
+            with self.lock:
+                if self.outcome_thread is None:
+                    self.outcome_thread = threading.Thread(target=self.flush_outcomes_thread, daemon=True)
+                    self.outcome_thread.start()
+    
+    def publish(self, touched=None):
+        """按当前代理池和统计发布新快照；调用方需持有锁
+
+        touched 为统计有变化的代理，只重新计算它们的代价，其余沿用上一个快照
+        """
+        if touched is None:
+            scores = {proxy: self.proxy_score(proxy) for proxy in self.available_proxies}
+        else:
+            scores = dict(self.snapshot.scores)
+            for proxy in touched:
+                if proxy in self.available_proxies:
+                    scores[proxy] = self.proxy_score(proxy)
+                else:
+                    scores.pop(proxy, None)
+        self.snapshot = PoolSnapshot(
+            tuple(self.available_proxies),
+            tuple(self.all_proxies),
+            scores,
+            self.proxy_score(None)
+        )
+    
+    def mark_proxy_failed(self, proxy):
+        """标记代理失败，失败计数达到阈值时移出可用列表并隔离（按批合并）"""
+        self.add_outcome(proxy, False)
+    
+    def mark_proxy_success(self, proxy, latency=None):
+        """标记代理成功，抵消一次失败计数并记录连接延迟（按批合并）"""
+        self.add_outcome(proxy, True, latency)
     
     def get_random_proxy(self):
-        """获取一个随机的可用代理"""
-        with self.lock:
-            if self.available_proxies:
-                return random.choice(self.available_proxies)
-            elif self.all_proxies:
-                # 如果没有测试过的可用代理，随机返回一个未测试的
-                return random.choice(self.all_proxies)
+        """按选择策略获取一个可用代理，只读取快照，不加锁"""
+        snapshot = self.snapshot
+        if snapshot.available:
+            strategy = SELECTION_STRATEGIES[self.selection_strategy]
+            return strategy(snapshot.available, snapshot.score)
+        elif snapshot.all_proxies:
+            # 如果没有测试过的可用代理，随机返回一个未测试的
+            return random.choice(snapshot.all_proxies)
         return None
     
+    def is_available(self, proxy):
+        """代理当前是否可用，只读取快照"""
+        return proxy in self.snapshot.scores
+    
+    def get_best_proxies(self, count):
+        """按期望代价从低到高返回至多 count 个可用代理"""
+        snapshot = self.snapshot
+        return sorted(snapshot.available, key=snapshot.score)[:count]
+    
     def get_all_available_proxies(self):
         """获取所有可用代理"""
-        with self.lock:
-            return self.available_proxies.copy()
+        return list(self.snapshot.available)
     
     def get_proxy_stats(self):
-        """获取代理统计信息"""
+        """获取代理统计信息（含各级健康检查的结果计数）"""
         with self.lock:
-            return {
+            self.flush_outcomes()
+            stats = {
                 'total_proxies': len(self.all_proxies),
                 'available_proxies': len(self.available_proxies),
-                'failed_proxies': len([p for p, f in self.proxy_failures.items() if f >= self.max_failures])
-            }
\ No newline at end of file
+                'failed_proxies': len([p for p, f in self.proxy_failures.items() if f >= self.max_failures]),
+                'quarantined_proxies': len(self.quarantine)
+            }
+        stats.update(self.prober.get_stats())
+        return stats
+    
+    def get_proxy_health(self):
+        """获取每个已知代理的健康状况（含隔离状态: 是否隔离、strike 次数、距下次复测秒数）"""
+        with self.lock:
+            self.flush_outcomes()
+            available = set(self.available_proxies)
+            proxies = available | set(self.proxy_failures) | set(self.proxy_latency) | set(self.quarantine.records)
+            now = time.time()
+            return [
+                dict({
+                    'proxy': proxy,
+                    'available': proxy in available,
+                    'failures': self.proxy_failures.get(proxy, 0),
+                    'latency': self.proxy_latency.get(proxy),
+                    'success_rate': self.proxy_success_rate.get(proxy)
+                }, **self.quarantine.state(proxy, now))
+                for proxy in sorted(proxies)
+            ]
+    
+    def export_state(self):
+        """导出代理池状态，用于多进程共享和持久化"""
+        with self.lock:
+            self.flush_outcomes()
+            return {
+                'all_proxies': list(self.all_proxies),
+                'available_proxies': list(self.available_proxies),
+                'proxy_failures': dict(self.proxy_failures),
+                'proxy_latency': dict(self.proxy_latency),
+                'proxy_success_rate': dict(self.proxy_success_rate),
+                'quarantine': self.quarantine.export()
+            }
+    
+    def save_state_file(self):
+        """将代理池状态原子写入状态文件"""
+        if not self.state_file:
+            return
+        state = self.export_state()
+        state['saved_at'] = time.time()
+        tmp_file = f"{self.state_file}.tmp"
+        try:
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(state, f)
+            os.replace(tmp_file, self.state_file)
+        except OSError as e:
+            logger.error(f"保存代理池状态失败: {e}")
+    
+    def load_state_file(self):
+        """从状态文件恢复代理池，恢复出可用代理时返回 True"""
+        if not self.state_file or not os.path.exists(self.state_file):
+            return False
+        try:
+            with open(self.state_file, encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"加载代理池状态失败: {e}")
+            return False
+        self.load_state(state)
+        saved_at = datetime.fromtimestamp(state.get('saved_at', 0)).strftime('%Y-%m-%d %H:%M:%S')
+        logger.info(f"从 {self.state_file} 恢复代理池 "
+                    f"(保存于 {saved_at})，可用代理数: {len(self.available_proxies)}")
+        return bool(self.available_proxies)
+    
+    def load_state(self, state):
+        """加载由 export_state 导出的代理池状态
+
+        worker 中重新计入尚未上报的连接结果，它们还不在 supervisor 下发的状态中
+        """
+        with self.lock:
+            self.all_proxies = IndexedSet(state.get('all_proxies', []))
+            self.available_proxies = IndexedSet(state.get('available_proxies', []))
+            self.proxy_failures = dict(state.get('proxy_failures', {}))
+            self.proxy_latency = dict(state.get('proxy_latency', {}))
+            self.proxy_success_rate = dict(state.get('proxy_success_rate', {}))
+            self.quarantine.load(state.get('quarantine', {}))
+            if self.relayed:
+                self.apply_outcomes(self.relayed)
+            self.publish()
@@ -0,0 +1,90 @@
+"""
+读多写少的代理池数据结构
+- IndexedSet: 列表加位置索引，O(1) 加入和删除（与末尾元素交换）
+- PoolSnapshot: 不可变快照，写入方在锁内修改后整体替换发布，
+  选择代理的热路径只读取当前快照（tuple 上 O(1) 随机选取），不需要加锁
+- OutcomeBuffer: 连接成功/失败结果先放入队列，由后台线程定期合并到延迟、成功率和失败计数中，
+  每次连接结束只追加一条记录，不争用代理池的锁
+"""
+import collections
+
+class IndexedSet:
+    """保持插入顺序（删除后除外）的集合，支持 O(1) 删除，非线程安全"""
+
+    __slots__ = ('items', 'positions')
+
+    def __init__(self, items=()):
+        self.items = []
+        self.positions = {}  # 元素 -> 在 items 中的下标
+        for item in items:
+            self.add(item)
+
+    def __contains__(self, item):
+        return item in self.positions
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def add(self, item):
+        """加入元素，已存在时返回 False"""
+        if item in self.positions:
+            return False
+        self.positions[item] = len(self.items)
+        self.items.append(item)
+        return True
+
+    def discard(self, item):
+        """删除元素，不存在时返回 False"""
+        index = self.positions.pop(item, None)
+        if index is None:
+            return False
+        last = self.items.pop()
+        if index < len(self.items):
+            # 用末尾元素填补空位
+            self.items[index] = last
+            self.positions[last] = index
+        return True
+
+class PoolSnapshot:
+    """某一时刻的代理池，发布后不再修改"""
+
+    __slots__ = ('available', 'all_proxies', 'scores', 'default_score')
+
+    def __init__(self, available=(), all_proxies=(), scores=None, default_score=1.0):
+        self.available = available  # 可用代理 tuple
+        self.all_proxies = all_proxies  # 全部代理 tuple
+        self.scores = scores or {}  # 代理 -> 发布时的期望代价
+        self.default_score = default_score
+
+    def score(self, proxy):
+        return self.scores.get(proxy, self.default_score)
+
+class OutcomeBuffer:
+    """待合并的代理使用结果
+
+    deque 的 append/popleft 是线程安全的，记录结果不需要加锁；
+    由后台线程每 interval 秒合并一次（读取统计或导出状态前也会合并）
+    """
+
+    def __init__(self, interval=0.2):
+        self.interval = interval
+        self.events = collections.deque()
+
+    def __len__(self):
+        return len(self.events)
+
+    def add(self, proxy, success, latency=None):
+        """记录一次结果"""
+        self.events.append((proxy, success, latency))
+
+    def drain(self):
+        """取出全部待合并的结果"""
+        events = []
+        while True:
+            try:
+                events.append(self.events.popleft())
+            except IndexError:
+                return events
@@ -0,0 +1,152 @@
+"""
+分级代理健康检查
+依次执行代价递增的检查，前一级通过才进入下一级:
+1. TCP 连接代理
+2. 通过代理对探测目标发起 CONNECT 握手
+3. （可选）经代理发送完整请求，响应内容需匹配期望的正则
+探测目标、匹配规则和各级超时均可配置，测试时可指向本地目标
+"""
+import re
+import socket
+import time
+import threading
+from urllib.parse import urlsplit
+import requests
+
+DEFAULT_PROBE_URL = 'https://ftty.ydmap.cn/srv100241/api/pub/sport/venue/getVenueOrderList?salesItemId=100341&curDate=1748188800000&venueGroupId=&t=1748187760876&type__1295=n4%2BxnDR70%3DK7wqWqY5DsD7fmKD54sO2g8S4rTD'
+# 返回内容包含"签名"或"验证"表示请求已到达目标站点，代理可用
+DEFAULT_PROBE_EXPECT = '签名|验证'
+DEFAULT_PROBE_HEADERS = {
+    'Host': 'ftty.ydmap.cn',
+    'server-reflexive-ip': '1.1.1.1',
+    'entry-tag': '',
+    'access-token': '',
+    'visitor-id': 'xxxxxx',
+    'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/107.0.0.0 Safari/537.36 NetType/WIFI MicroMessenger/6.8.0(0x16080000) MacWechat/3.8.10(0x13080a10) XWEB/1227 Flue',
+    'accept': 'application/json, text/plain, */*',
+    'timestamp': '1748187760918',
+    'signature': 'xxxxxx',
+    'tab-id': 'ydmap_fb21e370a0f048acfef6a518e9952c02',
+    'x-requested-with': 'XMLHttpRequest',
+    'cross-token': '',
+    'sec-fetch-site': 'same-origin',
+    'sec-fetch-mode': 'cors',
+    'sec-fetch-dest': 'empty',
+    'referer': 'https://ftty.ydmap.cn/booking/schedule/101332?salesItemId=100341',
+    'accept-language': 'zh-CN,zh;q=0.9'
+}
+
+STAGE_TCP = 'tcp'
+STAGE_CONNECT = 'connect'
+STAGE_REQUEST = 'request'
+
+class ProxyProber:
+    """分级代理探测
+
+    probe_url 为空时只做 TCP 和 CONNECT 两级检查；connect_target 默认取 probe_url 的 host:port
+    """
+
+    def __init__(self, probe_url=DEFAULT_PROBE_URL, connect_target=None, expect=DEFAULT_PROBE_EXPECT,
+                 headers=None, tcp_timeout=2, connect_timeout=3, request_timeout=3):
+        self.probe_url = probe_url or None
+        if connect_target is None:
+            if not self.probe_url:
+                raise ValueError("未配置完整请求时必须指定 CONNECT 探测目标")
+            url = urlsplit(self.probe_url)
+            connect_target = f"{url.hostname}:{url.port or (443 if url.scheme == 'https' else 80)}"
+        host, _, port = connect_target.rpartition(':')
+        self.connect_target = (host.strip('[]'), int(port))
+        self.expect = re.compile(expect) if expect else None
+        if headers is None:
+            headers = DEFAULT_PROBE_HEADERS if probe_url == DEFAULT_PROBE_URL else {}
+        self.headers = headers
+        self.tcp_timeout = tcp_timeout
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self.lock = threading.Lock()
+        self.failures = {STAGE_TCP: 0, STAGE_CONNECT: 0, STAGE_REQUEST: 0}
+        self.passed = 0
+
+    @staticmethod
+    def parse_proxy(proxy):
+        """解析 "host:port" 形式的代理地址"""
+        proxy_parts = proxy.replace('http://', '').split(':')
+        return proxy_parts[0], int(proxy_parts[1])
+
+    def connect_handshake(self, sock):
+        """通过代理对探测目标发起 CONNECT，返回是否得到 200 响应"""
+        host, port = self.connect_target
+        target = f"[{host}]:{port}" if ':' in host else f"{host}:{port}"
+        sock.settimeout(self.connect_timeout)
+        sock.sendall(f"CONNECT {target} HTTP/1.1\r\nHost: {target}\r\n\r\n".encode())
+        response = b''
+        while b'\r\n\r\n' not in response and len(response) < 8192:
+            chunk = sock.recv(1024)
+            if not chunk:
+                return False
+            response += chunk
+        status_line = response.split(b'\r\n', 1)[0].split()
+        return len(status_line) >= 2 and status_line[1] == b'200'
+
+    def full_request(self, proxy):
+        """经代理请求 probe_url 并匹配响应内容"""
+        proxies = {
+            'http': f'http://{proxy}',
+            'https': f'http://{proxy}'
+        }
+        response = requests.get(
+            self.probe_url,
+            headers=self.headers,
+            proxies=proxies,
+            timeout=self.request_timeout,
+            verify=False
+        )
+        if self.expect is None:
+            return response.status_code < 500
+        return bool(self.expect.search(response.text))
+
+    def probe(self, proxy):
+        """探测代理，返回 (是否可用, 未通过的阶段或 None, CONNECT 握手耗时秒数)
+
+        耗时为 TCP 连接加 CONNECT 握手的时间，与隧道实际建立连接的代价一致
+        """
+        stage = STAGE_TCP
+        latency = None
+        sock = None
+        try:
+            start = time.monotonic()
+            sock = socket.create_connection(self.parse_proxy(proxy), timeout=self.tcp_timeout)
+            stage = STAGE_CONNECT
+            if not self.connect_handshake(sock):
+                return self.record(False, stage, latency)
+            latency = time.monotonic() - start
+            sock.close()
+            sock = None
+            if self.probe_url:
+                stage = STAGE_REQUEST
+                if not self.full_request(proxy):
+                    return self.record(False, stage, latency)
+            return self.record(True, None, latency)
+        except Exception:
+            return self.record(False, stage, latency)
+        finally:
+            if sock is not None:
+                sock.close()
+
+    def record(self, ok, stage, latency):
+        with self.lock:
+            if ok:
+                self.passed += 1
+            else:
+                self.failures[stage] += 1
+        return ok, stage, latency
+
+    def get_stats(self):
+        """获取各阶段探测统计"""
+        with self.lock:
+            return {
+                'probe_passed': self.passed,
+                'probe_failed_tcp': self.failures[STAGE_TCP],
+                'probe_failed_connect': self.failures[STAGE_CONNECT],
+                'probe_failed_request': self.failures[STAGE_REQUEST]
+            }
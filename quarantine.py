@@ -0,0 +1,111 @@
+"""
+失败代理隔离与指数退避复测
+被隔离的代理按下次复测时间放入最小堆；每次进入隔离记一次 strike，
+复测间隔为 base_delay * 2^(strikes-1)，不超过 max_delay。
+复测通过后重新启用但保留 strike，短时间内再次失败的代理隔离时间翻倍；
+复测通过并在之后连续 forgive_after 秒未再失败时 strike 清零，偶发故障的代理能很快恢复。
+只有复测通过才会宽恕: 一直失败的代理即使两次 strike 间隔很长（达到 max_delay）也不会清零，
+退避时间停留在 max_delay
+"""
+import heapq
+import random
+import time
+
+class Quarantine:
+    """隔离队列，非线程安全，由调用方加锁"""
+
+    def __init__(self, base_delay=30, max_delay=3600, forgive_after=3600):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.forgive_after = forgive_after
+        self.heap = []  # (retest_at, proxy)，记录已变化的条目出堆时丢弃
+        # proxy -> {'strikes', 'last_strike', 'retest_at', 'readmitted_at'}，
+        # retest_at 为 None 表示未隔离，readmitted_at 为最近一次复测通过的时间
+        self.records = {}
+
+    def __contains__(self, proxy):
+        record = self.records.get(proxy)
+        return record is not None and record['retest_at'] is not None
+
+    def __len__(self):
+        return sum(1 for record in self.records.values() if record['retest_at'] is not None)
+
+    def add(self, proxy, now=None):
+        """隔离代理（或复测失败后再次隔离），返回复测间隔秒数"""
+        now = time.time() if now is None else now
+        record = self.records.get(proxy)
+        strikes = 0
+        if record and not self.forgiven(record, now):
+            strikes = record['strikes']
+        strikes += 1
+        # 加入少量抖动，避免同时失败的大量代理在同一时刻复测
+        delay = min(self.base_delay * 2 ** (strikes - 1), self.max_delay) * random.uniform(0.9, 1.1)
+        retest_at = now + delay
+        self.records[proxy] = {'strikes': strikes, 'last_strike': now, 'retest_at': retest_at,
+                               'readmitted_at': None}
+        heapq.heappush(self.heap, (retest_at, proxy))
+        return delay
+
+    def forgiven(self, record, now):
+        """复测通过后已连续 forgive_after 秒未再失败"""
+        readmitted_at = record.get('readmitted_at')
+        return readmitted_at is not None and now - readmitted_at > self.forgive_after
+
+    def pop_due(self, now=None):
+        """取出已到复测时间的代理，它们在复测结束前仍处于隔离状态"""
+        now = time.time() if now is None else now
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            retest_at, proxy = heapq.heappop(self.heap)
+            record = self.records.get(proxy)
+            if record and record['retest_at'] == retest_at:
+                due.append(proxy)
+        return due
+
+    def next_due(self):
+        """最早的复测时间，没有隔离的代理时返回 None"""
+        while self.heap:
+            retest_at, proxy = self.heap[0]
+            record = self.records.get(proxy)
+            if record and record['retest_at'] == retest_at:
+                return retest_at
+            heapq.heappop(self.heap)
+        return None
+
+    def readmit(self, proxy, now=None):
+        """复测通过，解除隔离但保留 strike 记录"""
+        now = time.time() if now is None else now
+        record = self.records.get(proxy)
+        if record:
+            record['retest_at'] = None
+            record['readmitted_at'] = now
+        # 顺带清理已过宽恕期的记录
+        for key in [p for p, r in self.records.items() if r['retest_at'] is None and self.forgiven(r, now)]:
+            del self.records[key]
+
+    def discard(self, proxy):
+        """彻底移除代理（已不在代理列表中）"""
+        self.records.pop(proxy, None)
+
+    def state(self, proxy, now=None):
+        """单个代理的隔离状态"""
+        now = time.time() if now is None else now
+        record = self.records.get(proxy)
+        if record is None:
+            return {'quarantined': False, 'strikes': 0, 'retest_in': None}
+        retest_at = record['retest_at']
+        return {
+            'quarantined': retest_at is not None,
+            'strikes': record['strikes'],
+            'retest_in': None if retest_at is None else max(retest_at - now, 0)
+        }
+
+    def export(self):
+        """导出隔离记录（用于持久化和多进程同步）"""
+        return {proxy: dict(record) for proxy, record in self.records.items()}
+
+    def load(self, records):
+        """加载 export 导出的隔离记录"""
+        self.records = {proxy: dict(record) for proxy, record in records.items()}
+        self.heap = [(r['retest_at'], proxy) for proxy, r in self.records.items() if r['retest_at'] is not None]
+        heapq.heapify(self.heap)
@@ -0,0 +1,92 @@
+"""
+客户端请求头的增量读取
+- 每个连接预分配固定大小的缓冲区，recv_into 直接写入，不产生中间 bytes 和拼接
+- 每次只在新收到的数据（及前 3 个字节）中查找 \\r\\n\\r\\n
+- 请求行和首部在首次访问时才解码
+- 消息头之后客户端已发送的数据（如紧跟 CONNECT 的 TLS ClientHello）保留下来，
+  隧道建立后转发给目标
+"""
+
+HEAD_TERMINATOR = b'\r\n\r\n'
+MAX_REQUEST_HEAD = 8192
+
+class RequestHead:
+    """单个连接的请求头缓冲区"""
+
+    __slots__ = ('buffer', 'view', 'length', 'head_end', 'scan_from', 'cached_request_line', 'cached_headers')
+
+    def __init__(self, max_size=MAX_REQUEST_HEAD):
+        self.buffer = bytearray(max_size)
+        self.view = memoryview(self.buffer)
+        self.length = 0
+        self.head_end = -1  # 消息头结束位置（含 \r\n\r\n），未读完时为 -1
+        self.scan_from = 0
+        self.cached_request_line = None
+        self.cached_headers = None
+
+    @property
+    def complete(self):
+        """是否已读到完整的消息头"""
+        return self.head_end >= 0
+
+    @property
+    def full(self):
+        """缓冲区已满"""
+        return self.length >= len(self.buffer)
+
+    def free_space(self):
+        """缓冲区剩余部分，供 recv_into 写入"""
+        return self.view[self.length:]
+
+    def feed(self, n):
+        """登记新写入的 n 个字节，返回消息头是否已完整"""
+        self.length += n
+        index = self.buffer.find(HEAD_TERMINATOR, self.scan_from, self.length)
+        if index >= 0:
+            self.head_end = index + len(HEAD_TERMINATOR)
+            return True
+        # 结束标记可能跨两次 recv，保留末尾 3 个字节参与下次查找
+        self.scan_from = max(0, self.length - len(HEAD_TERMINATOR) + 1)
+        return False
+
+    def data(self):
+        """已读取的全部数据"""
+        return bytes(self.view[:self.length])
+
+    def leftover(self):
+        """消息头之后客户端已发送的数据"""
+        if not self.complete:
+            return b''
+        return bytes(self.view[self.head_end:self.length])
+
+    def request_line(self):
+        """请求行（不含换行）"""
+        if self.cached_request_line is None:
+            end = self.buffer.find(b'\r\n', 0, self.length)
+            if end < 0:
+                end = self.length
+            self.cached_request_line = bytes(self.view[:end]).decode('utf-8', errors='ignore')
+        return self.cached_request_line
+
+    def header(self, name):
+        """获取首部值（不区分大小写），不存在时返回 None；首次调用时才解析首部"""
+        if self.cached_headers is None:
+            end = self.head_end if self.complete else self.length
+            headers = {}
+            lines = bytes(self.view[:end]).decode('latin-1').split('\r\n')
+            for line in lines[1:]:
+                key, sep, value = line.partition(':')
+                if sep:
+                    headers.setdefault(key.strip().lower(), value.strip())
+            self.cached_headers = headers
+        return self.cached_headers.get(name.lower())
+
+def read_request_head(sock, max_size=MAX_REQUEST_HEAD):
+    """从阻塞 socket 读取请求头，连接关闭或超出大小限制时返回已读取的部分"""
+    head = RequestHead(max_size)
+    while not head.complete and not head.full:
+        n = sock.recv_into(head.free_space())
+        if not n:
+            break
+        head.feed(n)
+    return head
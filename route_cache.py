@@ -0,0 +1,92 @@
+"""
+按目标 host:port 学习到的路由表
+记住“直连可用”、“需要上游代理（以及上次成功的代理）”或“不可达，快速失败”，
+带 TTL 和 LRU 容量上限。只有确定性的失败（域名不存在、直连被拒绝）或连续多次失败才标记为不可达，
+单个上游代理不稳定或偶发超时不会让目标对所有客户端快速失败
+"""
+import threading
+import time
+from collections import OrderedDict
+
+ROUTE_DIRECT = 'direct'
+ROUTE_UPSTREAM = 'upstream'
+ROUTE_UNREACHABLE = 'unreachable'
+
+class RouteCache:
+    """带 TTL 的 LRU 路由缓存"""
+
+    def __init__(self, max_size=10000, direct_ttl=600, upstream_ttl=300, unreachable_ttl=30,
+                 unreachable_after=3):
+        self.max_size = max_size
+        self.unreachable_after = unreachable_after  # 非确定性失败连续达到此次数时标记为不可达
+        self.ttls = {
+            ROUTE_DIRECT: direct_ttl,
+            ROUTE_UPSTREAM: upstream_ttl,
+            ROUTE_UNREACHABLE: unreachable_ttl,
+        }
+        self.entries = OrderedDict()  # "host:port" -> (route, proxy, expires_at)
+        self.failures = OrderedDict()  # "host:port" -> 连续失败次数
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, host, port):
+        """查询路由，返回 (route, proxy)，未命中或已过期返回 None"""
+        key = f"{host}:{port}"
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            route, proxy, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return route, proxy
+
+    def put(self, host, port, route, proxy=None):
+        """记录路由，超出容量时淘汰最久未使用的条目"""
+        ttl = self.ttls[route]
+        if ttl <= 0:
+            return
+        key = f"{host}:{port}"
+        with self.lock:
+            if route != ROUTE_UNREACHABLE:
+                self.failures.pop(key, None)
+            self.entries[key] = (route, proxy, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def record_failure(self, host, port, definitive=False):
+        """记录一次连接失败，确定性失败或连续失败达到 unreachable_after 次时标记为不可达，返回是否已标记"""
+        key = f"{host}:{port}"
+        with self.lock:
+            failures = self.failures.pop(key, 0) + 1
+            if not definitive and failures < self.unreachable_after:
+                self.failures[key] = failures
+                while len(self.failures) > self.max_size:
+                    self.failures.popitem(last=False)
+                return False
+        self.put(host, port, ROUTE_UNREACHABLE)
+        return True
+
+    def invalidate(self, host, port):
+        """删除路由"""
+        with self.lock:
+            self.entries.pop(f"{host}:{port}", None)
+
+    def get_stats(self):
+        """获取缓存统计信息"""
+        with self.lock:
+            return {
+                'route_cache_size': len(self.entries),
+                'route_cache_hits': self.hits,
+                'route_cache_misses': self.misses,
+                'route_cache_evictions': self.evictions
+            }
@@ -7,32 +7,75 @@ import subprocess
 import sys
 import os
 import signal
+import socket
 import time
 import argparse
 
 def check_port(port):
     """检查端口是否被占用"""
-    import socket
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     result = sock.connect_ex(('127.0.0.1', port))
     sock.close()
     return result == 0
 
-def kill_process_on_port(port):
-    """终止占用指定端口的进程"""
+def find_listening_pids(port):
+    """查找监听指定端口的进程（不含连接到该端口的客户端）"""
     try:
-        result = subprocess.run(["lsof", "-ti", f":{port}"], capture_output=True, text=True)
-        if result.stdout.strip():
-            pids = result.stdout.strip().split('\n')
+        result = subprocess.run(["lsof", "-ti", f"tcp:{port}", "-sTCP:LISTEN"],
+                                capture_output=True, text=True)
+    except Exception as e:
+        print(f"无法查找占用端口的进程: {e}")
+        return []
+    return [int(pid) for pid in result.stdout.split()]
+
+def can_share_port(host, port):
+    """占用端口的进程是否启用了 SO_REUSEPORT，即新进程能否与其同时监听"""
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        return False
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((host, port))
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+def stop_processes(pids, port=None, timeout=30):
+    """向进程发送 SIGTERM，使其停止监听并排空已有连接
+
+    指定 port 时等待端口释放，超过 timeout 秒仍被占用则强制结束
+    """
+    for pid in pids:
+        print(f"停止占用端口的进程 (PID: {pid})")
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        except OSError as e:
+            print(f"无法停止进程 {pid}: {e}")
+            return False
+    if port is None:
+        return True
+    deadline = time.monotonic() + timeout
+    while check_port(port):
+        if time.monotonic() >= deadline:
             for pid in pids:
-                if pid:
-                    print(f"停止占用端口 {port} 的进程 (PID: {pid})")
-                    subprocess.run(["kill", "-9", pid])
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
             time.sleep(1)
-            return True
-    except Exception as e:
-        print(f"无法停止进程: {e}")
-    return False
+            return not check_port(port)
+        time.sleep(0.2)
+    return True
+
+def kill_process_on_port(port, timeout=30):
+    """优雅终止占用指定端口的进程，等待端口释放"""
+    pids = find_listening_pids(port)
+    return bool(pids) and stop_processes(pids, port, timeout)
 
 def main():
     """启动隧道代理服务器"""
@@ -40,6 +83,92 @@ def main():
     parser.add_argument('--port', '-p', type=int, default=10800, help='代理服务端口 (默认: 10800)')
     parser.add_argument('--host', type=str, default='0.0.0.0', help='监听地址 (默认: 0.0.0.0)')
     parser.add_argument('--force', '-f', action='store_true', help='强制清理端口冲突')
+    parser.add_argument('--engine', choices=['threading', 'asyncio'], default='threading',
+                        help='服务引擎: threading 每连接线程, asyncio 单事件循环 (默认: threading)')
+    parser.add_argument('--forward-backend', choices=['auto', 'splice', 'buffer'], default='auto',
+                        help='threading 引擎的数据转发后端: splice 零拷贝, buffer 复用缓冲区 (默认: auto)')
+    parser.add_argument('--buffer-size', type=int, default=65536, help='单次转发的缓冲区大小 (默认: 65536)')
+    parser.add_argument('--connect-stagger', type=float, default=0.3,
+                        help='竞速连接中相邻尝试的错峰间隔/秒 (默认: 0.3)')
+    parser.add_argument('--connect-fanout', type=int, default=2,
+                        help='竞速连接中并行尝试的上游代理数 (默认: 2)')
+    parser.add_argument('--connect-deadline', type=float, default=15,
+                        help='建立到目标连接的总截止时间/秒 (默认: 15)')
+    parser.add_argument('--route-cache-size', type=int, default=10000,
+                        help='路由缓存的最大条目数 (默认: 10000)')
+    parser.add_argument('--route-cache-ttl', type=float, default=600,
+                        help='直连/上游路由的缓存时间/秒 (默认: 600)')
+    parser.add_argument('--unreachable-ttl', type=float, default=30,
+                        help='不可达目标的快速失败时间/秒 (默认: 30)')
+    parser.add_argument('--unreachable-after', type=int, default=3,
+                        help='非确定性失败（超时、上游代理失败）连续多少次后标记目标不可达；'
+                             '域名不存在或直连被拒绝时立即标记 (默认: 3)')
+    parser.add_argument('--dns-server', action='append', dest='dns_servers', metavar='HOST[:PORT]',
+                        help='直接查询的 DNS 服务器，可多次指定 (默认: 使用系统解析器)')
+    parser.add_argument('--dns-ttl', type=float, default=60,
+                        help='使用系统解析器时的 DNS 缓存时间/秒 (默认: 60)')
+    parser.add_argument('--upstream-pool-proxies', type=int, default=3,
+                        help='保持预热连接的最优上游代理数, 0 表示禁用 (默认: 3)')
+    parser.add_argument('--upstream-pool-per-proxy', type=int, default=2,
+                        help='每个上游代理的预热连接数 (默认: 2)')
+    parser.add_argument('--upstream-pool-idle-timeout', type=float, default=30,
+                        help='预热连接的最长空闲时间/秒 (默认: 30)')
+    parser.add_argument('--max-connections', type=int, default=0,
+                        help='每个进程的最大并发客户端连接数, 超出时返回 503, 0 表示不限制 (默认: 0)')
+    parser.add_argument('--max-connections-per-ip', type=int, default=0,
+                        help='单个客户端 IP 的最大并发连接数, 0 表示不限制 (默认: 0)')
+    parser.add_argument('--max-pending', type=int, default=512,
+                        help='正在握手（读取请求、连接目标）的最大连接数, 0 表示不限制 (默认: 512)')
+    parser.add_argument('--tunnel-idle-timeout', type=float, default=600,
+                        help='隧道双向均无数据时的最长保持时间/秒, 0 表示不限制 (默认: 600)')
+    parser.add_argument('--tunnel-max-lifetime', type=float, default=0,
+                        help='单条隧道的最长存活时间/秒, 0 表示不限制 (默认: 0)')
+    parser.add_argument('--origin-pool-size', type=int, default=8,
+                        help='普通 HTTP 代理每个源站保留的空闲连接数 (默认: 8)')
+    parser.add_argument('--origin-idle-timeout', type=float, default=60,
+                        help='源站空闲连接的最长保留时间/秒 (默认: 60)')
+    parser.add_argument('--access-log', type=str, default='-',
+                        help='JSON 访问日志输出文件, "-" 为标准输出, 空字符串表示禁用 (默认: -)')
+    parser.add_argument('--access-log-sample', type=float, default=1.0,
+                        help='访问日志采样比例 0~1 (默认: 1.0)')
+    parser.add_argument('--metrics-port', type=int, default=8081,
+                        help='指标服务端口 (/metrics 为 Prometheus 格式, / 为 JSON), 0 表示禁用 (默认: 8081)')
+    parser.add_argument('--metrics-host', type=str, default=None, help='指标服务监听地址 (默认: 与 --host 相同)')
+    parser.add_argument('--trace-phases', action='store_true',
+                        help='记录连接建立各阶段耗时 (accept、请求头、DNS、直连、上游连接、CONNECT 握手) 的直方图')
+    parser.add_argument('--debug-endpoints', action='store_true',
+                        help='在指标服务上提供 /debug/stacks 和 /debug/profile?seconds=N (仅单进程模式)')
+    parser.add_argument('--profile-dir', type=str, default=None,
+                        help='SIGUSR2 触发的采样分析结果目录 (默认: 系统临时目录)')
+    parser.add_argument('--drain-timeout', type=float, default=30,
+                        help='收到 SIGTERM 或平滑重启后等待已有连接结束的最长时间/秒 (默认: 30)')
+    parser.add_argument('--workers', '-w', type=int, default=1,
+                        help='worker 进程数, 大于1时以 SO_REUSEPORT 多进程监听同一端口 (默认: 1)')
+    parser.add_argument('--validate-concurrency', type=int, default=32, help='代理并发验证数 (默认: 32)')
+    parser.add_argument('--validate-deadline', type=float, default=60,
+                        help='每轮代理验证的总截止时间/秒 (默认: 60)')
+    parser.add_argument('--state-file', type=str, default='proxy_state.json',
+                        help='代理池状态持久化文件, 重启时据此快速恢复, 传空字符串禁用 (默认: proxy_state.json)')
+    parser.add_argument('--proxy-strategy', choices=['random', 'weighted', 'least-latency', 'p2c'],
+                        default='p2c', help='上游代理选择策略 (默认: p2c)')
+    parser.add_argument('--probe-url',
+                        help='代理健康检查的完整请求 URL, 空字符串表示只检查 TCP 和 CONNECT (默认: ydmap 接口)')
+    parser.add_argument('--probe-connect-target', metavar='HOST:PORT',
+                        help='CONNECT 握手检查的目标 (默认: --probe-url 的主机和端口)')
+    parser.add_argument('--probe-expect',
+                        help='完整请求响应内容需匹配的正则, 空字符串表示只要求状态码 < 500 (默认: 签名|验证)')
+    parser.add_argument('--probe-tcp-timeout', type=float, default=2,
+                        help='健康检查 TCP 连接超时/秒 (默认: 2)')
+    parser.add_argument('--probe-connect-timeout', type=float, default=3,
+                        help='健康检查 CONNECT 握手超时/秒 (默认: 3)')
+    parser.add_argument('--probe-request-timeout', type=float, default=3,
+                        help='健康检查完整请求超时/秒 (默认: 3)')
+    parser.add_argument('--quarantine-base-delay', type=float, default=30,
+                        help='失败代理首次隔离后的复测间隔/秒, 再次隔离时翻倍 (默认: 30)')
+    parser.add_argument('--quarantine-max-delay', type=float, default=3600,
+                        help='隔离复测间隔上限/秒 (默认: 3600)')
+    parser.add_argument('--proxy-source', action='append', dest='proxy_sources', metavar='URL|FILE',
+                        help='代理列表来源 URL 或本地文件，可多次指定 (默认: GitHub 免费代理列表)')
     
     args = parser.parse_args()
     
@@ -53,10 +182,20 @@ def main():
     print("  • 自动代理池管理")
     print()
     
-    # 检查端口是否被占用
-    if check_port(args.port):
+    # 由旧进程平滑重启（SIGHUP）启动时，继承监听 socket 和就绪通知管道
+    from lifecycle import LISTEN_FD_ENV, READY_FD_ENV, take_inherited_fd, notify_ready
+    listen_fd = take_inherited_fd(LISTEN_FD_ENV)
+    ready_fd = take_inherited_fd(READY_FD_ENV)
+    
+    # 检查端口是否被占用（平滑重启时端口由旧进程占用，无需检查）
+    takeover_pids = []
+    if ready_fd is None and check_port(args.port):
         if args.force or input(f"端口 {args.port} 已被占用，是否清理? (y/N): ").lower() == 'y':
-            if kill_process_on_port(args.port):
+            if can_share_port(args.host, args.port):
+                # 与旧进程同时监听，本进程开始 accept 后再让旧进程排空退出
+                takeover_pids = find_listening_pids(args.port)
+                print(f"端口 {args.port} 由旧进程 (PID: {takeover_pids}) 占用，本进程就绪后再通知其退出")
+            elif kill_process_on_port(args.port, args.drain_timeout):
                 print(f"✅ 已清理端口 {args.port}")
             else:
                 print(f"❌ 无法清理端口 {args.port}")
@@ -65,9 +204,19 @@ def main():
             print("❌ 端口被占用，启动失败")
             sys.exit(1)
     
+    def on_ready():
+        """开始 accept 后通知旧进程停止"""
+        notify_ready(ready_fd)
+        if takeover_pids:
+            stop_processes(takeover_pids)
+    
     print(f"📍 配置信息:")
     print(f"  监听地址: {args.host}:{args.port}")
     print(f"  代理配置: http://{args.host}:{args.port}")
+    print(f"  服务引擎: {args.engine}")
+    print(f"  worker 进程数: {args.workers}")
+    if args.metrics_port:
+        print(f"  指标服务: http://{args.metrics_host or args.host}:{args.metrics_port}/metrics")
     
     if args.host == '0.0.0.0':
         print(f"\n⚠️  安全提醒:")
@@ -86,16 +235,83 @@ def main():
     try:
         # 检查依赖
         try:
-            from tunnel_proxy import TunnelProxy
             from proxy_manager import ProxyManager
+            from workers import WorkerSupervisor, create_proxy
+            from access_log import setup_async_logging
         except ImportError as e:
             print(f"❌ 导入模块失败: {e}")
             print("请确保所有依赖文件都在当前目录")
             sys.exit(1)
         
+        # 日志经有界队列由后台线程写出，不阻塞请求处理
+        setup_async_logging()
+        
         # 启动隧道代理服务器
-        proxy = TunnelProxy(host=args.host, port=args.port)
-        proxy.start()
+        proxy_options = {
+            'forward_backend': args.forward_backend,
+            'buffer_size': args.buffer_size,
+            'connect_stagger': args.connect_stagger,
+            'connect_fanout': args.connect_fanout,
+            'connect_deadline': args.connect_deadline,
+            'route_cache_size': args.route_cache_size,
+            'route_cache_ttl': args.route_cache_ttl,
+            'unreachable_ttl': args.unreachable_ttl,
+            'unreachable_after': args.unreachable_after,
+            'dns_servers': args.dns_servers,
+            'dns_ttl': args.dns_ttl,
+            'upstream_pool_proxies': args.upstream_pool_proxies,
+            'upstream_pool_per_proxy': args.upstream_pool_per_proxy,
+            'upstream_pool_idle_timeout': args.upstream_pool_idle_timeout,
+            'origin_pool_size': args.origin_pool_size,
+            'origin_idle_timeout': args.origin_idle_timeout,
+            'max_connections': args.max_connections,
+            'max_connections_per_ip': args.max_connections_per_ip,
+            'max_pending': args.max_pending,
+            'tunnel_idle_timeout': args.tunnel_idle_timeout,
+            'tunnel_max_lifetime': args.tunnel_max_lifetime,
+            'access_log': args.access_log or None,
+            'access_log_sample': args.access_log_sample,
+            'metrics_host': args.metrics_host,
+            'metrics_port': args.metrics_port,
+            'drain_timeout': args.drain_timeout,
+            'trace_phases': args.trace_phases,
+            'debug_endpoints': args.debug_endpoints,
+            'profile_dir': args.profile_dir,
+        }
+        manager_options = {
+            'validate_concurrency': args.validate_concurrency,
+            'validate_deadline': args.validate_deadline,
+            'selection_strategy': args.proxy_strategy,
+            'state_file': args.state_file or None,
+            'proxy_sources': args.proxy_sources,
+            'quarantine_base_delay': args.quarantine_base_delay,
+            'quarantine_max_delay': args.quarantine_max_delay,
+            'probe_options': {key: value for key, value in {
+                'probe_url': args.probe_url,
+                'connect_target': args.probe_connect_target,
+                'expect': args.probe_expect,
+                'tcp_timeout': args.probe_tcp_timeout,
+                'connect_timeout': args.probe_connect_timeout,
+                'request_timeout': args.probe_request_timeout,
+            }.items() if value is not None},
+        }
+        if args.workers > 1:
+            supervisor = WorkerSupervisor(args.host, args.port, args.workers,
+                                          engine=args.engine, options=proxy_options,
+                                          manager_options=manager_options,
+                                          drain_timeout=args.drain_timeout,
+                                          on_ready=on_ready,
+                                          metrics_host=args.metrics_host,
+                                          metrics_port=args.metrics_port)
+            supervisor.start()
+        else:
+            proxy_manager = ProxyManager(**manager_options)
+            # 启用 SO_REUSEPORT，以便下次部署时新进程可以先与本进程同时监听
+            proxy = create_proxy(args.engine, args.host, args.port,
+                                 proxy_manager=proxy_manager,
+                                 reuse_port=hasattr(socket, 'SO_REUSEPORT'),
+                                 listen_fd=listen_fd, on_ready=on_ready, **proxy_options)
+            proxy.start()
         
     except KeyboardInterrupt:
         print("\n\n🛑 收到停止信号...")
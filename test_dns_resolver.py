@@ -0,0 +1,82 @@
+"""
+DNS 解析缓存的异常处理测试: 无效域名和格式错误的响应不应让域名永久无法解析
+运行: python -m unittest test_dns_resolver
+"""
+import socket
+import struct
+import threading
+import unittest
+
+from dns_resolver import DNSError, DNSResolver, build_query, parse_response
+
+class StubNameserver:
+    """本地 UDP nameserver，前 malformed 个查询返回截断的报文，之后返回一条 A 记录"""
+
+    def __init__(self, address='10.1.2.3', malformed=0):
+        self.address = address
+        self.malformed = malformed
+        self.queries = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    @property
+    def nameserver(self):
+        return '127.0.0.1:%d' % self.sock.getsockname()[1]
+
+    def serve(self):
+        while True:
+            try:
+                data, peer = self.sock.recvfrom(512)
+            except OSError:
+                return
+            self.queries += 1
+            query_id, = struct.unpack('!H', data[:2])
+            offset = 12
+            while data[offset]:
+                offset += data[offset] + 1
+            question = data[12:offset + 5]
+            qtype, = struct.unpack('!H', data[offset + 1:offset + 3])
+            if self.malformed:
+                self.malformed -= 1
+                # 声明有一条回答但报文在回答处截断
+                self.sock.sendto(struct.pack('!HHHHHH', query_id, 0x8180, 1, 1, 0, 0) + question + b'\xc0', peer)
+                continue
+            answer = b''
+            if qtype == 1:
+                answer = b'\xc0\x0c' + struct.pack('!HHIH', 1, 1, 60, 4) + socket.inet_aton(self.address)
+            self.sock.sendto(struct.pack('!HHHHHH', query_id, 0x8180, 1, 1 if answer else 0, 0, 0)
+                             + question + answer, peer)
+
+    def close(self):
+        self.sock.close()
+
+class DNSResolverErrorTest(unittest.TestCase):
+    def test_invalid_names_raise_dns_error(self):
+        for name in ('a..b', 'x' * 64 + '.example'):
+            with self.assertRaises(DNSError):
+                build_query(1, name, 1)
+
+    def test_truncated_response_raises_dns_error(self):
+        with self.assertRaises(DNSError):
+            parse_response(b'\x00\x01\x81\x80\x00\x01\x00\x01')
+
+    def test_recovers_after_malformed_reply(self):
+        server = StubNameserver(malformed=2)
+        self.addCleanup(server.close)
+        resolver = DNSResolver(nameservers=[server.nameserver], timeout=0.5, negative_ttl=0)
+        with self.assertRaises(OSError):
+            resolver.resolve('example.test')
+        self.assertEqual(resolver.resolve('example.test'), [(socket.AF_INET, '10.1.2.3')])
+        self.assertGreater(server.queries, 2)
+        self.assertEqual(resolver.inflight, {})
+
+    def test_invalid_name_is_not_stuck_in_flight(self):
+        resolver = DNSResolver(nameservers=['127.0.0.1:9'], timeout=0.2)
+        for _ in range(2):
+            with self.assertRaises(DNSError):
+                resolver.resolve('a..b')
+        self.assertEqual(resolver.inflight, {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+"""
+普通 HTTP 代理的请求解析测试（消息长度校验与 Host 改写，防止请求走私）
+运行: python -m unittest test_http_forward
+"""
+import types
+import unittest
+
+from http_forward import HTTPError, HTTPForwarder, body_framing, parse_head
+from metrics import MetricsRegistry
+
+def make_head(*header_lines, target='http://example.com/path?q=1'):
+    lines = [f"POST {target} HTTP/1.1"] + list(header_lines)
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+class ParseRequestTest(unittest.TestCase):
+    def setUp(self):
+        self.forwarder = HTTPForwarder(types.SimpleNamespace(metrics=MetricsRegistry()))
+
+    def parse(self, *header_lines, **kwargs):
+        method, host, port, origin_head, framing, _ = self.forwarder.parse_request(
+            make_head(*header_lines, **kwargs))
+        _, headers = parse_head(origin_head)
+        return framing, headers
+
+    def assert_rejected(self, *header_lines):
+        with self.assertRaises(HTTPError) as context:
+            self.forwarder.parse_request(make_head(*header_lines))
+        self.assertEqual(context.exception.status, "400 Bad Request")
+
+    def test_content_length(self):
+        framing, headers = self.parse('Content-Length: 4')
+        self.assertEqual(framing, 4)
+        self.assertIn(('Content-Length', '4'), headers)
+
+    def test_repeated_identical_content_length(self):
+        framing, _ = self.parse('Content-Length: 4', 'Content-Length: 4')
+        self.assertEqual(framing, 4)
+
+    def test_differing_content_length_rejected(self):
+        self.assert_rejected('Content-Length: 4', 'Content-Length: 40')
+        self.assert_rejected('Content-Length: 4, 40')
+
+    def test_malformed_content_length_rejected(self):
+        for value in ('+4', '4_0', '-1', 'abc', ''):
+            self.assert_rejected(f'Content-Length: {value}')
+
+    def test_transfer_encoding_with_content_length_rejected(self):
+        self.assert_rejected('Transfer-Encoding: chunked', 'Content-Length: 4')
+        self.assert_rejected('Content-Length: 4', 'Transfer-Encoding: chunked')
+
+    def test_chunked_must_be_final_coding(self):
+        self.assert_rejected('Transfer-Encoding: chunked, gzip')
+        self.assert_rejected('Transfer-Encoding: xchunked')
+        self.assert_rejected('Transfer-Encoding: gzip')
+
+    def test_chunked_final_coding_accepted(self):
+        framing, headers = self.parse('Transfer-Encoding: gzip, chunked')
+        self.assertEqual(framing, 'chunked')
+        framing, _ = self.parse('Transfer-Encoding: gzip', 'Transfer-Encoding: Chunked')
+        self.assertEqual(framing, 'chunked')
+        self.assertNotIn('content-length', [name.lower() for name, _ in headers])
+
+    def test_host_taken_from_request_uri(self):
+        _, headers = self.parse('Host: evil.example', 'Content-Length: 0',
+                                target='http://user@example.com:8080/')
+        hosts = [value for name, value in headers if name.lower() == 'host']
+        self.assertEqual(hosts, ['example.com:8080'])
+
+class ResponseFramingTest(unittest.TestCase):
+    def test_transfer_encoding_overrides_content_length(self):
+        headers = [('Transfer-Encoding', 'chunked'), ('Content-Length', '10')]
+        self.assertEqual(body_framing(headers, request=False), 'chunked')
+
+    def test_non_chunked_transfer_encoding_reads_until_close(self):
+        self.assertIsNone(body_framing([('Transfer-Encoding', 'gzip')], request=False))
+
+    def test_differing_content_length_rejected(self):
+        with self.assertRaises(HTTPError):
+            body_framing([('Content-Length', '1'), ('Content-Length', '2')], request=False)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+"""
+代理隔离的退避与宽恕测试
+运行: python -m unittest test_quarantine
+"""
+import unittest
+
+from proxy_manager import ProxyManager
+from quarantine import Quarantine
+
+class BackoffTest(unittest.TestCase):
+    def setUp(self):
+        self.quarantine = Quarantine(base_delay=30, max_delay=3600, forgive_after=3600)
+
+    def fail_repeatedly(self, times, now=0):
+        delays = []
+        for _ in range(times):
+            delay = self.quarantine.add('p', now)
+            delays.append(delay)
+            now += delay + 1
+        return delays, now
+
+    def test_dead_proxy_stays_at_max_delay(self):
+        delays, _ = self.fail_repeatedly(12)
+        self.assertGreater(min(delays[8:]), 3600 * 0.9)
+
+    def test_failure_soon_after_readmission_keeps_strikes(self):
+        _, now = self.fail_repeatedly(3)
+        self.quarantine.readmit('p', now)
+        self.assertEqual(self.quarantine.state('p', now)['strikes'], 3)
+        self.assertGreater(self.quarantine.add('p', now + 10), 120 * 0.9)
+
+    def test_forgiven_after_healthy_period(self):
+        _, now = self.fail_repeatedly(5)
+        self.quarantine.readmit('p', now)
+        self.assertLess(self.quarantine.add('p', now + 3601), 30 * 1.1)
+
+class CheckResultTest(unittest.TestCase):
+    def setUp(self):
+        self.manager = ProxyManager(auto_update=False)
+
+    def test_never_good_candidate_is_dropped(self):
+        self.manager.record_check_result('1.2.3.4:80', False)
+        self.assertEqual(len(self.manager.quarantine), 0)
+        self.assertEqual(self.manager.get_proxy_health(), [])
+
+    def test_previously_good_proxy_is_quarantined(self):
+        self.manager.load_state({'all_proxies': ['1.2.3.4:80'], 'available_proxies': ['1.2.3.4:80']})
+        self.manager.record_check_result('1.2.3.4:80', False)
+        self.assertIn('1.2.3.4:80', self.manager.quarantine)
+        self.assertEqual(self.manager.get_all_available_proxies(), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+"""
+路由缓存的不可达标记测试: 只有确定性失败或连续失败才让目标快速失败
+运行: python -m unittest test_route_cache
+"""
+import socket
+import unittest
+
+from dns_resolver import DNSError, HostNotFound
+from route_cache import RouteCache, ROUTE_DIRECT, ROUTE_UNREACHABLE
+from tunnel_proxy import TunnelProxy
+
+class RecordFailureTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = RouteCache(unreachable_after=3)
+
+    def test_transient_failures_are_not_cached(self):
+        for _ in range(2):
+            self.assertFalse(self.cache.record_failure('example.com', 443))
+        self.assertIsNone(self.cache.get('example.com', 443))
+
+    def test_consecutive_failures_mark_unreachable(self):
+        for _ in range(2):
+            self.cache.record_failure('example.com', 443)
+        self.assertTrue(self.cache.record_failure('example.com', 443))
+        self.assertEqual(self.cache.get('example.com', 443), (ROUTE_UNREACHABLE, None))
+
+    def test_success_resets_failure_count(self):
+        for _ in range(2):
+            self.cache.record_failure('example.com', 443)
+        self.cache.put('example.com', 443, ROUTE_DIRECT)
+        self.cache.invalidate('example.com', 443)
+        for _ in range(2):
+            self.assertFalse(self.cache.record_failure('example.com', 443))
+
+    def test_definitive_failure_marks_unreachable_immediately(self):
+        self.assertTrue(self.cache.record_failure('example.com', 443, definitive=True))
+        self.assertEqual(self.cache.get('example.com', 443), (ROUTE_UNREACHABLE, None))
+
+class DefinitiveFailureTest(unittest.TestCase):
+    def test_definitive_errors(self):
+        self.assertTrue(TunnelProxy.is_definitive_failure(HostNotFound('nxdomain')))
+        self.assertTrue(TunnelProxy.is_definitive_failure(ConnectionRefusedError()))
+        self.assertTrue(TunnelProxy.is_definitive_failure(socket.gaierror(socket.EAI_NONAME, 'unknown')))
+
+    def test_transient_errors(self):
+        self.assertFalse(TunnelProxy.is_definitive_failure(TimeoutError()))
+        self.assertFalse(TunnelProxy.is_definitive_failure(DNSError('timeout')))
+        self.assertFalse(TunnelProxy.is_definitive_failure(ConnectionResetError()))
+        self.assertFalse(TunnelProxy.is_definitive_failure(socket.gaierror(socket.EAI_AGAIN, 'again')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+"""
+连接建立过程的分阶段耗时
+- 每个阶段记录单调时钟的起止时间，同时计入按阶段区分的直方图 tunnel_phase_seconds
+- 采样到访问日志的连接额外输出各阶段相对 accept 的开始时间和耗时
+- 未启用时不创建 PhaseTrace，各处以 trace is None 跳过，不产生额外开销
+"""
+import time
+
+PHASE_ACCEPT = 'accept'  # accept 返回到处理线程/任务开始运行
+PHASE_HEAD = 'head'  # 读取请求头
+PHASE_QUEUE = 'connect_queue'  # asyncio 引擎等待连接线程池
+PHASE_DNS = 'dns'  # 解析目标域名
+PHASE_DIRECT = 'direct_connect'  # 直连目标的 TCP 握手
+PHASE_UPSTREAM = 'upstream_connect'  # 到上游代理的 TCP 握手（使用预热连接时没有）
+PHASE_HANDSHAKE = 'upstream_handshake'  # 向上游代理发送 CONNECT 到收到响应
+PHASE_SETUP = 'setup'  # accept 到向客户端返回 200
+
+PHASES = (PHASE_ACCEPT, PHASE_HEAD, PHASE_QUEUE, PHASE_DNS, PHASE_DIRECT,
+          PHASE_UPSTREAM, PHASE_HANDSHAKE, PHASE_SETUP)
+
+# 阶段耗时的分桶（秒），accept、DNS 缓存命中等阶段通常在毫秒以下
+PHASE_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                 0.5, 1, 2.5, 5, 10, 30)
+
+class PhaseTracer:
+    """各阶段的耗时直方图，为每个连接创建 PhaseTrace"""
+
+    def __init__(self, registry):
+        self.histograms = {
+            phase: registry.histogram('tunnel_phase_seconds', '连接建立各阶段耗时',
+                                      buckets=PHASE_BUCKETS, phase=phase)
+            for phase in PHASES
+        }
+
+    def start(self, accepted=None):
+        """开始跟踪一个连接，accepted 为 accept 返回时的单调时钟"""
+        trace = PhaseTrace(self.histograms, accepted or time.monotonic())
+        if accepted:
+            trace.record(PHASE_ACCEPT, accepted)
+        return trace
+
+class PhaseTrace:
+    """单个连接的阶段记录，连接竞速的多个线程可以同时写入"""
+
+    __slots__ = ('histograms', 'origin', 'spans')
+
+    def __init__(self, histograms, origin):
+        self.histograms = histograms
+        self.origin = origin
+        self.spans = []  # (阶段, 开始, 结束)
+
+    def record(self, phase, start, end=None):
+        """记录一个已完成的阶段，end 默认为当前时间"""
+        if end is None:
+            end = time.monotonic()
+        self.spans.append((phase, start, end))
+        self.histograms[phase].observe(end - start)
+
+    def summary(self):
+        """各阶段相对 accept 的开始时间和耗时（毫秒），并行尝试中同一阶段取最先完成的一次"""
+        phases = {}
+        for phase, start, end in sorted(self.spans, key=lambda span: span[2]):
+            if phase not in phases:
+                phases[phase] = [round((start - self.origin) * 1000, 2), round((end - start) * 1000, 2)]
+        return phases
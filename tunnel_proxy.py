@@ -3,12 +3,30 @@
 HTTP CONNECT 隧道代理服务器
 无需客户端安装证书，支持透明的HTTPS代理
 """
+import os
+import select
+import signal
 import socket
 import threading
-import select
 import time
 import logging
 from proxy_manager import ProxyManager
+from forwarding import create_copier, wait_ready
+from connect_race import ConnectRace
+from route_cache import RouteCache, ROUTE_DIRECT, ROUTE_UPSTREAM, ROUTE_UNREACHABLE
+from dns_resolver import DNSResolver, HostNotFound
+from upstream_pool import UpstreamPool
+from http_forward import HTTPForwarder
+from admission import AdmissionControl
+from tunnel_timeouts import TunnelTimeouts, EXPIRE_IDLE
+from access_log import AccessLog, dropped_log_records
+from request_head import read_request_head
+from lifecycle import GracefulShutdown, STOP_RESTART, hand_over
+from tracing import (PhaseTracer, PHASE_HEAD, PHASE_DNS, PHASE_DIRECT, PHASE_UPSTREAM,
+                     PHASE_HANDSHAKE, PHASE_SETUP)
+from profiling import ProfilingHooks
+from metrics import (MetricsRegistry, MetricsServer, stats_entries, proxy_manager_entries,
+                     histogram_summary)
 
 # 配置日志
 logging.basicConfig(
@@ -17,158 +35,440 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 累计型统计项（计数器），多进程汇总时 worker 重启后仍需计入总数
+CUMULATIVE_STATS = ('connections', 'bytes_transferred', 'bytes_in', 'bytes_out', 'connect_failures',
+                    'route_cache_hits', 'route_cache_misses', 'route_cache_evictions',
+                    'dns_cache_hits', 'dns_cache_misses', 'dns_prefetches', 'dns_failures',
+                    'upstream_pool_hits', 'upstream_pool_misses', 'upstream_pool_stale',
+                    'http_requests', 'origin_pool_hits', 'origin_pool_misses',
+                    'admission_rejected_global', 'admission_rejected_per_ip', 'admission_rejected_pending',
+                    'tunnel_idle_timeouts', 'tunnel_lifetime_expirations',
+                    'access_log_written', 'access_log_dropped', 'log_records_dropped')
+
 class TunnelProxy:
-    def __init__(self, host='0.0.0.0', port=10800):
+    def __init__(self, host='0.0.0.0', port=10800, forward_backend='auto', buffer_size=65536,
+                 proxy_manager=None, reuse_port=False,
+                 connect_stagger=0.3, connect_fanout=2, connect_deadline=15,
+                 route_cache_size=10000, route_cache_ttl=600, unreachable_ttl=30, unreachable_after=3,
+                 dns_servers=None, dns_ttl=60,
+                 upstream_pool_proxies=3, upstream_pool_per_proxy=2, upstream_pool_idle_timeout=30,
+                 origin_pool_size=8, origin_idle_timeout=60,
+                 max_connections=0, max_connections_per_ip=0, max_pending=0,
+                 tunnel_idle_timeout=600, tunnel_max_lifetime=0,
+                 access_log=None, access_log_sample=1.0,
+                 drain_timeout=30, listen_fd=None, on_ready=None, restart_on_hup=True,
+                 trace_phases=False, debug_endpoints=False, profile_dir=None,
+                 metrics_host=None, metrics_port=0):
         self.host = host
         self.port = port
-        self.proxy_manager = ProxyManager()
-        self.stats = {
-            'connections': 0,
-            'bytes_transferred': 0,
-            'active_connections': 0
+        # 多进程模式下各 worker 以 SO_REUSEPORT 绑定同一端口，由内核分配连接
+        self.reuse_port = reuse_port
+        # 数据转发后端: auto/splice/buffer，以及单次转发的缓冲区大小
+        self.forward_backend = forward_backend
+        self.buffer_size = buffer_size
+        self.proxy_manager = proxy_manager or ProxyManager()
+        # 竞速连接: 直连先发起，每隔 connect_stagger 秒追加一个上游代理尝试，
+        # 最多 connect_fanout 个上游代理，整体不超过 connect_deadline 秒
+        self.connect_stagger = connect_stagger
+        self.connect_fanout = connect_fanout
+        self.connect_deadline = connect_deadline
+        self.direct_timeout = 10  # 单次直连超时（秒）
+        self.proxy_timeout = 15  # 单次上游代理连接超时（秒）
+        # 按 host:port 记忆的路由: 直连/上游代理/不可达
+        self.route_cache = RouteCache(
+            max_size=route_cache_size,
+            direct_ttl=route_cache_ttl,
+            upstream_ttl=route_cache_ttl,
+            unreachable_ttl=unreachable_ttl,
+            unreachable_after=unreachable_after
+        )
+        # 带 TTL 缓存的 DNS 解析，dns_servers 为空时使用系统解析器
+        self.resolver = DNSResolver(nameservers=dns_servers, default_ttl=dns_ttl)
+        # 到最优上游代理的预热连接池，upstream_pool_proxies=0 时禁用
+        self.upstream_pool = None
+        if upstream_pool_proxies > 0 and upstream_pool_per_proxy > 0:
+            self.upstream_pool = UpstreamPool(
+                self.proxy_manager,
+                pool_proxies=upstream_pool_proxies,
+                per_proxy=upstream_pool_per_proxy,
+                idle_timeout=upstream_pool_idle_timeout
+            )
+        # 线程安全的运行指标，可通过 metrics_port 上的 HTTP 服务获取
+        self.metrics = MetricsRegistry()
+        self.connections_total = self.metrics.counter('tunnel_connections_total', '客户端连接总数')
+        self.active_tunnels = self.metrics.gauge('tunnel_active', '活跃隧道数')
+        self.bytes_in = self.metrics.counter(
+            'tunnel_bytes_total', '隧道转发字节数 (in: 客户端->目标, out: 目标->客户端)', direction='in')
+        self.bytes_out = self.metrics.counter(
+            'tunnel_bytes_total', '隧道转发字节数 (in: 客户端->目标, out: 目标->客户端)', direction='out')
+        self.connect_latency = {
+            route: self.metrics.histogram('tunnel_connect_seconds', '到目标的连接建立耗时', route=route)
+            for route in (ROUTE_DIRECT, ROUTE_UPSTREAM)
         }
+        self.connect_failures = self.metrics.counter('tunnel_connect_failures_total', '连接目标失败次数')
+        # 连接建立各阶段耗时（accept、读请求头、DNS、直连、上游连接和 CONNECT 握手），未启用时为 None
+        self.tracer = PhaseTracer(self.metrics) if trace_phases else None
+        # 按需诊断: SIGUSR1 输出线程栈，SIGUSR2 采样分析；debug_endpoints 时指标服务提供 /debug/*
+        self.profiling = ProfilingHooks(profile_dir)
+        self.debug_endpoints = debug_endpoints
+        # 普通 HTTP 正向代理: 客户端 keep-alive，源站连接按 host:port 复用
+        self.http_forwarder = HTTPForwarder(self, max_per_origin=origin_pool_size,
+                                            idle_timeout=origin_idle_timeout)
+        # 准入控制: 全局/单 IP 并发连接上限和握手队列上限，超出时返回 503
+        self.admission = AdmissionControl(max_connections, max_connections_per_ip, max_pending)
+        # 隧道空闲超时和最长存活时间（秒），0 表示不限制
+        self.tunnel_timeouts = TunnelTimeouts(tunnel_idle_timeout, tunnel_max_lifetime)
+        # 结构化访问日志（JSON 行），access_log 为输出路径（'-' 为标准输出），None 时禁用
+        self.access_log = AccessLog(access_log, access_log_sample) if access_log else None
+        # 优雅退出: SIGTERM 时停止 accept，最多等待 drain_timeout 秒让已有连接结束；
+        # SIGHUP 时把监听 socket 交给新进程（restart_on_hup=False 时忽略，由 supervisor 处理）
+        self.drain_timeout = drain_timeout
+        self.shutdown = GracefulShutdown(self.stop_accepting, self.restart if restart_on_hup else None)
+        # 信号处理函数只计数并通过管道唤醒主线程，第二次 SIGTERM 时不再等待排空
+        self.stop_requests = 0
+        self.wakeup_fds = None
+        self.listen_fd = listen_fd  # 旧进程传下来的监听 socket
+        self.on_ready = on_ready  # 开始 accept 时调用
+        self.listening = threading.Event()
+        self.server_socket = None
+        self.metrics_host = host if metrics_host is None else metrics_host
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+    
+    def parse_connect_target(self, request_line):
+        """解析CONNECT请求行，返回 (host, port)，格式错误时返回 None"""
+        # 解析CONNECT请求: CONNECT example.com:443 HTTP/1.1
+        parts = request_line.split()
+        if len(parts) < 2 or parts[0] != 'CONNECT':
+            return None
+        
+        # 提取目标主机和端口
+        target = parts[1]
+        if ':' in target:
+            host, port = target.split(':', 1)
+            port = int(port)
+        else:
+            host = target
+            port = 443  # 默认HTTPS端口
+        return host, port
     
-    def handle_connect_request(self, client_socket, request_line):
-        """处理HTTP CONNECT请求"""
+    def new_access_record(self, client_socket, target):
+        """为采样到的连接创建访问记录，未采样或未启用时返回 None"""
+        if not self.access_log or not self.access_log.sample():
+            return None
+        try:
+            client = '%s:%s' % client_socket.getpeername()[:2]
+        except OSError:
+            client = None
+        return {'client': client, 'target': target, 'route': None, 'proxy': None,
+                'status': None, 'setup_ms': None, 'bytes_in': 0, 'bytes_out': 0,
+                'started': time.monotonic()}
+    
+    def finish_access_record(self, record):
+        """补全耗时并提交访问记录"""
+        if record is None:
+            return
+        record['duration_ms'] = round((time.monotonic() - record.pop('started')) * 1000, 1)
+        self.access_log.write(record)
+    
+    def new_trace(self, accepted=None):
+        """启用阶段跟踪时为连接创建 PhaseTrace，accepted 为 accept 返回的时间"""
+        return self.tracer.start(accepted) if self.tracer else None
+    
+    def finish_setup_trace(self, trace, record):
+        """已向客户端返回 200: 记录建立耗时，并将各阶段写入访问记录"""
+        if trace is None:
+            return
+        trace.record(PHASE_SETUP, trace.origin)
+        if record:
+            record['phases'] = trace.summary()
+    
+    def handle_connect_request(self, client_socket, request_line, ticket=None, early_data=b'', trace=None):
+        """处理HTTP CONNECT请求，early_data 为客户端紧跟请求头发送的数据，隧道建立后转发给目标
+
+        trace 为阶段跟踪（未启用时为 None）
+        """
+        record = None
         try:
-            # 解析CONNECT请求: CONNECT example.com:443 HTTP/1.1
-            parts = request_line.split()
-            if len(parts) < 2 or parts[0] != 'CONNECT':
+            target = self.parse_connect_target(request_line)
+            if not target:
                 self.send_error_response(client_socket, "400 Bad Request")
                 return False
+            host, port = target
             
-            # 提取目标主机和端口
-            target = parts[1]
-            if ':' in target:
-                host, port = target.split(':', 1)
-                port = int(port)
-            else:
-                host = target
-                port = 443  # 默认HTTPS端口
-            
-            logger.info(f"CONNECT请求: {host}:{port}")
+            logger.debug("CONNECT请求: %s:%s", host, port)
+            record = self.new_access_record(client_socket, f"{host}:{port}")
             
             # 建立到目标服务器的连接
-            target_socket = self.connect_to_target(host, port)
+            target_socket = self.connect_to_target(host, port, record, trace)
+            if ticket:
+                ticket.established()
             if not target_socket:
+                if record:
+                    record['status'] = 502
                 self.send_error_response(client_socket, "502 Bad Gateway")
                 return False
+            if record:
+                record['status'] = 200
+                record['setup_ms'] = round((time.monotonic() - record['started']) * 1000, 1)
             
             # 发送连接成功响应
             response = "HTTP/1.1 200 Connection Established\r\n\r\n"
             client_socket.send(response.encode())
+            self.finish_setup_trace(trace, record)
+            if early_data:
+                target_socket.sendall(early_data)
+                self.bytes_in.inc(len(early_data))
             
             # 开始隧道转发
-            self.start_tunnel(client_socket, target_socket, f"{host}:{port}")
+            bytes_in, bytes_out = self.start_tunnel(client_socket, target_socket, f"{host}:{port}")
+            if record:
+                record['bytes_in'] = bytes_in + len(early_data)
+                record['bytes_out'] = bytes_out
             return True
             
         except Exception as e:
             logger.error(f"处理CONNECT请求失败: {e}")
+            if record and record['status'] is None:
+                record['status'] = 500
             self.send_error_response(client_socket, "500 Internal Server Error")
             return False
+        finally:
+            self.finish_access_record(record)
     
-    def connect_to_target(self, host, port):
-        """连接到目标服务器，可选择通过上游代理"""
-        # 尝试直接连接
+    def connect_direct(self, race, host, port, trace=None):
+        """直接连接目标服务器，依次尝试解析得到的各个地址"""
+        started = trace and time.monotonic()
         try:
-            target_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            target_socket.settimeout(10)
-            target_socket.connect((host, port))
-            logger.info(f"直接连接到 {host}:{port} 成功")
-            return target_socket
-        except Exception as direct_error:
-            logger.warning(f"直接连接 {host}:{port} 失败: {direct_error}")
+            addresses = self.resolver.resolve(host)
+        except Exception as dns_error:
+            logger.warning(f"解析 {host} 失败: {dns_error}")
+            raise
+        if trace:
+            trace.record(PHASE_DNS, started)
         
-        # 尝试通过上游代理连接
-        proxy = self.proxy_manager.get_random_proxy()
-        if proxy:
+        # 多个地址时平分直连超时，某个地址不可达时尽快切换到下一个
+        timeout = max(self.direct_timeout / len(addresses), 1)
+        last_error = None
+        for family, address in addresses:
+            target_socket = socket.socket(family, socket.SOCK_STREAM)
+            race.register(target_socket)
+            started = trace and time.monotonic()
             try:
-                proxy_parts = proxy.replace('http://', '').split(':')
-                proxy_host = proxy_parts[0]
-                proxy_port = int(proxy_parts[1])
-                
-                proxy_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                proxy_socket.settimeout(15)
+                target_socket.settimeout(timeout)
+                target_socket.connect((address, port))
+            except Exception as direct_error:
+                target_socket.close()
+                if race.cancelled:
+                    raise
+                last_error = direct_error
+                self.resolver.report_failure(host, family, address)
+                continue
+            if trace:
+                trace.record(PHASE_DIRECT, started)
+            logger.debug("直接连接到 %s:%s (%s) 成功", host, port, address)
+            return target_socket
+        
+        logger.warning(f"直接连接 {host}:{port} 失败: {last_error}")
+        raise last_error
+    
+    def connect_via_proxy(self, race, proxy, host, port, use_pool=True, trace=None):
+        """通过上游代理连接目标服务器"""
+        proxy_parts = proxy.replace('http://', '').split(':')
+        proxy_host = proxy_parts[0]
+        proxy_port = int(proxy_parts[1])
+        
+        start = time.monotonic()
+        # 优先使用预热好的空闲连接，省去 TCP 握手
+        proxy_socket = self.upstream_pool.acquire(proxy) if self.upstream_pool and use_pool else None
+        pooled = proxy_socket is not None
+        if not pooled:
+            proxy_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        race.register(proxy_socket)
+        try:
+            proxy_socket.settimeout(self.proxy_timeout)
+            if not pooled:
                 proxy_socket.connect((proxy_host, proxy_port))
-                
-                # 通过代理发送CONNECT请求
-                connect_request = f"CONNECT {host}:{port} HTTP/1.1\r\n\r\n"
-                proxy_socket.send(connect_request.encode())
-                
-                # 读取代理响应
-                response = proxy_socket.recv(4096).decode()
-                if "200 Connection Established" in response or "200 OK" in response:
-                    logger.info(f"通过代理 {proxy} 连接到 {host}:{port} 成功")
-                    self.proxy_manager.mark_proxy_success(proxy)
-                    return proxy_socket
-                else:
-                    logger.warning(f"代理 {proxy} 响应错误: {response[:100]}")
-                    self.proxy_manager.mark_proxy_failed(proxy)
-                    proxy_socket.close()
-                    
-            except Exception as proxy_error:
+                if trace:
+                    trace.record(PHASE_UPSTREAM, start)
+            
+            # 通过代理发送CONNECT请求
+            handshake_started = trace and time.monotonic()
+            connect_request = f"CONNECT {host}:{port} HTTP/1.1\r\n\r\n"
+            proxy_socket.send(connect_request.encode())
+            
+            # 读取代理响应
+            response = proxy_socket.recv(4096).decode()
+            if pooled and not response:
+                raise ConnectionError("预热连接已被代理关闭")
+        except Exception as proxy_error:
+            proxy_socket.close()
+            if pooled and not race.cancelled:
+                # 预热连接可能在存活检查后被代理关闭，改用新连接重试一次
+                return self.connect_via_proxy(race, proxy, host, port, use_pool=False, trace=trace)
+            # 被取消的尝试不计入代理失败
+            if not race.cancelled:
                 logger.warning(f"代理连接 {proxy} 失败: {proxy_error}")
                 self.proxy_manager.mark_proxy_failed(proxy)
-                if 'proxy_socket' in locals():
-                    proxy_socket.close()
+            raise
+        
+        if "200 Connection Established" in response or "200 OK" in response:
+            if trace:
+                trace.record(PHASE_HANDSHAKE, handshake_started)
+            logger.debug("通过代理 %s 连接到 %s:%s 成功", proxy, host, port)
+            # 预热连接省去了 TCP 握手，耗时与新建连接不可比，只计入成功、不更新延迟
+            self.proxy_manager.mark_proxy_success(proxy, None if pooled else time.monotonic() - start)
+            return proxy_socket
+        
+        logger.warning(f"代理 {proxy} 响应错误: {response[:100]}")
+        self.proxy_manager.mark_proxy_failed(proxy)
+        proxy_socket.close()
+        raise ConnectionError(f"代理 {proxy} 响应错误")
+    
+    def connect_attempts(self, host, port, route=None, trace=None):
+        """按顺序生成连接尝试
+
+        默认先直连，再依次通过不同的上游代理；路由缓存表明需要上游代理时，
+        先尝试上次成功的代理和其他代理，直连放在最后。
+        上游代理优先选用有预热连接的代理，其余按选择策略选取
+        """
+        direct = ('direct', lambda race: self.connect_direct(race, host, port, trace))
+        used = set()
         
-        return None
+        if route and route[0] == ROUTE_UPSTREAM and route[1]:
+            proxy = route[1]
+            used.add(proxy)
+            yield proxy, lambda race: self.connect_via_proxy(race, proxy, host, port, trace=trace)
+        elif not route or route[0] != ROUTE_UPSTREAM:
+            yield direct
+        
+        warm = self.upstream_pool.warm_proxy() if self.upstream_pool else None
+        for _ in range(self.connect_fanout * 2):
+            if len(used) >= self.connect_fanout:
+                break
+            if warm and warm not in used and self.proxy_manager.is_available(warm):
+                proxy = warm
+            else:
+                proxy = self.proxy_manager.get_random_proxy()
+            if not proxy:
+                break
+            if proxy in used:
+                continue
+            used.add(proxy)
+            yield proxy, lambda race, proxy=proxy: self.connect_via_proxy(race, proxy, host, port, trace=trace)
+        
+        if route and route[0] == ROUTE_UPSTREAM:
+            yield direct
+    
+    @staticmethod
+    def is_definitive_failure(error):
+        """直连的错误是否说明目标本身不可达（域名不存在、连接被拒绝），而非网络波动或超时"""
+        if isinstance(error, HostNotFound):
+            return True
+        if isinstance(error, socket.gaierror):
+            return error.errno == socket.EAI_NONAME
+        return isinstance(error, ConnectionRefusedError)
+    
+    def connect_to_target(self, host, port, info=None, trace=None):
+        """连接到目标服务器: 直连与上游代理错峰竞速，首个成功者胜出
+
+        info 不为 None 时写入实际使用的路由 (route) 和上游代理 (proxy)；
+        trace 不为 None 时记录 DNS、直连、上游连接和 CONNECT 握手的耗时
+        """
+        route = self.route_cache.get(host, port)
+        if route and route[0] == ROUTE_UNREACHABLE:
+            logger.debug("路由缓存: %s:%s 近期不可达，快速失败", host, port)
+            self.connect_failures.inc()
+            if info is not None:
+                info['route'] = ROUTE_UNREACHABLE
+            return None
+        
+        start = time.monotonic()
+        race = ConnectRace(stagger=self.connect_stagger, deadline=self.connect_deadline)
+        label, target_socket, errors = race.run(self.connect_attempts(host, port, route, trace))
+        if target_socket is None:
+            logger.warning(f"连接 {host}:{port} 失败，共尝试 {len(errors)} 次")
+            definitive = any(label == 'direct' and self.is_definitive_failure(error) for label, error in errors)
+            self.route_cache.record_failure(host, port, definitive)
+            self.connect_failures.inc()
+            return None
+        
+        if label == 'direct':
+            self.route_cache.put(host, port, ROUTE_DIRECT)
+            self.connect_latency[ROUTE_DIRECT].observe(time.monotonic() - start)
+        else:
+            self.route_cache.put(host, port, ROUTE_UPSTREAM, label)
+            self.connect_latency[ROUTE_UPSTREAM].observe(time.monotonic() - start)
+        if info is not None:
+            info['route'] = ROUTE_DIRECT if label == 'direct' else ROUTE_UPSTREAM
+            info['proxy'] = None if label == 'direct' else label
+        return target_socket
+    
+    def abort_tunnel(self, client_socket, target_socket):
+        """中断隧道两端，唤醒阻塞在 recv/send 上的转发"""
+        for sock in (client_socket, target_socket):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+    
+    def register_tunnel_timer(self, client_socket, target_socket, target_info):
+        """登记隧道的空闲超时和最长存活时间"""
+        def on_expire(reason):
+            logger.debug("隧道 %s %s，已关闭", target_info, '空闲超时' if reason == EXPIRE_IDLE else '达到最长存活时间')
+            self.abort_tunnel(client_socket, target_socket)
+        return self.tunnel_timeouts.register(on_expire)
     
     def start_tunnel(self, client_socket, target_socket, target_info):
-        """启动双向数据转发隧道"""
-        self.stats['active_connections'] += 1
+        """启动双向数据转发隧道，返回 (客户端->目标字节数, 目标->客户端字节数)"""
+        self.active_tunnels.inc()
+        # 隧道期间使用阻塞 socket: 空闲时线程阻塞在 recv 上，不产生任何唤醒，
+        # 超时由 tunnel_timeouts 统一处理
+        client_socket.settimeout(None)
+        target_socket.settimeout(None)
+        timer = self.register_tunnel_timer(client_socket, target_socket, target_info)
+        
+        transferred = {}
         
-        def forward_data(source, destination, direction):
-            """单向数据转发"""
+        def forward_data(source, destination, direction, byte_counter):
+            """单向数据转发，源端 EOF 时半关闭目标端的写方向"""
+            bytes_count = 0
+            copier = None
             try:
-                bytes_count = 0
+                copier = create_copier(self.forward_backend, self.buffer_size)
                 while True:
-                    # 使用select进行非阻塞检查
-                    ready, _, _ = select.select([source], [], [], 1.0)
-                    if ready:
-                        data = source.recv(4096)
-                        if not data:
-                            break
-                        destination.send(data)
-                        bytes_count += len(data)
-                        self.stats['bytes_transferred'] += len(data)
-                    else:
-                        # 检查连接是否仍然活跃
-                        try:
-                            source.settimeout(0.1)
-                            test_data = source.recv(1, socket.MSG_PEEK)
-                            if not test_data:
-                                break
-                        except socket.timeout:
-                            continue
-                        except:
-                            break
-                        finally:
-                            source.settimeout(None)
-                            
+                    n = copier.transfer(source, destination)
+                    if n is None:
+                        wait_ready(source)
+                        continue
+                    if not n:
+                        break
+                    bytes_count += n
+                    byte_counter.inc(n)
+                    timer.touch()
+                destination.shutdown(socket.SHUT_WR)
             except Exception as e:
                 logger.debug(f"数据转发结束 {direction}: {e}")
+                # 任一方向出错时中断整个隧道
+                self.abort_tunnel(client_socket, target_socket)
             finally:
-                logger.info(f"隧道关闭 {target_info} - {direction}: 传输 {bytes_count} 字节")
+                if copier:
+                    copier.close()
+                transferred[byte_counter] = bytes_count
+                logger.debug("隧道关闭 %s - %s: 传输 %d 字节", target_info, direction, bytes_count)
         
-        # 创建双向转发线程
-        client_to_target = threading.Thread(
-            target=forward_data,
-            args=(client_socket, target_socket, f"客户端->目标"),
-            daemon=True
-        )
+        # 目标->客户端在新线程中转发，客户端->目标在当前线程中转发
         target_to_client = threading.Thread(
             target=forward_data,
-            args=(target_socket, client_socket, f"目标->客户端"),
+            args=(target_socket, client_socket, f"目标->客户端", self.bytes_out),
             daemon=True
         )
-        
-        client_to_target.start()
         target_to_client.start()
+        forward_data(client_socket, target_socket, f"客户端->目标", self.bytes_in)
         
-        # 等待任一方向的连接关闭
-        client_to_target.join()
+        # 等待两个方向都结束
         target_to_client.join()
+        timer.close()
         
         # 清理连接
         try:
@@ -180,7 +480,8 @@ class TunnelProxy:
         except:
             pass
             
-        self.stats['active_connections'] -= 1
+        self.active_tunnels.dec()
+        return transferred.get(self.bytes_in, 0), transferred.get(self.bytes_out, 0)
     
     def send_error_response(self, client_socket, error):
         """发送HTTP错误响应"""
@@ -190,35 +491,43 @@ class TunnelProxy:
         except:
             pass
     
-    def handle_client(self, client_socket, client_address):
-        """处理客户端连接"""
+    def is_http_request(self, request_line):
+        """是否为绝对 URI 形式的普通 HTTP 代理请求"""
+        parts = request_line.split(' ', 2)
+        return len(parts) == 3 and parts[1].lower().startswith('http://')
+    
+    def handle_client(self, client_socket, client_address, ticket=None, accepted=None):
+        """处理客户端连接，ticket 为准入控制分配的凭据，accepted 为 accept 返回的时间（阶段跟踪用）"""
         try:
-            self.stats['connections'] += 1
-            logger.info(f"新连接来自: {client_address}")
+            self.connections_total.inc()
+            logger.debug("新连接来自: %s", client_address)
+            trace = self.new_trace(accepted)
             
-            # 读取客户端请求
+            # 读取客户端请求头
             client_socket.settimeout(30)  # 30秒超时
-            request_data = b""
-            
-            while b"\r\n\r\n" not in request_data:
-                chunk = client_socket.recv(1024)
-                if not chunk:
-                    break
-                request_data += chunk
-                if len(request_data) > 8192:  # 限制请求大小
-                    break
+            head_started = trace and time.monotonic()
+            head = read_request_head(client_socket)
+            if trace:
+                trace.record(PHASE_HEAD, head_started)
             
-            if not request_data:
+            if not head.length:
                 logger.warning(f"客户端 {client_address} 未发送数据")
                 return
             
-            request_text = request_data.decode('utf-8', errors='ignore')
-            request_lines = request_text.split('\r\n')
-            request_line = request_lines[0]
+            request_line = head.request_line()
+            is_connect = request_line.startswith('CONNECT')
+            # 只复制需要的部分，隧道存续期间不再持有请求头的缓冲区
+            payload = head.leftover() if is_connect else head.data()
+            del head
             
             # 处理CONNECT请求
-            if request_line.startswith('CONNECT'):
-                self.handle_connect_request(client_socket, request_line)
+            if is_connect:
+                self.handle_connect_request(client_socket, request_line, ticket, payload, trace)
+            elif self.is_http_request(request_line):
+                # 普通 HTTP 代理请求，连接上的后续请求也在此处理
+                if ticket:
+                    ticket.established()
+                self.http_forwarder.handle(client_socket, payload)
             else:
                 # 不支持的请求类型
                 logger.warning(f"不支持的请求: {request_line}")
@@ -233,6 +542,75 @@ class TunnelProxy:
                 client_socket.close()
             except:
                 pass
+            if ticket:
+                ticket.release()
+    
+    def reject_connection(self, client_socket, client_address, reason):
+        """拒绝超出准入限制的连接"""
+        logger.debug(f"拒绝连接 {client_address} ({reason})")
+        try:
+            client_socket.setblocking(False)
+            client_socket.send(b"HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\nConnection: close\r\n\r\n")
+        except OSError:
+            pass
+        finally:
+            client_socket.close()
+    
+    def get_stats(self):
+        """获取服务器统计信息（含路由缓存、DNS 缓存和上游连接池）"""
+        bytes_in = self.bytes_in.value
+        bytes_out = self.bytes_out.value
+        stats = {
+            'connections': self.connections_total.value,
+            'active_connections': self.active_tunnels.value,
+            'bytes_transferred': bytes_in + bytes_out,
+            'bytes_in': bytes_in,
+            'bytes_out': bytes_out,
+            'connect_failures': self.connect_failures.value
+        }
+        stats.update(self.route_cache.get_stats())
+        stats.update(self.resolver.get_stats())
+        if self.upstream_pool:
+            stats.update(self.upstream_pool.get_stats())
+        stats.update(self.http_forwarder.get_stats())
+        stats.update(self.admission.get_stats())
+        stats.update(self.tunnel_timeouts.get_stats())
+        if self.access_log:
+            stats.update(self.access_log.get_stats())
+        stats['log_records_dropped'] = dropped_log_records()
+        return stats
+    
+    def collect_metrics(self):
+        """导出 Prometheus 指标条目"""
+        entries = self.metrics.collect()
+        native = {'connections', 'active_connections', 'bytes_transferred', 'bytes_in', 'bytes_out',
+                  'connect_failures'}
+        stats = {k: v for k, v in self.get_stats().items() if k not in native}
+        entries.extend(stats_entries(stats, CUMULATIVE_STATS))
+        entries.extend(proxy_manager_entries(self.proxy_manager))
+        return entries
+    
+    def metrics_json(self):
+        """导出 JSON 格式的状态"""
+        return {
+            'stats': self.get_stats(),
+            'histograms': histogram_summary(self.metrics.collect()),
+            'proxy_pool': self.proxy_manager.get_proxy_stats(),
+            'proxies': self.proxy_manager.get_proxy_health()
+        }
+    
+    def start_background_services(self):
+        """启动状态日志、上游连接池和指标服务"""
+        self.start_stats_logger()
+        if self.upstream_pool:
+            self.upstream_pool.start()
+        if self.metrics_port:
+            try:
+                self.metrics_server = MetricsServer(self, self.metrics_host, self.metrics_port,
+                                                    self.profiling if self.debug_endpoints else None)
+                self.metrics_server.start()
+            except OSError as e:
+                logger.error(f"❌ 指标服务启动失败: {e}")
     
     def start_stats_logger(self):
         """启动状态日志线程"""
@@ -240,24 +618,123 @@ class TunnelProxy:
             while True:
                 time.sleep(60)  # 每分钟记录一次
                 proxy_stats = self.proxy_manager.get_proxy_stats()
+                stats = self.get_stats()
                 logger.info(
-                    f"状态 - 总连接: {self.stats['connections']}, "
-                    f"活跃连接: {self.stats['active_connections']}, "
-                    f"传输字节: {self.stats['bytes_transferred']}, "
+                    f"状态 - 总连接: {stats['connections']}, "
+                    f"活跃连接: {stats['active_connections']}, "
+                    f"传输字节: {stats['bytes_transferred']}, "
+                    f"路由缓存命中/未命中: {stats['route_cache_hits']}/{stats['route_cache_misses']}, "
+                    f"DNS缓存命中/未命中: {stats['dns_cache_hits']}/{stats['dns_cache_misses']}, "
+                    f"拒绝连接: {stats['admission_rejected_global'] + stats['admission_rejected_per_ip'] + stats['admission_rejected_pending']}, "
                     f"可用代理: {proxy_stats['available_proxies']}/{proxy_stats['total_proxies']}"
                 )
         
         stats_thread = threading.Thread(target=log_stats, daemon=True)
         stats_thread.start()
     
-    def start(self):
-        """启动代理服务器"""
+    def create_server_socket(self, backlog=128):
+        """创建并绑定监听 socket，平滑重启时直接使用旧进程传下来的 socket"""
+        if self.listen_fd is not None:
+            server_socket = socket.socket(fileno=self.listen_fd)
+            self.listen_fd = None
+            return server_socket
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        
+        if self.reuse_port:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         try:
             server_socket.bind((self.host, self.port))
-            server_socket.listen(128)
+            server_socket.listen(backlog)
+        except Exception:
+            server_socket.close()
+            raise
+        return server_socket
+    
+    def mark_ready(self):
+        """已开始 accept: 通知等待方（worker 上报、平滑重启的旧进程）"""
+        self.listening.set()
+        if self.on_ready:
+            self.on_ready()
+    
+    def restart(self):
+        """SIGHUP: 启动继承监听 socket 的新进程，新进程就绪后返回 True"""
+        return hand_over(self.proxy_manager, self.server_socket)
+    
+    def stop_accepting(self):
+        """SIGTERM: 记录停止请求，主线程被唤醒管道唤醒后停止 accept
+
+        不在信号处理函数中抛出异常，避免打断准入与线程交接（泄漏准入名额和连接）
+        """
+        self.stop_requests += 1
+    
+    def begin_drain(self):
+        """停止 accept 后的准备: 保存代理池状态供下一个进程使用"""
+        self.proxy_manager.save_state_file()
+        if self.shutdown.reason == STOP_RESTART and self.metrics_server:
+            self.metrics_server.stop()
+        logger.info(f"🛑 停止接受新连接，等待 {self.admission.active} 个连接结束 (最长 {self.drain_timeout} 秒)...")
+    
+    def finish_drain(self):
+        if self.admission.active:
+            logger.warning(f"仍有 {self.admission.active} 个连接未结束，强制关闭")
+        else:
+            logger.info("所有连接已结束")
+        if self.access_log:
+            self.access_log.close()
+    
+    def drain(self):
+        """等待已有连接结束，超过 drain_timeout 或再次收到 SIGTERM 时不再等待"""
+        deadline = time.monotonic() + self.drain_timeout
+        self.begin_drain()
+        while self.admission.active and self.stop_requests < 2 and time.monotonic() < deadline:
+            time.sleep(0.1)
+        self.finish_drain()
+    
+    def accept_backlog(self, server_socket):
+        """接收已在监听队列中的连接，避免关闭监听 socket 时被重置
+
+        平滑重启时监听 socket 由新进程继续使用，队列中的连接由新进程接收，不调用此方法
+        """
+        server_socket.setblocking(False)
+        while True:
+            try:
+                client_socket, client_address = server_socket.accept()
+            except OSError:
+                return
+            client_socket.setblocking(True)
+            self.dispatch(client_socket, client_address)
+    
+    def dispatch(self, client_socket, client_address):
+        """准入判断后在新线程中处理客户端连接"""
+        accepted = self.tracer and time.monotonic()
+        # 超出准入限制时直接返回 503，不再创建线程
+        ticket, reason = self.admission.admit(client_address[0])
+        if ticket is None:
+            self.reject_connection(client_socket, client_address, reason)
+            return
+        
+        # 为每个客户端创建处理线程
+        client_thread = threading.Thread(
+            target=self.handle_client,
+            args=(client_socket, client_address, ticket, accepted),
+            daemon=True
+        )
+        try:
+            client_thread.start()
+        except RuntimeError as e:
+            # 线程数达到系统上限
+            logger.error(f"无法创建处理线程: {e}")
+            ticket.release()
+            self.reject_connection(client_socket, client_address, 'threads')
+    
+    def start(self):
+        """启动代理服务器"""
+        server_socket = None
+        try:
+            server_socket = self.server_socket = self.create_server_socket()
+            # 监听 socket 可能与平滑重启的另一个进程共用，使用非阻塞模式: 与唤醒管道一起
+            # 等待可读后再 accept，被另一进程抢先接收时继续等待
+            server_socket.setblocking(False)
             
             logger.info(f"🚀 HTTP CONNECT隧道代理服务器启动")
             logger.info(f"📍 监听地址: {self.host}:{self.port}")
@@ -265,26 +742,47 @@ class TunnelProxy:
             logger.info(f"✅ 无需安装证书，支持所有HTTPS网站")
             logger.info("=" * 50)
             
-            # 启动状态日志
-            self.start_stats_logger()
+            # 启动状态日志、上游连接池和指标服务
+            self.start_background_services()
+            if self.shutdown.install():
+                # 信号可能由任意线程接收，通过唤醒管道让主线程从 select 中返回并执行信号处理函数
+                self.wakeup_fds = os.pipe()
+                for fd in self.wakeup_fds:
+                    os.set_blocking(fd, False)
+                signal.set_wakeup_fd(self.wakeup_fds[1])
+            self.profiling.install()
+            self.mark_ready()
             
-            while True:
-                client_socket, client_address = server_socket.accept()
-                
-                # 为每个客户端创建处理线程
-                client_thread = threading.Thread(
-                    target=self.handle_client,
-                    args=(client_socket, client_address),
-                    daemon=True
-                )
-                client_thread.start()
-                
+            while not self.stop_requests:
+                waiting = [server_socket, self.wakeup_fds[0]] if self.wakeup_fds else [server_socket]
+                readable, _, _ = select.select(waiting, [], [], None if self.wakeup_fds else 1.0)
+                if self.wakeup_fds and self.wakeup_fds[0] in readable:
+                    os.read(self.wakeup_fds[0], 512)
+                if server_socket not in readable:
+                    continue
+                try:
+                    client_socket, client_address = server_socket.accept()
+                except BlockingIOError:
+                    continue
+                client_socket.setblocking(True)
+                self.dispatch(client_socket, client_address)
+            
+            if self.shutdown.reason != STOP_RESTART:
+                self.accept_backlog(server_socket)
         except KeyboardInterrupt:
             logger.info("\n🛑 收到停止信号，正在关闭服务器...")
         except Exception as e:
             logger.error(f"❌ 服务器错误: {e}")
         finally:
-            server_socket.close()
+            if server_socket:
+                server_socket.close()
+            if self.wakeup_fds:
+                signal.set_wakeup_fd(-1)
+                for fd in self.wakeup_fds:
+                    os.close(fd)
+                self.wakeup_fds = None
+            if self.shutdown.reason:
+                self.drain()
             logger.info("✅ 服务器已关闭")
 
 def main():
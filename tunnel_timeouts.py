@@ -0,0 +1,139 @@
+"""
+隧道空闲超时与最长存活时间
+所有隧道共用一个后台线程和按截止时间排序的最小堆，转发数据时只记录最近活动时间，
+空闲隧道不产生任何唤醒或系统调用；到期时检查实际截止时间，未到则重新入堆，
+已到则调用隧道的中断回调（shutdown 两端 socket，唤醒阻塞在 recv 上的转发）
+"""
+import heapq
+import itertools
+import threading
+import time
+
+EXPIRE_IDLE = 'idle'
+EXPIRE_LIFETIME = 'lifetime'
+
+class TunnelTimer:
+    """单条隧道的超时状态"""
+
+    __slots__ = ('manager', 'started', 'last_activity', 'on_expire', 'closed', 'queued')
+
+    def __init__(self, manager, on_expire):
+        self.manager = manager
+        self.started = self.last_activity = time.monotonic()
+        self.on_expire = on_expire
+        self.closed = False
+        self.queued = False  # 是否在堆中
+
+    def touch(self):
+        """记录一次数据转发"""
+        self.last_activity = time.monotonic()
+
+    def deadline(self):
+        """返回 (截止时间, 原因)，不限制时返回 (None, None)"""
+        candidates = []
+        if self.manager.idle_timeout:
+            candidates.append((self.last_activity + self.manager.idle_timeout, EXPIRE_IDLE))
+        if self.manager.max_lifetime:
+            candidates.append((self.started + self.manager.max_lifetime, EXPIRE_LIFETIME))
+        return min(candidates) if candidates else (None, None)
+
+    def close(self):
+        """隧道结束，之后不会再触发回调；需在关闭 socket 之前调用
+
+        释放回调（及其引用的 socket），已关闭的计时器过多时压缩堆
+        """
+        with self.manager.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.on_expire = None
+            if self.queued:
+                self.manager.discard_closed()
+
+class TunnelTimeouts:
+    """基于最小堆的隧道超时管理，idle_timeout/max_lifetime 为 0 时表示不限制"""
+
+    def __init__(self, idle_timeout=600, max_lifetime=0):
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.heap = []  # (截止时间, 序号, TunnelTimer)，已关闭的隧道到期时或压缩时丢弃
+        self.closed_queued = 0  # 堆中已关闭的计时器数
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.thread = None
+        self.expired = {EXPIRE_IDLE: 0, EXPIRE_LIFETIME: 0}
+
+    def register(self, on_expire):
+        """登记一条隧道，到期时以原因为参数调用 on_expire"""
+        timer = TunnelTimer(self, on_expire)
+        deadline, _ = timer.deadline()
+        if deadline is not None:
+            with self.lock:
+                self.push(deadline, timer)
+        return timer
+
+    def push(self, deadline, timer):
+        """加入堆，调用方需持有锁"""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True, name='tunnel-timeouts')
+            self.thread.start()
+        heapq.heappush(self.heap, (deadline, next(self.counter), timer))
+        timer.queued = True
+        if self.heap[0][2] is timer:
+            self.wakeup.notify()
+
+    def discard_closed(self):
+        """堆中的计时器已关闭；已关闭的多于未关闭的时重建堆，调用方需持有锁
+
+        短连接的截止时间（默认 600 秒）远晚于其关闭时间，不压缩时堆会随连接速率无限增长
+        """
+        self.closed_queued += 1
+        if self.closed_queued * 2 <= len(self.heap):
+            return
+        live = [entry for entry in self.heap if not entry[2].closed]
+        for entry in self.heap:
+            if entry[2].closed:
+                entry[2].queued = False
+        heapq.heapify(live)
+        self.heap = live
+        self.closed_queued = 0
+
+    def run(self):
+        """后台线程: 等待最早的截止时间并处理到期隧道"""
+        with self.lock:
+            while True:
+                if not self.heap:
+                    self.wakeup.wait()
+                    continue
+                now = time.monotonic()
+                deadline, _, timer = self.heap[0]
+                if deadline > now:
+                    self.wakeup.wait(deadline - now)
+                    continue
+                heapq.heappop(self.heap)
+                timer.queued = False
+                if timer.closed:
+                    self.closed_queued -= 1
+                    continue
+                deadline, reason = timer.deadline()
+                if deadline > now:
+                    # 期间有数据转发，按新的截止时间重新入堆
+                    heapq.heappush(self.heap, (deadline, next(self.counter), timer))
+                    timer.queued = True
+                    continue
+                timer.closed = True
+                on_expire, timer.on_expire = timer.on_expire, None
+                self.expired[reason] += 1
+                try:
+                    on_expire(reason)
+                except Exception:
+                    pass
+
+    def get_stats(self):
+        """获取超时统计信息"""
+        with self.lock:
+            return {
+                'tunnel_idle_timeouts': self.expired[EXPIRE_IDLE],
+                'tunnel_lifetime_expirations': self.expired[EXPIRE_LIFETIME]
+            }
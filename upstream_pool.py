@@ -0,0 +1,144 @@
+"""
+上游代理预热连接池
+为当前最优的若干上游代理预先建立 TCP 连接，CONNECT 时可直接在空闲连接上发送请求，
+省去到远端代理的 TCP 握手。选择上游代理时优先选用有空闲连接的代理（warm_proxy），
+否则按选择策略随机选到预热代理的概率很低，预热的连接大多闲置到过期
+"""
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+class UpstreamPool:
+    """按代理维护空闲连接，带单代理上限、空闲超时和存活检查"""
+
+    def __init__(self, proxy_manager, pool_proxies=3, per_proxy=2, idle_timeout=30,
+                 connect_timeout=5, refill_interval=1, demand_window=60):
+        self.proxy_manager = proxy_manager
+        self.pool_proxies = pool_proxies  # 预热的代理个数（按代价排序取前 N 个）
+        self.per_proxy = per_proxy  # 每个代理保持的空闲连接数
+        self.idle_timeout = idle_timeout  # 空闲连接的最长保留时间（秒）
+        self.connect_timeout = connect_timeout
+        self.refill_interval = refill_interval
+        # 最近 demand_window 秒内有上游请求时才预热，避免无流量时持续连接免费代理
+        self.demand_window = demand_window
+        self.last_demand = 0
+        self.idle = {}  # proxy -> deque[(socket, created_at)]
+        self.connecting = {}  # proxy -> 正在建立的连接数
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='upstream-pool')
+        self.stats = {'hits': 0, 'misses': 0, 'stale': 0}
+
+    @staticmethod
+    def parse_proxy(proxy):
+        """解析 "host:port" 形式的代理地址"""
+        proxy_parts = proxy.replace('http://', '').split(':')
+        return proxy_parts[0], int(proxy_parts[1])
+
+    @staticmethod
+    def is_alive(sock):
+        """非阻塞探测空闲连接: 对端已关闭或意外发来数据都视为不可用"""
+        try:
+            sock.setblocking(False)
+            sock.recv(1, socket.MSG_PEEK)
+            return False
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+
+    def acquire(self, proxy):
+        """取出一个到 proxy 的可用空闲连接，没有时返回 None"""
+        self.last_demand = time.monotonic()
+        while True:
+            with self.lock:
+                connections = self.idle.get(proxy)
+                if not connections:
+                    self.stats['misses'] += 1
+                    return None
+                sock, created_at = connections.popleft()
+            if time.monotonic() - created_at < self.idle_timeout and self.is_alive(sock):
+                with self.lock:
+                    self.stats['hits'] += 1
+                return sock
+            with self.lock:
+                self.stats['stale'] += 1
+            sock.close()
+
+    def warm_proxy(self):
+        """有空闲连接的代理，没有时返回 None；只读取当前状态，不加锁"""
+        for proxy, connections in list(self.idle.items()):
+            if connections:
+                return proxy
+        return None
+
+    def open_connection(self, proxy):
+        """建立一个到代理的空闲连接并放入池中"""
+        sock = None
+        try:
+            sock = socket.create_connection(self.parse_proxy(proxy), timeout=self.connect_timeout)
+            with self.lock:
+                connections = self.idle.get(proxy)
+                if connections is not None and len(connections) < self.per_proxy:
+                    connections.append((sock, time.monotonic()))
+                    sock = None
+        except OSError:
+            pass
+        finally:
+            if sock is not None:
+                sock.close()
+            with self.lock:
+                self.connecting[proxy] = self.connecting.get(proxy, 1) - 1
+
+    def prune(self, connections):
+        """清理过期或已失效的空闲连接，调用方需持有锁"""
+        now = time.monotonic()
+        alive = deque()
+        for sock, created_at in connections:
+            if now - created_at < self.idle_timeout and self.is_alive(sock):
+                alive.append((sock, created_at))
+            else:
+                sock.close()
+        return alive
+
+    def refill(self):
+        """为当前最优代理补足空闲连接，关闭不再需要的连接"""
+        demand = time.monotonic() - self.last_demand < self.demand_window
+        targets = self.proxy_manager.get_best_proxies(self.pool_proxies) if demand else []
+        with self.lock:
+            for proxy in list(self.idle):
+                if proxy not in targets:
+                    for sock, _ in self.idle.pop(proxy):
+                        sock.close()
+            for proxy in targets:
+                connections = self.prune(self.idle.get(proxy, deque()))
+                self.idle[proxy] = connections
+                missing = self.per_proxy - len(connections) - self.connecting.get(proxy, 0)
+                for _ in range(max(missing, 0)):
+                    self.connecting[proxy] = self.connecting.get(proxy, 0) + 1
+                    self.executor.submit(self.open_connection, proxy)
+
+    def refill_loop(self):
+        """定期补充连接池的线程"""
+        while True:
+            try:
+                self.refill()
+            except Exception:
+                pass
+            time.sleep(self.refill_interval)
+
+    def start(self):
+        """启动后台补充线程"""
+        thread = threading.Thread(target=self.refill_loop, daemon=True)
+        thread.start()
+
+    def get_stats(self):
+        """获取连接池统计信息"""
+        with self.lock:
+            return {
+                'upstream_pool_idle': sum(len(c) for c in self.idle.values()),
+                'upstream_pool_hits': self.stats['hits'],
+                'upstream_pool_misses': self.stats['misses'],
+                'upstream_pool_stale': self.stats['stale']
+            }
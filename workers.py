@@ -0,0 +1,281 @@
+"""
+多进程 worker 模式
+各 worker 以 SO_REUSEPORT 绑定同一端口，由内核在进程间分配连接；
+supervisor 负责统一维护代理池、重启异常退出的 worker 并汇总统计
+"""
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+import logging
+from proxy_manager import ProxyManager
+from lifecycle import GracefulShutdown, STOP_RESTART, hand_over
+from access_log import setup_async_logging, dropped_log_records
+from tunnel_proxy import CUMULATIVE_STATS
+from metrics import (MetricsServer, merge_entries, stats_entries, proxy_manager_entries,
+                     histogram_summary)
+
+logger = logging.getLogger(__name__)
+
+def create_proxy(engine, host, port, **options):
+    """按引擎类型创建代理服务器实例"""
+    if engine == 'asyncio':
+        from async_tunnel_proxy import AsyncTunnelProxy
+        return AsyncTunnelProxy(host=host, port=port, **options)
+    from tunnel_proxy import TunnelProxy
+    return TunnelProxy(host=host, port=port, **options)
+
+def worker_main(engine, host, port, options, manager_options, conn, report_interval=5):
+    """worker 进程入口：接收代理池快照，定期上报统计和代理的连接结果"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    setup_async_logging()
+    # worker 不读写状态文件，代理池完全由 supervisor 下发
+    manager_options = dict(manager_options, state_file=None)
+    # 连接结果随统计上报，由 supervisor 合并到统一的代理池状态后再下发给所有 worker
+    proxy_manager = ProxyManager(auto_update=False, relay_outcomes=True, **manager_options)
+    # 指标服务和平滑重启由 supervisor 统一处理
+    options = dict(options, metrics_port=0)
+    proxy = create_proxy(engine, host, port, proxy_manager=proxy_manager, reuse_port=True,
+                         restart_on_hup=False, **options)
+
+    def sync_loop():
+        """与 supervisor 同步: 接收代理池状态，上报本进程统计和连接结果"""
+        last_report = 0
+        try:
+            # 首次上报即表示本 worker 已开始 accept
+            while not proxy.listening.wait(1):
+                if conn.poll():
+                    proxy_manager.load_state(conn.recv())
+            while True:
+                if conn.poll(1):
+                    proxy_manager.load_state(conn.recv())
+                if time.time() - last_report >= report_interval:
+                    conn.send({'stats': proxy.get_stats(), 'metrics': proxy.metrics.collect(),
+                               'outcomes': proxy_manager.take_relayed_outcomes()})
+                    last_report = time.time()
+        except (EOFError, OSError):
+            logger.warning("与 supervisor 的连接已断开")
+
+    threading.Thread(target=sync_loop, daemon=True).start()
+    proxy.start()
+    # 收到 SIGTERM 正常排空后退出码为 0，supervisor 不再重启；其他原因退出时由 supervisor 重启
+    if not proxy.shutdown.reason:
+        sys.exit(1)
+
+class WorkerSupervisor:
+    """启动并守护 N 个 worker 进程"""
+
+    def __init__(self, host, port, workers, engine='threading', options=None,
+                 manager_options=None, sync_interval=10, stats_interval=60,
+                 drain_timeout=30, on_ready=None, metrics_host=None, metrics_port=0):
+        self.host = host
+        self.port = port
+        self.num_workers = workers
+        self.engine = engine
+        self.options = options or {}
+        self.manager_options = manager_options or {}  # ProxyManager 配置（supervisor 与 worker 共用）
+        self.sync_interval = sync_interval  # 代理池快照下发间隔（秒）
+        self.stats_interval = stats_interval  # 汇总统计日志间隔（秒）
+        self.context = multiprocessing.get_context('spawn')
+        self.workers = {}  # index -> (process, conn)
+        self.worker_stats = {}  # index -> 最近一次上报的统计
+        self.retired_stats = {key: 0 for key in CUMULATIVE_STATS}
+        self.retired_metrics = []  # 已退出 worker 的累计指标（不含仪表）
+        self.proxy_manager = None
+        # SIGTERM: worker 各自排空后退出；SIGHUP: 启动新的 supervisor，其 worker 就绪后本进程退出
+        self.drain_timeout = drain_timeout
+        self.shutdown = GracefulShutdown(self.stop_supervising, self.restart)
+        self.stop_requests = 0  # 收到 SIGTERM 的次数，第二次时不再等待 worker 排空
+        self.on_ready = on_ready  # 所有 worker 都开始 accept 时调用
+        self.metrics_host = host if metrics_host is None else metrics_host
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+
+    def spawn_worker(self, index):
+        """启动第 index 个 worker"""
+        parent_conn, child_conn = self.context.Pipe()
+        process = self.context.Process(
+            target=worker_main,
+            args=(self.engine, self.host, self.port, self.options, self.manager_options, child_conn),
+            name=f"tunnel-worker-{index}",
+            daemon=True
+        )
+        process.start()
+        child_conn.close()
+        self.workers[index] = (process, parent_conn)
+        # 新 worker 立即获得当前代理池
+        self.send_state(index, self.proxy_manager.export_state())
+        logger.info(f"worker {index} 已启动 (PID: {process.pid})")
+
+    def send_state(self, index, state):
+        """向 worker 下发代理池快照"""
+        try:
+            self.workers[index][1].send(state)
+        except (OSError, EOFError, ValueError):
+            pass
+
+    def collect_stats(self):
+        """读取各 worker 上报的统计，并将其中的连接结果合并到代理池"""
+        for index, (process, conn) in self.workers.items():
+            try:
+                while conn.poll():
+                    report = conn.recv()
+                    self.proxy_manager.merge_outcomes(report.pop('outcomes', None))
+                    self.worker_stats[index] = report
+            except (OSError, EOFError):
+                pass
+
+    def get_stats(self):
+        """汇总所有 worker 的统计"""
+        totals = dict(self.retired_stats)
+        totals['active_connections'] = 0
+        for report in self.worker_stats.values():
+            for key, value in report['stats'].items():
+                totals[key] = totals.get(key, 0) + value
+        totals['log_records_dropped'] = totals.get('log_records_dropped', 0) + dropped_log_records()
+        totals['workers'] = sum(1 for process, _ in self.workers.values() if process.is_alive())
+        return totals
+
+    def merged_metrics(self):
+        """合并所有 worker（含已退出 worker 的累计值）的指标"""
+        return merge_entries(
+            [self.retired_metrics] + [report['metrics'] for report in self.worker_stats.values()]
+        )
+
+    def collect_metrics(self):
+        """导出汇总后的 Prometheus 指标条目"""
+        entries = self.merged_metrics()
+        native = {entry['name'] for entry in entries}
+        stats = {
+            key: value for key, value in self.get_stats().items()
+            if key not in ('connections', 'active_connections', 'bytes_transferred', 'bytes_in',
+                           'bytes_out', 'connect_failures')
+            and f"tunnel_{key}" not in native
+        }
+        entries.extend(stats_entries(stats, CUMULATIVE_STATS))
+        entries.extend(proxy_manager_entries(self.proxy_manager))
+        return entries
+
+    def metrics_json(self):
+        """导出 JSON 格式的汇总状态"""
+        return {
+            'stats': self.get_stats(),
+            'histograms': histogram_summary(self.merged_metrics()),
+            'proxy_pool': self.proxy_manager.get_proxy_stats(),
+            'proxies': self.proxy_manager.get_proxy_health()
+        }
+
+    def reap_workers(self):
+        """重启异常退出的 worker，所有 worker 都正常退出时返回 False"""
+        for index, (process, conn) in list(self.workers.items()):
+            if process.is_alive():
+                continue
+            last_report = self.worker_stats.pop(index, None)
+            if last_report:
+                for key in CUMULATIVE_STATS:
+                    self.retired_stats[key] += last_report['stats'].get(key, 0)
+                self.retired_metrics = merge_entries([
+                    self.retired_metrics,
+                    [entry for entry in last_report['metrics'] if entry['type'] != 'gauge']
+                ])
+            conn.close()
+            if process.exitcode == 0:
+                # worker 被单独发送 SIGTERM（如 --force 接管端口）并已排空
+                logger.info(f"worker {index} (PID: {process.pid}) 已停止")
+                del self.workers[index]
+                continue
+            logger.warning(f"worker {index} (PID: {process.pid}) 已退出，退出码 {process.exitcode}，正在重启")
+            self.spawn_worker(index)
+        return bool(self.workers)
+
+    def restart(self):
+        """SIGHUP: 启动新的 supervisor，其 worker 以 SO_REUSEPORT 绑定同一端口，全部就绪后返回 True"""
+        return hand_over(self.proxy_manager)
+
+    def forward_signal(self, signum, frame=None):
+        """SIGUSR1/SIGUSR2: 转发给所有 worker，由各 worker 输出线程栈或进行采样分析"""
+        for process, conn in self.workers.values():
+            if process.is_alive():
+                os.kill(process.pid, signum)
+
+    def stop_supervising(self):
+        """SIGTERM: 记录停止请求，主循环在下一轮检查时退出"""
+        self.stop_requests += 1
+
+    def stop(self):
+        """停止所有 worker: 先发送 SIGTERM 让其排空，超时后强制结束"""
+        for process, conn in self.workers.values():
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + self.drain_timeout + 5
+        for process, conn in self.workers.values():
+            # 排空期间再次收到 SIGTERM 时不再等待
+            while process.is_alive() and self.stop_requests < 2 and time.monotonic() < deadline:
+                process.join(timeout=0.1)
+            if process.is_alive():
+                process.kill()
+                process.join(timeout=1)
+            conn.close()
+
+    def start(self):
+        """启动 supervisor 主循环"""
+        # 代理池只在 supervisor 中拉取和验证一次，再同步给所有 worker
+        self.proxy_manager = ProxyManager(**self.manager_options)
+        for index in range(self.num_workers):
+            self.spawn_worker(index)
+        if self.metrics_port:
+            try:
+                self.metrics_server = MetricsServer(self, self.metrics_host, self.metrics_port)
+                self.metrics_server.start()
+            except OSError as e:
+                logger.error(f"❌ 指标服务启动失败: {e}")
+
+        last_sync = time.time()
+        last_stats = time.time()
+        try:
+            if self.shutdown.install() and hasattr(signal, 'SIGUSR1'):
+                signal.signal(signal.SIGUSR1, self.forward_signal)
+                signal.signal(signal.SIGUSR2, self.forward_signal)
+            while not self.stop_requests:
+                time.sleep(1)
+                if self.stop_requests:
+                    break
+                self.collect_stats()
+                if not self.reap_workers():
+                    logger.info("所有 worker 都已停止")
+                    break
+                if self.on_ready and len(self.worker_stats) == len(self.workers):
+                    self.on_ready()
+                    self.on_ready = None
+                if time.time() - last_sync >= self.sync_interval:
+                    state = self.proxy_manager.export_state()
+                    for index in self.workers:
+                        self.send_state(index, state)
+                    last_sync = time.time()
+                if time.time() - last_stats >= self.stats_interval:
+                    stats = self.get_stats()
+                    proxy_stats = self.proxy_manager.get_proxy_stats()
+                    logger.info(
+                        f"汇总状态 - worker: {stats['workers']}/{self.num_workers}, "
+                        f"总连接: {stats['connections']}, "
+                        f"活跃连接: {stats['active_connections']}, "
+                        f"传输字节: {stats['bytes_transferred']}, "
+                        f"路由缓存命中/未命中: {stats.get('route_cache_hits', 0)}/{stats.get('route_cache_misses', 0)}, "
+                        f"可用代理: {proxy_stats['available_proxies']}/{proxy_stats['total_proxies']}"
+                    )
+                    last_stats = time.time()
+            
+            if self.stop_requests:
+                logger.info(f"🛑 收到停止信号，等待 worker 排空 (最长 {self.drain_timeout} 秒)...")
+                self.proxy_manager.save_state_file()
+                if self.shutdown.reason == STOP_RESTART and self.metrics_server:
+                    self.metrics_server.stop()
+        except KeyboardInterrupt:
+            logger.info("🛑 收到停止信号，正在停止所有 worker...")
+        finally:
+            self.stop()